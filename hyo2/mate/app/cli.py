@@ -1,21 +1,40 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import json
+import logging
 import os
+import sys
+import threading
+import time
 
+from hyo2.mate.lib.catalogue import SurveyCatalogue
+from hyo2.mate.lib.check_cache import CheckCache
+from hyo2.mate.lib.export import ParquetExporter
 from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.raw_file import raw_file_name
+from hyo2.mate.lib.watch import DirectoryWatcher, ProcessedFiles, \
+    check_raw_file, DEFAULT_SETTLE_TIME, DEFAULT_POLL_INTERVAL
 from ausseabed.qajson.parser import QajsonParser
 
+logger = logging.getLogger(__name__)
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "-i", "--input", help='Path to input QA JSON file', required=True)
-    parser.add_argument(
-        "-o", "--output", help='Path to output QA JSON file. If not provided \
-        will be printed to stdout.', required=False)
-    args = parser.parse_args()
 
-    qajson_input = args.input
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    # subcommands are given as the first argument, without one the QA JSON
+    # given by -i is run
+    if len(argv) > 0 and argv[0] in SUBCOMMANDS:
+        return SUBCOMMANDS[argv[0]](argv[1:])
+    return run(argv)
+
+
+def load_qajson(qajson_input: str) -> dict:
+    '''
+    Reads a QA JSON file, after validating it against the most recent
+    schema.
+    '''
     if not os.path.isfile(qajson_input):
         raise RuntimeError(
             "QA JSON file does not exist {}".format(qajson_input))
@@ -28,16 +47,74 @@ def main():
         raise RuntimeError(
             "QA JSON is invalid {}".format(qajson_input))
 
-    rawdatachecks = None
-    output = None
     with open(qajson_input) as jsonfile:
-        qajson = json.load(jsonfile)
-        output = qajson
-        rawdatachecks = qajson['qa']['raw_data']['checks']
+        return json.load(jsonfile)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(
+        prog='hyo2.mate',
+        epilog="Use `hyo2.mate watch -h` and `hyo2.mate query -h` for the \
+        watch mode and survey catalogue query options.")
+    parser.add_argument(
+        "-i", "--input", help='Path to input QA JSON file', required=True)
+    parser.add_argument(
+        "-o", "--output", help='Path to output QA JSON file. If not provided \
+        will be printed to stdout.', required=False)
+    parser.add_argument(
+        "-c", "--cache", help='Path to check output cache. Checks that have \
+        already been run on unchanged files will not be run again.',
+        required=False)
+    parser.add_argument(
+        "--read-ahead", help='Read raw files in large blocks in a background \
+        thread. Improves throughput when files are on a network share.',
+        action='store_true')
+    parser.add_argument(
+        "--prefetch", help='While each raw file is checked, read the next \
+        one into the file system cache in a background thread.',
+        action='store_true')
+    parser.add_argument(
+        "--sampled", help='Quick look mode. Only parts of each raw file are \
+        scanned and counts are extrapolated, results are flagged as \
+        provisional.',
+        action='store_true')
+    parser.add_argument(
+        "--skip-duplicates", help='Raw files that hold the same data as \
+        another file, or a truncated copy of it, are found from their \
+        content and not scanned.',
+        action='store_true')
+    add_catalogue_arguments(parser)
+    add_export_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.export is not None and args.survey is None:
+        parser.error("--survey is required with --export")
+
+    qajson = load_qajson(args.input)
+    output = qajson
+    rawdatachecks = qajson['qa']['raw_data']['checks']
 
-    checkrunner = CheckRunner(rawdatachecks)
-    checkrunner.initialize()
-    checkrunner.run_checks()
+    cache = None
+    catalogue = None
+    try:
+        if args.cache is not None:
+            cache = CheckCache(args.cache)
+        if args.catalogue is not None:
+            catalogue = SurveyCatalogue(args.catalogue)
+        exporter = create_exporter(args)
+
+        checkrunner = CheckRunner(
+            rawdatachecks, cache=cache, catalogue=catalogue,
+            vessel=args.vessel, exporter=exporter)
+        checkrunner.initialize()
+        checkrunner.run_checks(
+            read_ahead=args.read_ahead, prefetch=args.prefetch,
+            sampled=args.sampled,
+            skip_duplicates=args.skip_duplicates)
+    finally:
+        if cache is not None:
+            cache.close()
+        if catalogue is not None:
+            catalogue.close()
 
     output['qa']['raw_data']['checks'] = checkrunner.output
     if args.output is None:
@@ -49,5 +126,243 @@ def main():
             jsonfileoutput.write(json.dumps(output, indent=4))
 
 
+def add_catalogue_arguments(parser):
+    parser.add_argument(
+        "--catalogue", help='Path to survey catalogue. The scan results and \
+        check states of each file are added to it, for use with \
+        `hyo2.mate query`.', required=False)
+    parser.add_argument(
+        "--vessel", help='Name of the vessel that recorded the files, \
+        stored in the survey catalogue and used to partition exported \
+        data.', required=False)
+
+
+def add_export_arguments(parser):
+    parser.add_argument(
+        "--export", help='Directory the datagram index, positions and \
+        attitude of each file are written to as Parquet, partitioned by \
+        survey, vessel and day. Requires pyarrow.', required=False)
+    parser.add_argument(
+        "--survey", help='Name of the survey, used to partition exported \
+        data.', required=False)
+
+
+def create_exporter(args):
+    if args.export is None:
+        return None
+    return ParquetExporter(args.export, args.survey)
+
+
+def watch(argv):
+    parser = argparse.ArgumentParser(
+        prog='hyo2.mate watch',
+        description='Watches acquisition folders, and runs the checks of a \
+        QA JSON file on each raw file (.all, .kmall, .gsf) once it has \
+        stopped being written to.')
+    parser.add_argument(
+        "directories", nargs='+', help='Directories to watch')
+    parser.add_argument(
+        "-i", "--input", help='Path to QA JSON file giving the checks to \
+        run. The input files of the checks are ignored.', required=True)
+    parser.add_argument(
+        "-o", "--output-dir", help='Directory the QA JSON of each raw file \
+        is written to, as <raw file name>.qa.json. Files in sub directories \
+        of a watched directory are written to the same sub directories of \
+        the output directory. Defaults to the current directory.',
+        default=None)
+    parser.add_argument(
+        "--ndjson", help='Append the checks of each raw file to this file \
+        as a line of JSON, instead of writing a QA JSON file per raw file.',
+        default=None)
+    parser.add_argument(
+        "--state", help='File recording the raw files that have been \
+        checked, these are not checked again unless they change. Defaults \
+        to .mate_processed in the output directory, or next to the NDJSON \
+        file.', default=None)
+    parser.add_argument(
+        "-c", "--cache", help='Path to check output cache.', required=False)
+    parser.add_argument(
+        "-r", "--recursive", help='Also watch sub directories',
+        action='store_true')
+    parser.add_argument(
+        "--settle-time", help='Seconds a raw file must be unchanged for \
+        before it is checked.', type=float, default=DEFAULT_SETTLE_TIME)
+    parser.add_argument(
+        "--poll-interval", help='Seconds between checks for new files.',
+        type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument(
+        "--workers", help='Number of raw files checked at the same time.',
+        type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument(
+        "--no-events", help='List the directories on each poll rather than \
+        using file system events. Needed for some network shares.',
+        action='store_true')
+    parser.add_argument(
+        "--once", help='Check the files found, then exit once none are \
+        left waiting to settle.', action='store_true')
+    parser.add_argument(
+        "--read-ahead", help='Read raw files in large blocks in a background \
+        thread.', action='store_true')
+    add_catalogue_arguments(parser)
+    add_export_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.export is not None and args.survey is None:
+        parser.error("--survey is required with --export")
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    qajson = load_qajson(args.input)
+    template_checks = qajson['qa']['raw_data']['checks']
+
+    output_dir = args.output_dir
+    if output_dir is None:
+        output_dir = os.getcwd()
+    state_path = args.state
+    if state_path is None:
+        if args.ndjson is not None:
+            state_path = args.ndjson + '.processed'
+        else:
+            state_path = os.path.join(output_dir, '.mate_processed')
+    if args.ndjson is None:
+        os.makedirs(output_dir, exist_ok=True)
+    processed = ProcessedFiles(state_path)
+
+    cache = None
+    if args.cache is not None:
+        cache = CheckCache(args.cache)
+
+    catalogue = None
+    if args.catalogue is not None:
+        catalogue = SurveyCatalogue(args.catalogue)
+    exporter = create_exporter(args)
+
+    output_lock = threading.Lock()
+
+    def write_output(path, checks):
+        checks = [check.to_dict() for check in checks]
+        if args.ndjson is not None:
+            line = json.dumps({'file': path, 'checks': checks})
+            with output_lock:
+                with open(args.ndjson, 'a') as f:
+                    f.write(line + '\n')
+            return
+        output = copy.deepcopy(qajson)
+        output['qa']['raw_data']['checks'] = checks
+        # from the path within the watched directory, so files of the same
+        # name in different sub directories don't overwrite each other
+        relative_dir = os.path.dirname(watcher.relative_path(path))
+        output_path = os.path.join(
+            output_dir, relative_dir, raw_file_name(path) + '.qa.json')
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        # written to a temporary file first so a partly written file is
+        # never picked up by another process
+        with open(output_path + '.tmp', 'w') as f:
+            f.write(json.dumps(output, indent=4))
+        os.replace(output_path + '.tmp', output_path)
+
+    def process(path):
+        # the size and time are taken before the checks, so a file changed
+        # while being checked is checked again
+        stat = os.stat(path)
+        checks = check_raw_file(
+            template_checks, path, cache, args.read_ahead, catalogue,
+            args.vessel, exporter)
+        write_output(path, checks)
+        processed.add(path, stat.st_size, stat.st_mtime_ns)
+        return path
+
+    watcher = DirectoryWatcher(
+        args.directories,
+        settle_time=args.settle_time,
+        recursive=args.recursive,
+        use_events=not args.no_events,
+        processed=processed)
+    running = set()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            while True:
+                for path in watcher.poll():
+                    running.add(executor.submit(process, path))
+                for future in [f for f in running if f.done()]:
+                    running.remove(future)
+                    try:
+                        logger.info("Checked {}".format(future.result()))
+                    except Exception:
+                        logger.exception("Checks failed")
+                if args.once and len(running) == 0 and \
+                        watcher.pending_count == 0:
+                    break
+                time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        if cache is not None:
+            cache.close()
+        if catalogue is not None:
+            catalogue.close()
+
+
+def query(argv):
+    parser = argparse.ArgumentParser(
+        prog='hyo2.mate query',
+        description='Answers questions about a survey from the catalogue \
+        written by `hyo2.mate --catalogue` or `hyo2.mate watch \
+        --catalogue`, without scanning the files again.')
+    parser.add_argument("catalogue", help='Path to survey catalogue')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--missed-pings", metavar='PERCENT', type=float, help='Files with \
+        more than this percentage of pings missed.')
+    group.add_argument(
+        "--missing-type", metavar='TYPE', help='Files without any \
+        datagrams of this type (eg; S).')
+    group.add_argument(
+        "--pings-by", choices=['vessel', 'models', 'format'], help='Total \
+        ping count grouped by vessel, echo sounder model or format.')
+    group.add_argument(
+        "--failed", help='Files with failed checks.', action='store_true')
+    group.add_argument(
+        "--sql", help='SQL select statement run against the catalogue.')
+    parser.add_argument(
+        "--json", help='Print each row as a line of JSON rather than as \
+        tab separated values.', action='store_true')
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.catalogue):
+        raise RuntimeError(
+            "Catalogue does not exist {}".format(args.catalogue))
+    catalogue = SurveyCatalogue(args.catalogue)
+    try:
+        if args.missed_pings is not None:
+            columns, rows = catalogue.missed_pings(args.missed_pings)
+        elif args.missing_type is not None:
+            columns, rows = catalogue.missing_datagram_type(
+                args.missing_type)
+        elif args.pings_by is not None:
+            columns, rows = catalogue.ping_totals(args.pings_by)
+        elif args.failed:
+            columns, rows = catalogue.failed_checks()
+        else:
+            columns, rows = catalogue.query(args.sql)
+    finally:
+        catalogue.close()
+
+    if args.json:
+        for row in rows:
+            print(json.dumps(dict(zip(columns, row))))
+    else:
+        print('\t'.join(columns))
+        for row in rows:
+            print('\t'.join('' if v is None else str(v) for v in row))
+
+
+# functions run for each subcommand, given the remaining arguments
+SUBCOMMANDS = {
+    'watch': watch,
+    'query': query,
+}
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,332 @@
+from datetime import datetime
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Tuple
+
+from ausseabed.qajson.model import QajsonCheck
+
+from hyo2.mate.lib.check_cache import file_fingerprint
+from hyo2.mate.lib.raw_file import raw_file_extension, raw_file_name, \
+    split_archive_path, split_compression_suffix
+from hyo2.mate.lib.scan import Scan
+
+logger = logging.getLogger(__name__)
+
+# how the datagrams in the file were read
+SCAN_MODE_FULL = 'full'
+SCAN_MODE_SAMPLED = 'sampled'
+SCAN_MODE_METADATA = 'metadata'
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS files ("
+    "  path TEXT PRIMARY KEY,"
+    "  fingerprint TEXT,"
+    "  file_name TEXT NOT NULL,"
+    "  format TEXT,"
+    "  size INTEGER,"
+    "  vessel TEXT,"
+    "  models TEXT,"
+    "  serial_numbers TEXT,"
+    "  start_time TEXT,"
+    "  stop_time TEXT,"
+    "  ping_type TEXT,"
+    "  scan_mode TEXT NOT NULL,"
+    "  scanned_at TEXT NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS datagram_types ("
+    "  path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,"
+    "  dg_type TEXT NOT NULL,"
+    "  record_count INTEGER,"
+    "  byte_count INTEGER,"
+    "  ping_count INTEGER,"
+    "  missed_pings INTEGER,"
+    "  start_time TEXT,"
+    "  stop_time TEXT,"
+    "  PRIMARY KEY (path, dg_type)"
+    ")",
+    "CREATE TABLE IF NOT EXISTS installation_parameters ("
+    "  path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,"
+    "  name TEXT NOT NULL,"
+    "  value TEXT,"
+    "  PRIMARY KEY (path, name)"
+    ")",
+    "CREATE TABLE IF NOT EXISTS check_states ("
+    "  path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,"
+    "  check_id TEXT NOT NULL,"
+    "  check_version TEXT NOT NULL,"
+    "  check_name TEXT,"
+    "  state TEXT,"
+    "  status TEXT,"
+    "  PRIMARY KEY (path, check_id, check_version)"
+    ")",
+    "CREATE INDEX IF NOT EXISTS files_start_time ON files (start_time)",
+    "CREATE INDEX IF NOT EXISTS files_vessel ON files (vessel)",
+    "CREATE INDEX IF NOT EXISTS datagram_types_type "
+    "ON datagram_types (dg_type)",
+    "CREATE INDEX IF NOT EXISTS installation_parameters_name "
+    "ON installation_parameters (name, value)",
+    "CREATE INDEX IF NOT EXISTS check_states_state "
+    "ON check_states (check_id, state)",
+]
+
+
+def _time_str(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _check_rows(path: str, checks: List[QajsonCheck]) -> List[Tuple]:
+    rows = []
+    for check in checks or []:
+        outputs = check.outputs
+        rows.append((
+            path, check.info.id, check.info.version, check.info.name,
+            None if outputs is None else outputs.check_state,
+            None if outputs is None or outputs.execution is None
+            else outputs.execution.status))
+    return rows
+
+
+def _is_plain_file(path: str) -> bool:
+    return split_archive_path(path)[1] is None and \
+        split_compression_suffix(path)[1] is None
+
+
+class SurveyCatalogue:
+    """ Catalogue of the scan results of every file checked during a survey,
+    so survey wide questions (eg; which lines have more than 1% missed
+    pings) can be answered without scanning the files again.
+
+    For each file the catalogue holds the counts in `scan_result` for each
+    datagram type, the installation parameters, the time bounds and systems
+    that recorded it, and the state of each check run on it. These are
+    stored in an indexed SQLite database. Recording a file again replaces
+    its previous entry.
+    """
+
+    def __init__(self, path: str):
+        """ `SurveyCatalogue` constructor
+
+        Args:
+            path (str): path to the SQLite database file. Will be created if
+                it does not exist.
+        """
+        self.path = path
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def record(
+            self,
+            path: str,
+            scan: Scan,
+            checks: List[QajsonCheck] = None,
+            vessel: str = None):
+        """ Adds the results of a scan, and the checks run on the file, to
+        the catalogue.
+
+        Args:
+            path (str): path of the file, as given in the QA JSON
+            scan (Scan): scan of the file, the scan must still be open
+            checks (list): `QajsonCheck` run on the file, with outputs
+            vessel (str): name of the vessel that recorded the file
+        """
+        if scan.sampled:
+            scan_mode = SCAN_MODE_SAMPLED
+        elif scan.metadata_only:
+            scan_mode = SCAN_MODE_METADATA
+        else:
+            scan_mode = SCAN_MODE_FULL
+
+        start_times = []
+        stop_times = []
+        type_rows = []
+        for dg_type, info in scan.scan_result.items():
+            if info.get('startTime') is not None:
+                start_times.append(info['startTime'])
+            if info.get('stopTime') is not None:
+                stop_times.append(info['stopTime'])
+            type_rows.append((
+                path, str(dg_type), info.get('recordCount'),
+                info.get('byteCount'), info.get('pingCount'),
+                info.get('missedPings'), _time_str(info.get('startTime')),
+                _time_str(info.get('stopTime'))))
+
+        # several datagram types of a format may count the same pings (eg;
+        # the X, N and Y datagrams of a .all file), so the ping counts of
+        # the file are those of the type the scan takes pings from
+        ping_type = scan.ping_bounds()['pingType']
+        if ping_type is not None:
+            ping_type = str(ping_type)
+
+        models = []
+        serial_numbers = []
+        if _is_plain_file(path):
+            # only a few KB are read from each end of the file
+            try:
+                quick_info = scan.quick_info()
+                models = quick_info['models']
+                serial_numbers = quick_info['serialNumbers']
+                if quick_info['startTime'] is not None:
+                    start_times.append(quick_info['startTime'])
+                if quick_info['stopTime'] is not None:
+                    stop_times.append(quick_info['stopTime'])
+            except NotImplementedError:
+                pass
+
+        parameter_rows = []
+        get_parameters = getattr(scan, 'get_installation_parameters', None)
+        parameters = get_parameters() if get_parameters is not None \
+            else None
+        if isinstance(parameters, dict):
+            parameter_rows = [
+                (path, str(name), str(value))
+                for name, value in parameters.items()
+            ]
+        elif parameters is not None:
+            parameter_rows = [(path, 'text', str(parameters))]
+
+        check_rows = _check_rows(path, checks)
+
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "DELETE FROM files WHERE path = ?", (path,))
+                self._connection.execute(
+                    "INSERT INTO files (path, fingerprint, file_name, format,"
+                    " size, vessel, models, serial_numbers, start_time,"
+                    " stop_time, ping_type, scan_mode, scanned_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, file_fingerprint(path), raw_file_name(path),
+                        raw_file_extension(path).lower(), scan.data_size,
+                        vessel, ','.join(str(m) for m in models),
+                        ','.join(str(s) for s in serial_numbers),
+                        _time_str(min(start_times, default=None)),
+                        _time_str(max(stop_times, default=None)),
+                        ping_type, scan_mode, datetime.now().isoformat()))
+                # a metadata scan only read a few datagrams, so doesn't
+                # give counts of each type
+                if scan_mode != SCAN_MODE_METADATA:
+                    self._connection.executemany(
+                        "INSERT INTO datagram_types VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?)", type_rows)
+                self._connection.executemany(
+                    "INSERT INTO installation_parameters VALUES (?, ?, ?)",
+                    parameter_rows)
+                self._connection.executemany(
+                    "INSERT INTO check_states VALUES (?, ?, ?, ?, ?, ?)",
+                    check_rows)
+
+    def record_check_states(self, path: str, checks: List[QajsonCheck]):
+        """ Adds the states of checks run on a file that has already been
+        recorded, replacing any earlier states of the same checks. Used for
+        survey level checks, which are only run once every file has been
+        scanned. Files that aren't in the catalogue are ignored.
+
+        Args:
+            path (str): path of the file, as given in the QA JSON
+            checks (list): `QajsonCheck` run on the file, with outputs
+        """
+        with self._lock:
+            with self._connection:
+                recorded = self._connection.execute(
+                    "SELECT 1 FROM files WHERE path = ?", (path,)).fetchone()
+                if recorded is None:
+                    return
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO check_states "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    _check_rows(path, checks))
+
+    def is_recorded(self, path: str, fingerprint: str) -> bool:
+        """ Indicates if the catalogue holds the file with the given
+        `file_fingerprint`, ie; the file hasn't changed since it was recorded
+        """
+        _, rows = self.query(
+            "SELECT 1 FROM files WHERE path = ? AND fingerprint = ?",
+            (path, fingerprint))
+        return len(rows) > 0
+
+    def query(
+            self,
+            sql: str,
+            params: Tuple = ()) -> Tuple[List[str], List[Tuple]]:
+        """ Runs a query against the catalogue.
+
+        Args:
+            sql (str): SQL select statement
+            params (tuple): values of the `?` placeholders in `sql`
+
+        Returns:
+            Tuple of the column names and the rows returned
+        """
+        with self._lock:
+            cursor = self._connection.execute(sql, params)
+            rows = cursor.fetchall()
+        return [c[0] for c in cursor.description or []], rows
+
+    def missed_pings(
+            self, min_percent: float = 0.0) -> Tuple[List[str], List[Tuple]]:
+        """ Files where more than `min_percent` of pings were missed. Pings
+        are counted from the ping datagram type of each file.
+        """
+        return self.query(
+            "SELECT d.path, d.ping_count AS pings, d.missed_pings,"
+            " 100.0 * d.missed_pings /"
+            " (d.ping_count + d.missed_pings) AS missed_percent "
+            "FROM files f JOIN datagram_types d"
+            " ON d.path = f.path AND d.dg_type = f.ping_type "
+            "WHERE d.ping_count + d.missed_pings > 0"
+            " AND missed_percent > ? "
+            "ORDER BY missed_percent DESC",
+            (min_percent,))
+
+    def missing_datagram_type(
+            self, dg_type: str) -> Tuple[List[str], List[Tuple]]:
+        """ Files that don't include any datagrams of the given type """
+        return self.query(
+            "SELECT path, start_time FROM files "
+            "WHERE scan_mode != ? AND NOT EXISTS ("
+            " SELECT 1 FROM datagram_types d"
+            " WHERE d.path = files.path AND d.dg_type = ?) "
+            "ORDER BY start_time",
+            (SCAN_MODE_METADATA, str(dg_type)))
+
+    def ping_totals(
+            self, group_by: str = 'vessel') -> Tuple[List[str], List[Tuple]]:
+        """ Total ping count of the files grouped by a column of the files
+        table, eg; `vessel` or `models`. Pings are counted from the ping
+        datagram type of each file.
+        """
+        if group_by not in ['vessel', 'models', 'format', 'serial_numbers']:
+            raise ValueError("Can't group pings by {}".format(group_by))
+        return self.query(
+            "SELECT f.{0}, COUNT(DISTINCT f.path) AS files,"
+            " SUM(d.ping_count) AS pings,"
+            " SUM(d.missed_pings) AS missed_pings "
+            "FROM files f JOIN datagram_types d"
+            " ON d.path = f.path AND d.dg_type = f.ping_type "
+            "GROUP BY f.{0} ORDER BY f.{0}".format(group_by))
+
+    def failed_checks(self) -> Tuple[List[str], List[Tuple]]:
+        """ Files with checks that failed, or couldn't be run """
+        return self.query(
+            "SELECT path, check_name, state, status FROM check_states "
+            "WHERE state = 'fail' OR status = 'failed' "
+            "ORDER BY path, check_name")
+
+    def close(self):
+        """ Closes the connection to the catalogue database.
+        """
+        with self._lock:
+            self._connection.close()
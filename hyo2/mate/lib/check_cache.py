@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+from ausseabed.qajson.model import QajsonOutputs, QajsonParam
+
+from hyo2.mate.lib.raw_file import ARCHIVE_SEPARATOR, split_archive_path
+
+logger = logging.getLogger(__name__)
+
+
+def file_fingerprint(path: str) -> Optional[str]:
+    """ Generates a cheap fingerprint for a file based on its location, size
+    and modification time. Any change to the file contents made by acquisition
+    or processing software will update the modification time, so this is
+    enough to detect when cached check outputs are stale. Members of an
+    archive are fingerprinted using the archive's size and modification time.
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        Fingerprint string, or None if the file does not exist.
+    """
+    archive_path, member = split_archive_path(path)
+    if not os.path.exists(archive_path):
+        return None
+    stat = os.stat(archive_path)
+    location = os.path.abspath(archive_path)
+    if member is not None:
+        location += ARCHIVE_SEPARATOR + member
+    return "{}:{}:{}".format(location, stat.st_size, stat.st_mtime_ns)
+
+
+def canonical_params(params: List[QajsonParam]) -> str:
+    """ Generates a string representation of a list of check parameters that
+    does not depend on the order the parameters were given in.
+
+    Args:
+        params (list): list of `QajsonParam` objects
+
+    Returns:
+        JSON string of the sorted parameter names and values
+    """
+    if params is None:
+        params = []
+    pairs = sorted(
+        ([p.name, p.value] for p in params),
+        key=lambda pair: pair[0]
+    )
+    return json.dumps(pairs, sort_keys=True, default=str)
+
+
+class CheckCache:
+    """ Persistent store of check outputs. Outputs are keyed on the
+    fingerprint of the file the check was run against, the check id and
+    version, and the parameters given to the check. If none of these have
+    changed since the check was last run the cached output can be used
+    instead of re-scanning the file.
+
+    Outputs are stored in a SQLite database so the cache survives between
+    runs of the application (eg; each time QAX re-submits a QA JSON).
+    """
+
+    def __init__(self, path: str):
+        """ `CheckCache` constructor
+
+        Args:
+            path (str): path to the SQLite database file. Will be created if
+                it does not exist.
+        """
+        self.path = path
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS check_outputs ("
+            "  fingerprint TEXT NOT NULL,"
+            "  check_id TEXT NOT NULL,"
+            "  check_version TEXT NOT NULL,"
+            "  params TEXT NOT NULL,"
+            "  outputs TEXT NOT NULL,"
+            "  PRIMARY KEY (fingerprint, check_id, check_version, params)"
+            ")"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def default_path() -> str:
+        """ Location of the cache database used when none is specified.
+        """
+        return os.path.join(
+            os.path.expanduser('~'), '.hyo2', 'mate', 'check_cache.sqlite')
+
+    def get(
+        self,
+        fingerprint: str,
+        check_id: str,
+        check_version: str,
+        params: List[QajsonParam]
+    ) -> Optional[QajsonOutputs]:
+        """ Gets the cached outputs for a check.
+
+        Returns:
+            The `QajsonOutputs` from the previous run of this check, or None
+            if the check has not been run with these inputs.
+        """
+        if fingerprint is None:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT outputs FROM check_outputs WHERE fingerprint = ? "
+                "AND check_id = ? AND check_version = ? AND params = ?",
+                (fingerprint, check_id, check_version,
+                    canonical_params(params))
+            ).fetchone()
+        if row is None:
+            return None
+        return QajsonOutputs.from_dict(json.loads(row[0]))
+
+    def put(
+        self,
+        fingerprint: str,
+        check_id: str,
+        check_version: str,
+        params: List[QajsonParam],
+        outputs: QajsonOutputs
+    ):
+        """ Stores the outputs of a check. Any previously cached outputs for
+        the same inputs will be replaced.
+        """
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO check_outputs "
+                "(fingerprint, check_id, check_version, params, outputs) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (fingerprint, check_id, check_version,
+                    canonical_params(params),
+                    json.dumps(outputs.to_dict(), default=str))
+            )
+            self._connection.commit()
+
+    def clear(self):
+        """ Removes all cached outputs.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM check_outputs")
+            self._connection.commit()
+
+    def close(self):
+        """ Closes the connection to the cache database.
+        """
+        with self._lock:
+            self._connection.close()
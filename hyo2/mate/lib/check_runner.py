@@ -1,14 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
 import copy
 from datetime import datetime
 import logging
-import os
+import threading
 import traceback
-from typing import Callable, List
+from typing import Callable, Dict, List
 
 from ausseabed.qajson.model import QajsonParam, QajsonOutputs, \
     QajsonExecution, QajsonInputs, QajsonCheck, QajsonExecution
 
-from hyo2.mate.lib.utils import get_scan, get_check, is_check_supported
+from hyo2.mate.lib.scan import ScanState
+
+from hyo2.mate.lib.catalogue import SurveyCatalogue
+from hyo2.mate.lib.check_cache import CheckCache, file_fingerprint
+from hyo2.mate.lib.duplicates import content_fingerprint, find_duplicates, \
+    EXACT_DUPLICATE
+from hyo2.mate.lib.export import ParquetExporter
+from hyo2.mate.lib.readahead import FilePrefetcher
+from hyo2.mate.lib.raw_file import close_archives, raw_file_extension, \
+    split_archive_path, stored_file_size
+from hyo2.mate.lib.utils import get_scan, get_check, get_check_class, \
+    is_check_supported, is_metadata_check, is_survey_check
 
 logger = logging.getLogger(__name__)
 
@@ -24,17 +36,47 @@ class CheckRunner:
     to the next file.
     """
 
-    def __init__(self, checks_def: List[QajsonCheck]):
+    def __init__(
+            self,
+            checks_def: List[QajsonCheck],
+            cache: CheckCache = None,
+            catalogue: SurveyCatalogue = None,
+            vessel: str = None,
+            exporter: ParquetExporter = None):
         """ `CheckRunner` constructor
 
         Args:
             checks_def (dict): definition of checks. This should conform to
                 the checks block of the QA JSON schema.
+            cache (CheckCache): optional store of previous check outputs.
+                Checks that have already been run against an unchanged file
+                with the same parameters are answered from the cache.
+            catalogue (SurveyCatalogue): optional catalogue the scan results
+                and check states of each file scanned are added to.
+            vessel (str): name of the vessel that recorded the files, stored
+                in the catalogue and used to partition exported data.
+            exporter (ParquetExporter): optional exporter the datagram index
+                and position data of each file scanned is written with.
         """
         self._input = checks_def
         # The check runner output will be added to the input qajson
         self._output = self._input
         self._file_checks = None
+        # (check id, file path) to check lookup used to attach outputs
+        self._check_index = None
+        self._cache = cache
+        self._catalogue = catalogue
+        self._vessel = vessel
+        self._exporter = exporter
+        # summary gathered from each file by survey level checks, by
+        # (check id, file path)
+        self._survey_summaries = {}
+        self._survey_lock = threading.Lock()
+        # files found to hold the same data as another file, see
+        # `_find_duplicates`. The (original path, duplicate type) of each
+        # duplicate, by path.
+        self._duplicates = {}
+        self.duplicate_groups = []
 
     @property
     def output(self) -> dict:
@@ -52,6 +94,7 @@ class CheckRunner:
         of checks with files to a list of files with checks.
         """
         filechecks = {}
+        checkindex = {}
         for check in self._input:
             checkid = check.info.id
             checkversion = check.info.version
@@ -68,6 +111,11 @@ class CheckRunner:
                 filename = input.path
                 filetype = input.file_type
 
+                # There may be duplicate checks, each with different files.
+                # Outputs are attached to the first check that includes the
+                # file the output was generated for.
+                checkindex.setdefault((checkid, filename), check)
+
                 if (filename, filetype) in filechecks:
                     checklistforfile = filechecks[(filename, filetype)]
                     checklistforfile.append(check)
@@ -77,44 +125,101 @@ class CheckRunner:
                     filechecks[(filename, filetype)] = checklistforfile
 
         self._file_checks = filechecks
+        self._check_index = checkindex
 
     def _add_output(self, check_id, filename, output):
         """ Adds the output to the appropriate location in the _output.
         """
-        for check in self._output:
-            outputcheckid = check.info.id
-
-            # does this check match the check fro which the output was
-            # generated for
-            if check_id != outputcheckid:
-                continue
-
-            # does this check have the file specified that the output was
-            # generated for. There may be duplicate checks, each with different
-            # files, this makes sure we only attach the output to the right
-            # one.
-            inputs = check.inputs
-            has_file = False
-            for input in inputs.files:
-                if input.path == filename:
-                    has_file = True
-                    break
-
-            if not has_file:
-                continue
-
-            check.outputs = output
-            return
+        check = self._check_index.get((check_id, filename))
+        if check is None:
+            raise RuntimeError("Could not find check {} for file {}".format(
+                check_id, filename
+            ))
+        check.outputs = output
+
+    def _add_check_output(
+            self,
+            checkdata: QajsonCheck,
+            filename: str,
+            outputs: QajsonOutputs):
+        """ Adds the output of a check run on a single file. The output of a
+        survey level check only holds the summary of the file, which is kept
+        until the files are compared by `_run_survey_checks`.
+        """
+        if is_survey_check(checkdata.info.id, checkdata.info.version):
+            summary = None
+            if isinstance(outputs.data, dict):
+                summary = outputs.data.get('summary')
+            with self._survey_lock:
+                self._survey_summaries[(checkdata.info.id, filename)] = \
+                    summary
+        self._add_output(checkdata.info.id, filename, outputs)
+
+    def _run_survey_checks(self):
+        """ Runs the survey level checks once all files have been scanned,
+        comparing the summaries gathered from each file. All files given to
+        a check are compared, whichever check in the QA JSON they were given
+        to. The outputs replace the summaries.
+        """
+        groups = {}
+        for (check_id, filename), summary in self._survey_summaries.items():
+            checkdata = self._check_index[(check_id, filename)]
+            key = (check_id, checkdata.info.version)
+            groups.setdefault(key, {})[filename] = summary
+
+        for (check_id, check_version), summaries in groups.items():
+            # params are taken from the first check in the QA JSON
+            checkdata = self._check_index[(check_id, next(iter(summaries)))]
+            checkstart = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+            check = get_check_class(check_id, check_version)
+            try:
+                outputs = check.run_survey_check(
+                    summaries, checkdata.inputs.params or [])
+                checkstatus = "completed"
+                checkerrormessage = None
+            except Exception:
+                outputs = {filename: QajsonOutputs() for filename in summaries}
+                checkstatus = "failed"
+                checkerrormessage = traceback.format_exc()
+            checkend = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+            # a check in the QA JSON has a single output, so the outputs of
+            # all its files are merged
+            files_by_check = {}
+            for filename in summaries:
+                checkdata = self._check_index[(check_id, filename)]
+                _, filenames = files_by_check.setdefault(
+                    id(checkdata), (checkdata, []))
+                filenames.append(filename)
+            for checkdata, filenames in files_by_check.values():
+                checkoutputs = _merge_outputs(
+                    {filename: outputs[filename] for filename in filenames})
+                checkoutputs.execution = QajsonExecution(
+                    start=checkstart,
+                    end=checkend,
+                    status=checkstatus,
+                    error=checkerrormessage
+                )
+                checkdata.outputs = checkoutputs
 
-        raise RuntimeError("Could not find check {} for file {}".format(
-            check_id, filename
-        ))
+        if self._catalogue is not None:
+            checks_by_file = {}
+            for check_id, filename in self._survey_summaries:
+                checks_by_file.setdefault(filename, []).append(
+                    self._check_index[(check_id, filename)])
+            for filename, checks in checks_by_file.items():
+                self._catalogue.record_check_states(filename, checks)
 
     def run_checks(
             self,
             progress_callback: Callable = None,
             qajson_update_callback: Callable = None,
-            is_stopped: Callable = None):
+            is_stopped: Callable = None,
+            max_workers: int = None,
+            read_ahead: bool = False,
+            prefetch: bool = False,
+            sampled: bool = False,
+            skip_duplicates: bool = False):
         """ Excutes all checks on a file-by-file basis
 
         :param progress_callback Callable: function reference that is passed
@@ -124,79 +229,389 @@ class CheckRunner:
             to be called when the qajson related to this check has been
             updated by the check. Optional.
         :param is_stopped Callable: if this function returns True the check
-            runner will stop processing (eventually)
+            runner will stop processing. This is polled while each file is
+            being scanned, so stopping doesn't wait for a file to finish.
+        :param max_workers int: number of files to scan concurrently using a
+            thread pool. If not given files are scanned one after the other.
+            Callbacks may be called from worker threads, but never from more
+            than one at a time.
+        :param read_ahead bool: read each raw file in large blocks in a
+            background thread. Improves throughput when files are stored on a
+            network share.
+        :param prefetch bool: when scanning files one after the other, read
+            the next file into the file system cache while the current file
+            is being checked.
+        :param sampled bool: quick look mode, only parts of each raw file
+            are scanned and the results extrapolated (see
+            `Scan.scan_sampled`). Outputs are flagged as sampled, and are
+            not cached.
+        :param skip_duplicates bool: before any files are scanned, find the
+            raw files that are exact duplicates or truncated copies of
+            another file from their content fingerprints, and don't scan
+            them. Their checks are given a warning naming the original
+            file, and the groups are listed in `duplicate_groups`.
         """
         if self._file_checks is None:
             raise RuntimeError("CheckRunner is not initialized")
 
-        # to support accurate progress reporting get size of all files
-        total_file_size = 0
-        processed_files_size = 0
-        for (filename, filetype), checklist in self._file_checks.items():
-            if os.path.exists(filename):
-                total_file_size += os.path.getsize(filename)
+        try:
+            if skip_duplicates:
+                self._find_duplicates(is_stopped)
+
+            # to support accurate progress reporting get size of all files
+            file_sizes = {}
+            for (filename, filetype) in self._file_checks.keys():
+                file_sizes[(filename, filetype)] = stored_file_size(filename)
+            total_file_size = sum(file_sizes.values())
+
+            # number of bytes processed for each file, and the sum of these.
+            # Callbacks are serialised so that users of the check runner don't
+            # need to be thread safe.
+            callback_lock = threading.Lock()
+            processed_sizes = {}
+            processed = {'total': 0}
+
+            def file_progress(file_key, scan_progress):
+                with callback_lock:
+                    p = scan_progress * file_sizes[file_key]
+                    processed['total'] += p - processed_sizes.get(file_key, 0)
+                    processed_sizes[file_key] = p
+                    if progress_callback is not None and total_file_size != 0:
+                        progress_callback(processed['total'] / total_file_size)
+
+            def check_file(file_key, checklist):
+                if is_stopped is not None and is_stopped():
+                    return
+                completed = self._check_file(
+                    file_key[0],
+                    file_key[1],
+                    checklist,
+                    lambda p: file_progress(file_key, p),
+                    is_stopped,
+                    read_ahead,
+                    sampled
+                )
+                if not completed:
+                    return
+                file_progress(file_key, 1.0)
+                # qajson for all checks is updated on a file by file basis. So
+                # call the update after a file has finished processing, and
+                # not after each check.
+                if qajson_update_callback is not None:
+                    with callback_lock:
+                        qajson_update_callback()
+
+            if max_workers is None or max_workers <= 1:
+                file_checks = list(self._file_checks.items())
+                prefetchers = []
+                try:
+                    for i, (file_key, checklist) in enumerate(file_checks):
+                        if is_stopped is not None and is_stopped():
+                            return
+                        if prefetch and i + 1 < len(file_checks):
+                            next_filename = file_checks[i + 1][0][0]
+                            # archive members can't be prefetched on their own
+                            if split_archive_path(next_filename)[1] is None:
+                                prefetchers.append(
+                                    FilePrefetcher(next_filename))
+                        check_file(file_key, checklist)
+                        # the prefetch of this file is no longer needed
+                        if len(prefetchers) > 1:
+                            prefetchers.pop(0).cancel()
+                finally:
+                    for prefetcher in prefetchers:
+                        prefetcher.cancel()
+            else:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = [
+                        executor.submit(check_file, file_key, checklist)
+                        for file_key, checklist in self._file_checks.items()
+                    ]
+                    for future in futures:
+                        # re-raise any exception from the worker threads
+                        future.result()
 
-        for (filename, filetype), checklist in self._file_checks.items():
             if is_stopped is not None and is_stopped():
                 return
+            if len(self._survey_summaries) > 0:
+                self._run_survey_checks()
+                if qajson_update_callback is not None:
+                    qajson_update_callback()
+        finally:
+            # archives are only kept open while their members are checked
+            close_archives()
+
+    def _find_duplicates(self, is_stopped: Callable = None):
+        """ Fingerprints the content of each raw file, reading only the
+        datagram headers and a few datagrams, and records the files that
+        hold the same data as another file so they aren't scanned.
+        """
+        fingerprints = []
+        for (filename, filetype) in self._file_checks.keys():
+            if is_stopped is not None and is_stopped():
+                return
+            if filetype != 'Raw Files':
+                continue
+            scan = get_scan(filename, raw_file_extension(filename), filetype)
+            with scan:
+                try:
+                    fingerprints.append(content_fingerprint(scan))
+                except NotImplementedError:
+                    # format can't be indexed, so is always scanned
+                    continue
 
-            file_size = 0
-            if os.path.exists(filename):
-                file_size = os.path.getsize(filename)
-            file_size_fraction = 1
-            if total_file_size != 0:
-                file_size_fraction = file_size / total_file_size
-            _, extension = os.path.splitext(filename)
-            # remove the `.` char from extension
-            file_extension = extension[1:]
-
-            # read metadata from header
-            scan = get_scan(filename, file_extension, filetype)
-
-            def prog_cb(scan_progress):
-                p = scan_progress * file_size + processed_files_size
-                if progress_callback is not None:
-                    progress_callback(p / total_file_size)
-
-            scan.scan_datagram(prog_cb)
+        self._record_duplicates(find_duplicates(fingerprints))
 
-            processed_files_size += file_size
+    def _record_duplicates(self, groups: List[Dict]):
+        """ Records the groups of duplicate files found by
+        `duplicates.find_duplicates`, so the duplicates aren't scanned.
+        """
+        self.duplicate_groups = groups
+        self._duplicates = {}
+        for group in groups:
+            for duplicate in group['duplicates']:
+                logger.warning("{} is {} duplicate of {}, not scanned".format(
+                    duplicate['path'],
+                    'an exact' if duplicate['type'] == EXACT_DUPLICATE
+                    else 'a prefix',
+                    group['original']))
+                self._duplicates[duplicate['path']] = \
+                    (group['original'], duplicate['type'])
+
+    def _duplicate_outputs(
+            self,
+            original: str,
+            duplicate_type: str) -> QajsonOutputs:
+        """ Output given to the checks of a file that wasn't scanned as it
+        duplicates another file.
+        """
+        now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        if duplicate_type == EXACT_DUPLICATE:
+            message = "Not checked, exact duplicate of {}".format(original)
+        else:
+            message = "Not checked, truncated copy of {}".format(original)
+        return QajsonOutputs(
+            execution=QajsonExecution(
+                start=now,
+                end=now,
+                status="completed",
+                error=None
+            ),
+            files=None,
+            count=None,
+            percentage=None,
+            messages=[message],
+            data={'duplicateOf': original, 'duplicateType': duplicate_type},
+            check_state=ScanState.WARNING
+        )
+
+    def _check_file(
+            self,
+            filename: str,
+            filetype: str,
+            checklist: List[QajsonCheck],
+            progress_callback: Callable,
+            is_stopped: Callable,
+            read_ahead: bool = False,
+            sampled: bool = False) -> bool:
+        """ Scans a single file and runs all checks on it.
 
+        Returns:
+            True if the checks were run, or False if the scan was stopped.
+        """
+        if filename in self._duplicates:
+            # the data has already been checked in the original file. The
+            # summaries of survey level checks aren't added, so the
+            # duplicate isn't compared with the original.
+            checkoutputs = self._duplicate_outputs(
+                *self._duplicates[filename])
             for checkdata in checklist:
-                checkid = checkdata.info.id
-                checkversion = checkdata.info.version
-
-                checkparams = []
-                if checkdata.inputs.params is not None:
-                    checkparams = checkdata.inputs.params
-
-                checkoutputs = QajsonOutputs()
-                checkstatus = None
-                checkerrormessage = None
-                checkstart = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
-                # get check based on id and version
-                check = get_check(checkid, checkversion, scan, checkparams)
-                try:
-                    check.run_check()
-                    checkstatus = "completed"
-                    # merge two dicts; checkoutputs and check.output
-                    checkoutputs = check.output
-                except Exception as e:
-                    checkstatus = "failed"
-                    checkerrormessage = traceback.format_exc()
-                checkend = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
-
-                checkoutputs.execution = QajsonExecution(
-                    start=checkstart,
-                    end=checkend,
-                    status=checkstatus,
-                    error=checkerrormessage
+                self._add_output(
+                    checkdata.info.id, filename, copy.deepcopy(checkoutputs))
+            return True
+
+        # extension without the `.` char, looking through any compression
+        # suffix (eg; `all` for `.all.gz`)
+        file_extension = raw_file_extension(filename)
+
+        # checks that have already been run on this version of the file
+        # with the same params don't need to be run again
+        fingerprint = None
+        if self._cache is not None:
+            fingerprint = file_fingerprint(filename)
+        pending_checks = []
+        for checkdata in checklist:
+            cached_outputs = None
+            if self._cache is not None:
+                cached_outputs = self._cache.get(
+                    fingerprint,
+                    checkdata.info.id,
+                    checkdata.info.version,
+                    checkdata.inputs.params
                 )
+            if cached_outputs is None:
+                pending_checks.append(checkdata)
+            else:
+                self._add_check_output(checkdata, filename, cached_outputs)
+
+        if len(pending_checks) == 0 and \
+                not self._needs_recording(filename, fingerprint):
+            # nothing left to run, so no need to read the file at all
+            return True
+        # when every output is cached the file is only scanned to add it to
+        # the catalogue or export it, as the checks would need
+        scanned_checks = pending_checks if len(pending_checks) > 0 \
+            else checklist
+
+        # the scan (and all datagrams it has read) is released as soon
+        # as the checks for this file have been run
+        scan = get_scan(filename, file_extension, filetype, read_ahead)
+        with scan:
+            # read metadata from header
+            if all(is_metadata_check(c.info.id, c.info.version)
+                   for c in scanned_checks):
+                # only the metadata at the start of the file is needed, so
+                # the rest of it isn't read
+                scan.scan_metadata(progress_callback, is_stopped)
+            elif sampled:
+                scan.scan_sampled(progress_callback, is_stopped)
+            else:
+                scan.scan_datagram(progress_callback, is_stopped)
+            if is_stopped is not None and is_stopped():
+                # the scan will have been abandoned part way through the
+                # file, so don't run checks on the incomplete data
+                return False
+
+            for checkdata in pending_checks:
+                checkoutputs = self._run_check(checkdata, scan)
+                if scan.sampled:
+                    self._flag_sampled(checkoutputs)
+                elif (self._cache is not None and
+                        checkoutputs.execution.status == "completed"):
+                    self._cache.put(
+                        fingerprint,
+                        checkdata.info.id,
+                        checkdata.info.version,
+                        checkdata.inputs.params,
+                        checkoutputs
+                    )
+
+                self._add_check_output(checkdata, filename, checkoutputs)
+
+            if self._catalogue is not None:
+                # survey level checks only hold the summary of the file
+                # until they are run, see `_run_survey_checks`
+                self._catalogue.record(
+                    filename,
+                    scan,
+                    [self._check_index[(c.info.id, filename)]
+                        for c in checklist
+                        if not is_survey_check(c.info.id, c.info.version)],
+                    self._vessel)
+            if self._exporter is not None:
+                self._exporter.export(scan, self._vessel)
+        return True
+
+    def _needs_recording(self, filename: str, fingerprint: str) -> bool:
+        """ Indicates if a file has to be scanned, even though the outputs of
+        all its checks are cached, as this version of it hasn't been added to
+        the catalogue or exported.
+        """
+        if self._catalogue is not None and \
+                not self._catalogue.is_recorded(filename, fingerprint):
+            return True
+        if self._exporter is not None and not self._exporter.is_exported(
+                filename, self._vessel, fingerprint):
+            return True
+        return False
+
+    def _flag_sampled(self, checkoutputs: QajsonOutputs):
+        """ Marks check outputs generated from a sampled scan as
+        provisional, so they can be shown as such until a full scan has been
+        run.
+        """
+        data = checkoutputs.data
+        if not isinstance(data, dict):
+            data = {}
+        data['sampled'] = True
+        checkoutputs.data = data
+        messages = list(checkoutputs.messages or [])
+        messages.append(
+            "Provisional result from a sampled scan of the file")
+        checkoutputs.messages = messages
+
+    def _run_check(self, checkdata: QajsonCheck, scan) -> QajsonOutputs:
+        """ Runs a single check against a file that has already been scanned.
 
-                self._add_output(checkid, filename, checkoutputs)
-
-            # qajson for all checks is updated on a file by file basis. So
-            # call the update after a file has finished processing, and
-            # not after each check.
-            if qajson_update_callback is not None:
-                qajson_update_callback()
+        Returns:
+            The check outputs, including execution details.
+        """
+        checkid = checkdata.info.id
+        checkversion = checkdata.info.version
+
+        checkparams = []
+        if checkdata.inputs.params is not None:
+            checkparams = checkdata.inputs.params
+
+        checkoutputs = QajsonOutputs()
+        checkstatus = None
+        checkerrormessage = None
+        checkstart = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        # get check based on id and version
+        check = get_check(checkid, checkversion, scan, checkparams)
+        try:
+            check.run_check()
+            checkstatus = "completed"
+            # merge two dicts; checkoutputs and check.output
+            checkoutputs = check.output
+            if check.survey_level:
+                # the file is compared with the others once all have been
+                # scanned, see `_run_survey_checks`
+                checkoutputs = QajsonOutputs(data={'summary': check.summary})
+        except Exception:
+            checkstatus = "failed"
+            checkerrormessage = traceback.format_exc()
+        checkend = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+        checkoutputs.execution = QajsonExecution(
+            start=checkstart,
+            end=checkend,
+            status=checkstatus,
+            error=checkerrormessage
+        )
+        return checkoutputs
+
+
+# check states in order of severity, used when merging outputs
+_STATE_SEVERITY = {None: 0, 'pass': 1, 'warning': 2, 'fail': 3}
+
+
+def _severity(state) -> int:
+    # `ScanState` members don't hash as their string values
+    return _STATE_SEVERITY.get(getattr(state, 'value', state), 0)
+
+
+def _merge_outputs(outputs: Dict[str, QajsonOutputs]) -> QajsonOutputs:
+    """ Merges the outputs of a check for several files into one. The state
+    is the most severe of the files, messages are prefixed with the name of
+    the file they're for, and the data of each file is kept under `files`.
+    """
+    state = None
+    messages = []
+    data = {}
+    for filename, output in outputs.items():
+        if _severity(output.check_state) > _severity(state):
+            state = output.check_state
+        messages.extend(
+            "{}: {}".format(filename, message)
+            for message in output.messages or [])
+        data[filename] = output.data
+    return QajsonOutputs(
+        execution=None,
+        files=None,
+        count=None,
+        percentage=None,
+        messages=messages,
+        data={'files': data},
+        check_state=state
+    )
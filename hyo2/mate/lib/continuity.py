@@ -0,0 +1,125 @@
+from typing import Dict, List, Optional
+
+from hyo2.mate.lib.scan import ScanResult, ScanState
+
+# ping counters of .all and .kmall datagrams are uint16 values that wrap
+COUNTER_MODULUS = 65536
+
+DEFAULT_MAX_TIME_GAP = 60.0
+DEFAULT_MAX_PING_GAP = 0
+
+
+def _counter_step(previous: Dict, current: Dict) -> Optional[int]:
+    """ Gets the number of pings from the last ping of `previous` to the
+    first ping of `current`, or None if they can't be compared. Negative if
+    the counter went backwards.
+    """
+    if previous['pingType'] is None or \
+            previous['pingType'] != current['pingType'] or \
+            previous['lastCounter'] is None or \
+            current['firstCounter'] is None:
+        return None
+    step = (current['firstCounter'] - previous['lastCounter']) % \
+        COUNTER_MODULUS
+    if step >= COUNTER_MODULUS // 2:
+        step -= COUNTER_MODULUS
+    return step
+
+
+def _is_duplicate(previous: Dict, current: Dict) -> bool:
+    return all(
+        previous[key] == current[key]
+        for key in [
+            'pingType', 'firstCounter', 'lastCounter', 'startTime',
+            'stopTime'])
+
+
+def check_continuity(
+        bounds: Dict[str, Dict],
+        max_time_gap: float = DEFAULT_MAX_TIME_GAP,
+        max_ping_gap: int = DEFAULT_MAX_PING_GAP) -> Dict[str, ScanResult]:
+    """ Compares consecutive lines of a survey, flagging gaps and overlaps
+    between them, and files that duplicate another. The files are put in
+    order of their start time, and the last ping of each file compared with
+    the first ping of the next.
+
+    Args:
+        bounds (dict): `Scan.ping_bounds` of each file, by file path
+        max_time_gap (float): seconds allowed between the end of one file
+            and the start of the next before it is flagged as a gap
+        max_ping_gap (int): number of pings allowed to be missing between
+            the end of one file and the start of the next
+
+    Returns:
+        dict of the result for each file, by file path. Problems between
+        two files are reported against the later file.
+    """
+    results = {}
+    ordered = []
+    for path, bound in bounds.items():
+        if bound is None or bound['startTime'] is None:
+            results[path] = ScanResult(
+                state=ScanState.WARNING,
+                messages=(
+                    "Start time of file not found, its continuity with "
+                    "other lines could not be checked"),
+                data={})
+        else:
+            ordered.append(path)
+    ordered.sort(key=lambda p: (bounds[p]['startTime'], p))
+
+    previous_path = None
+    for path in ordered:
+        current = bounds[path]
+        messages: List[str] = []
+        state = ScanState.PASS
+        data = {
+            'previousFile': previous_path,
+            'timeGap': None,
+            'pingGap': None,
+        }
+        if previous_path is not None:
+            previous = bounds[previous_path]
+            step = _counter_step(previous, current)
+            if previous['stopTime'] is not None:
+                data['timeGap'] = current['startTime'] - previous['stopTime']
+            if step is not None:
+                data['pingGap'] = step - 1
+
+            if _is_duplicate(previous, current):
+                state = ScanState.FAIL
+                messages.append(
+                    "Duplicate of {}".format(previous_path))
+            elif data['timeGap'] is not None and data['timeGap'] < 0:
+                state = ScanState.FAIL
+                messages.append(
+                    "Overlaps {} by {:.1f} seconds".format(
+                        previous_path, -data['timeGap']))
+            elif step is not None and step <= 0 and (
+                    data['timeGap'] is None or
+                    data['timeGap'] <= max_time_gap):
+                state = ScanState.FAIL
+                messages.append(
+                    "Ping counter repeats or goes back {} pings from the "
+                    "end of {}".format(1 - step, previous_path))
+            else:
+                if data['timeGap'] is not None and \
+                        data['timeGap'] > max_time_gap:
+                    state = ScanState.WARNING
+                    messages.append(
+                        "{:.1f} second gap after {}".format(
+                            data['timeGap'], previous_path))
+                if step is not None and step <= 0:
+                    # a counter that goes back after a long gap is most
+                    # likely the sonar being restarted
+                    messages.append(
+                        "Ping counter was reset after {}".format(
+                            previous_path))
+                elif step is not None and step - 1 > max_ping_gap:
+                    state = ScanState.WARNING
+                    messages.append(
+                        "{} pings missing after {}".format(
+                            step - 1, previous_path))
+        results[path] = ScanResult(state=state, messages=messages, data=data)
+        previous_path = path
+    return results
@@ -0,0 +1,250 @@
+from typing import List, Optional, Tuple
+import os
+import struct
+
+import numpy as np
+
+ALL_STX = 0x02
+ALL_ETX = 0x03
+# number of bytes following the length field of the smallest possible .all
+# datagram; STX, type, model, date, time, counter, serial, ETX and checksum
+ALL_MIN_LENGTH = 19
+
+# the type of every .all datagram is an ASCII letter or digit
+ALL_TYPE_BYTES = np.zeros(256, dtype=bool)
+ALL_TYPE_BYTES[ord('0'):ord('9') + 1] = True
+ALL_TYPE_BYTES[ord('A'):ord('Z') + 1] = True
+ALL_TYPE_BYTES[ord('a'):ord('z') + 1] = True
+
+# files are searched in chunks of this many bytes, limiting the size of the
+# temporary arrays
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def map_file(path: str) -> np.ndarray:
+    '''
+    Memory maps a file as an array of bytes. Returns an empty array for an
+    empty file (which can't be mapped).
+    '''
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def read_uint32(buffer: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    '''
+    Reads the little endian uint32 at each of the positions in the buffer.
+    The positions don't need to be aligned.
+    '''
+    value = buffer[positions].astype(np.int64)
+    for i in range(1, 4):
+        value |= buffer[positions + i].astype(np.int64) << (8 * i)
+    return value
+
+
+def find_all_candidates(
+        buffer: np.ndarray,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds every position in a buffer that could be the start of a .all
+    datagram; the length field is followed by the STX and a valid datagram
+    type, and the ETX is found where the length says the datagram ends.
+
+    :param buffer: contents of a .all file as an array of bytes
+    :param chunk_size: number of bytes searched at a time
+    :return: tuple of arrays of the start and end (exclusive) offset of each
+        candidate datagram, sorted by start
+    '''
+    size = len(buffer)
+    # last position a datagram could start
+    last_start = size - ALL_MIN_LENGTH - 4
+    starts = []
+    ends = []
+    for chunk_start in range(0, max(0, last_start + 1), chunk_size):
+        chunk_end = min(chunk_start + chunk_size, last_start + 1)
+        stx = buffer[chunk_start + 4:chunk_end + 4] == ALL_STX
+        positions = np.flatnonzero(stx).astype(np.int64) + chunk_start
+        positions = positions[ALL_TYPE_BYTES[buffer[positions + 5]]]
+        lengths = read_uint32(buffer, positions)
+        datagram_ends = positions + 4 + lengths
+        in_file = (lengths >= ALL_MIN_LENGTH) & (datagram_ends <= size)
+        positions = positions[in_file]
+        datagram_ends = datagram_ends[in_file]
+        has_etx = buffer[datagram_ends - 3] == ALL_ETX
+        starts.append(positions[has_etx])
+        ends.append(datagram_ends[has_etx])
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def follow_all_datagrams(
+        buffer: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Follows the length fields of the datagrams from the start of a buffer
+    holding the contents of a .all file, stopping at the first invalid
+    datagram. Only the header and ETX of each datagram are read.
+
+    :param buffer: contents of a .all file as an array of bytes
+    :return: tuple of arrays of the start and end (exclusive) offset of
+        each datagram followed
+    '''
+    size = len(buffer)
+    data = memoryview(buffer)
+    type_bytes = ALL_TYPE_BYTES.tolist()
+    starts = []
+    ends = []
+    position = 0
+    while position + 4 + ALL_MIN_LENGTH <= size:
+        length, stx, dg_type = struct.unpack_from('<IBB', data, position)
+        end = position + 4 + length
+        if stx != ALL_STX or not type_bytes[dg_type] or \
+                length < ALL_MIN_LENGTH or end > size or \
+                data[end - 3] != ALL_ETX:
+            break
+        starts.append(position)
+        ends.append(end)
+        position = end
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+class AllDatagramIndex:
+    '''
+    Locations of the valid datagrams in a .all file, and of the corrupt
+    byte ranges between them.
+
+    Datagrams are followed from the start of the file using their length
+    fields. Where the next datagram isn't valid (eg; the file was partially
+    overwritten, or a logging crash left a truncated datagram) the index
+    resyncs to the next candidate datagram that is itself followed by a
+    candidate (or the end of the file). The search for candidates is
+    vectorised, so a multi-GB file can be indexed in seconds.
+
+    :param starts: offset of each valid datagram
+    :type starts: numpy.ndarray
+    :param ends: offset of the byte after each valid datagram
+    :type ends: numpy.ndarray
+    :param corrupt_ranges: (start, end) offsets of bytes that aren't part
+        of a valid datagram
+    :type corrupt_ranges: list
+    :param size: number of bytes indexed
+    :type size: int
+    '''
+
+    def __init__(
+            self,
+            starts: np.ndarray,
+            ends: np.ndarray,
+            corrupt_ranges: List[Tuple[int, int]],
+            size: int):
+        self.starts = starts
+        self.ends = ends
+        self.corrupt_ranges = corrupt_ranges
+        self.size = size
+
+    @classmethod
+    def from_buffer(
+            cls,
+            buffer: np.ndarray,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> 'AllDatagramIndex':
+        '''
+        Indexes the datagrams in a buffer holding the contents of a .all
+        file.
+        '''
+        size = len(buffer)
+        starts, ends = find_all_candidates(buffer, chunk_size)
+        count = len(starts)
+        if count == 0:
+            corrupt = [(0, size)] if size > 0 else []
+            return cls(starts, ends, corrupt, size)
+
+        # candidates that end where another candidate starts, or at the end
+        # of the file. Only these are trusted when resyncing.
+        following = np.minimum(np.searchsorted(starts, ends), count - 1)
+        chained = (starts[following] == ends) | (ends == size)
+        chained_indexes = np.flatnonzero(chained)
+        # the index of the last candidate in each run of candidates that
+        # immediately follow one another, so clean stretches of the file
+        # are accepted in one step
+        breaks = np.append(np.flatnonzero(ends[:-1] != starts[1:]), count - 1)
+        run_ends = breaks[np.searchsorted(breaks, np.arange(count))]
+
+        runs = []
+        corrupt = []
+        position = 0
+        while position < size:
+            i = np.searchsorted(starts, position)
+            if i < count and starts[i] == position:
+                last = run_ends[i]
+                runs.append(np.arange(i, last + 1))
+                position = int(ends[last])
+                continue
+            k = np.searchsorted(chained_indexes, i)
+            if k == len(chained_indexes):
+                corrupt.append((position, size))
+                break
+            next_start = int(starts[chained_indexes[k]])
+            corrupt.append((position, next_start))
+            position = next_start
+
+        if len(runs) == 0:
+            accepted = np.zeros(0, dtype=np.int64)
+        else:
+            accepted = np.concatenate(runs)
+        return cls(starts[accepted], ends[accepted], corrupt, size)
+
+    @classmethod
+    def from_file(
+            cls,
+            path: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> 'AllDatagramIndex':
+        '''
+        Indexes the datagrams in a .all file, which is memory mapped rather
+        than read into memory.
+        '''
+        return cls.from_buffer(map_file(path), chunk_size)
+
+    @classmethod
+    def from_lengths(
+            cls,
+            buffer: np.ndarray,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> 'AllDatagramIndex':
+        '''
+        Indexes the datagrams in a buffer by following their length fields
+        (see `follow_all_datagrams`), so only the headers of an intact file
+        are read. The search for candidates is only made over the bytes
+        from the first invalid datagram, giving the same index as
+        `from_buffer`.
+        '''
+        size = len(buffer)
+        starts, ends = follow_all_datagrams(buffer)
+        position = int(ends[-1]) if len(ends) > 0 else 0
+        if position == size:
+            return cls(starts, ends, [], size)
+        rest = cls.from_buffer(buffer[position:], chunk_size)
+        return cls(
+            np.concatenate([starts, rest.starts + position]),
+            np.concatenate([ends, rest.ends + position]),
+            [(start + position, end + position)
+             for start, end in rest.corrupt_ranges],
+            size)
+
+    def is_start(self, position: int) -> bool:
+        '''Indicates if a valid datagram starts at `position`'''
+        i = np.searchsorted(self.starts, position)
+        return i < len(self.starts) and self.starts[i] == position
+
+    def next_start(self, position: int) -> Optional[int]:
+        '''
+        Gets the offset of the first valid datagram that starts after
+        `position`, or None if there isn't one.
+        '''
+        i = np.searchsorted(self.starts, position, side='right')
+        if i == len(self.starts):
+            return None
+        return int(self.starts[i])
+
+    def corrupt_byte_count(self) -> int:
+        '''number of bytes that aren't part of a valid datagram'''
+        return sum(end - start for start, end in self.corrupt_ranges)
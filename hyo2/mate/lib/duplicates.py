@@ -0,0 +1,209 @@
+from typing import Dict, List
+import zlib
+
+import numpy as np
+
+from hyo2.mate.lib.raw_file import open_raw_file
+from hyo2.mate.lib.scan import Scan
+
+# datagram headers are hashed in blocks of this many datagrams. A file is
+# only taken to be a truncated copy of another if it has at least one
+# complete block.
+BLOCK_RECORDS = 256
+
+EXACT_DUPLICATE = 'exact'
+PREFIX_DUPLICATE = 'prefix'
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """ splitmix64 finaliser, a fast non-cryptographic mixing of uint64
+    values. Overflow wraps, as intended.
+    """
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def _record_hashes(table: Dict[str, np.ndarray]) -> np.ndarray:
+    """ Hashes the type, time, counter and size of each datagram along with
+    its position in the file, so the hashes of a block can be summed.
+    """
+    unique_types, type_ids = np.unique(
+        table['type'].astype(str), return_inverse=True)
+    type_codes = np.array(
+        [zlib.crc32(t.encode()) for t in unique_types], dtype=np.uint64)
+    times = np.nan_to_num(
+        np.asarray(table['time'], dtype=np.float64), nan=-1.0)
+    hashes = type_codes[type_ids.reshape(-1)]
+    for column in [
+            times.view(np.uint64),
+            table['counter'].astype(np.int64).view(np.uint64),
+            table['size'].astype(np.int64).view(np.uint64),
+            np.arange(len(times), dtype=np.uint64)]:
+        hashes = _mix(hashes ^ column)
+    return hashes
+
+
+def _sample_indexes(count: int) -> List[int]:
+    """ Indexes of the datagrams whose payloads are hashed; the first, those
+    at each power of two and the last. Every file samples the same indexes,
+    so the samples of a truncated copy are a subset of the original's.
+    """
+    if count == 0:
+        return []
+    indexes = {0, count - 1}
+    step = 1
+    while step - 1 < count:
+        indexes.add(step - 1)
+        step *= 2
+    return sorted(indexes)
+
+
+class ContentFingerprint:
+    """ Cheap fingerprint of the content of a raw file, used to find files
+    that hold the same data under a different name, or a truncated copy of
+    another file.
+
+    Built from the header of every datagram (type, time, counter and size),
+    hashed in blocks, and the hashes of the payloads of a small number of
+    datagrams. Unlike `check_cache.file_fingerprint` it doesn't depend on the
+    name or modification time of the file.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            count: int,
+            blocks: np.ndarray,
+            tail: int,
+            samples: Dict[int, int]):
+        """ `ContentFingerprint` constructor
+
+        Args:
+            path (str): path of the file
+            count (int): number of complete datagrams in the file
+            blocks (np.ndarray): digest of each complete block of
+                `BLOCK_RECORDS` datagram headers
+            tail (int): digest of the headers after the last complete block
+            samples (dict): CRC32 of the payload of the sampled datagrams,
+                by datagram index
+        """
+        self.path = path
+        self.count = count
+        self.blocks = blocks
+        self.tail = tail
+        self.samples = samples
+
+    @property
+    def key(self):
+        """ Files can only be duplicates if their keys match """
+        if len(self.blocks) > 0:
+            return int(self.blocks[0])
+        return ('tail', self.tail)
+
+    def is_duplicate_of(self, other: 'ContentFingerprint') -> bool:
+        """ Indicates if this file holds exactly the same datagrams as
+        `other`
+        """
+        return self.count == other.count and \
+            self.tail == other.tail and \
+            np.array_equal(self.blocks, other.blocks) and \
+            self.samples == other.samples
+
+    def is_prefix_of(self, other: 'ContentFingerprint') -> bool:
+        """ Indicates if this file holds the datagrams at the start of
+        `other`, as a copy made before `other` was finished or a truncated
+        copy of it would. Datagrams after the last complete block of this
+        file are only compared by their payload samples.
+        """
+        if self.count >= other.count or len(self.blocks) == 0:
+            return False
+        if not np.array_equal(
+                self.blocks, other.blocks[:len(self.blocks)]):
+            return False
+        return all(
+            other.samples[i] == crc
+            for i, crc in self.samples.items()
+            if i in other.samples)
+
+
+def content_fingerprint(scan: Scan) -> ContentFingerprint:
+    """ Fingerprints the content of the file of a scan. Only the datagram
+    headers (from the time index) and the payloads of about log2(n) of the
+    n datagrams are read. A datagram cut off by the end of the file isn't
+    included.
+
+    Args:
+        scan (Scan): scan of the file, which doesn't need to have been
+            scanned
+
+    Returns:
+        `ContentFingerprint` of the file
+
+    Raises:
+        NotImplementedError: if the format of the scan has no time index
+    """
+    table = scan.datagram_table()
+    with open_raw_file(scan.file_path) as raw_file:
+        if raw_file.size is not None:
+            complete = table['offset'] + table['size'] <= raw_file.size
+            table = {name: column[complete] for name, column in table.items()}
+        count = len(table['offset'])
+
+        samples = {}
+        stream = raw_file.stream
+        # in file order, so a compressed stream is only read forwards
+        for i in _sample_indexes(count):
+            stream.seek(int(table['offset'][i]))
+            samples[i] = zlib.crc32(stream.read(int(table['size'][i])))
+
+    hashes = _record_hashes(table)
+    block_count = count // BLOCK_RECORDS
+    blocks = np.add.reduceat(
+        hashes[:block_count * BLOCK_RECORDS],
+        np.arange(0, block_count * BLOCK_RECORDS, BLOCK_RECORDS)) \
+        if block_count > 0 else np.zeros(0, dtype=np.uint64)
+    tail = int(hashes[block_count * BLOCK_RECORDS:].sum(dtype=np.uint64))
+    return ContentFingerprint(scan.file_path, count, blocks, tail, samples)
+
+
+def find_duplicates(fingerprints: List[ContentFingerprint]) -> List[Dict]:
+    """ Groups the files that hold the same data. Each group has an
+    original, the longest of the files (or the first given of files of the
+    same length), and the files that are exact duplicates or truncated
+    copies (prefixes) of it.
+
+    Args:
+        fingerprints (list): fingerprint of each file
+
+    Returns:
+        list of dicts with the `original` path and the `duplicates`, a list
+        of dicts of the `path` and `type` (`exact` or `prefix`) of each
+        duplicate. Only groups with duplicates are included.
+    """
+    # longest first, so the original of each group is found before any
+    # truncated copies of it
+    ordered = sorted(
+        enumerate(fingerprints), key=lambda item: (-item[1].count, item[0]))
+    originals = {}
+    groups = {}
+    for _, fingerprint in ordered:
+        match = None
+        for original in originals.get(fingerprint.key, []):
+            if fingerprint.is_duplicate_of(original):
+                match = (original, EXACT_DUPLICATE)
+            elif fingerprint.is_prefix_of(original):
+                match = (original, PREFIX_DUPLICATE)
+            if match is not None:
+                break
+        if match is None:
+            originals.setdefault(fingerprint.key, []).append(fingerprint)
+            continue
+        original, duplicate_type = match
+        group = groups.setdefault(
+            original.path, {'original': original.path, 'duplicates': []})
+        group['duplicates'].append(
+            {'path': fingerprint.path, 'type': duplicate_type})
+    return list(groups.values())
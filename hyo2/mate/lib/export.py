@@ -0,0 +1,282 @@
+import glob
+import hashlib
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from hyo2.mate.lib.check_cache import file_fingerprint
+from hyo2.mate.lib.raw_file import raw_file_name
+from hyo2.mate.lib.scan import Scan
+
+logger = logging.getLogger(__name__)
+
+# names of the tables (top level directories) written by `ParquetExporter`
+DATAGRAMS_TABLE = 'datagrams'
+POSITIONS_TABLE = 'positions'
+ATTITUDE_TABLE = 'attitude'
+
+# directory under the root holding the fingerprint of each exported file.
+# Directories starting with `_` are ignored when reading the tables.
+EXPORTED_DIR = '_exported'
+
+DEFAULT_COMPRESSION = 'zstd'
+
+# partition value used when the vessel or day isn't known
+UNKNOWN = 'unknown'
+
+# columns each table is partitioned by, as `name=value` directories
+PARTITION_COLUMNS = ['survey', 'vessel', 'day']
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(
+            "Parquet export requires the pyarrow package, install it with "
+            "`pip install hyo2.mate[parquet]`")
+    return pyarrow
+
+
+def _partition_value(value: Optional[str]) -> str:
+    """ Makes a value safe to use as a directory name """
+    if value is None or str(value).strip() == '':
+        return UNKNOWN
+    return re.sub(r'[\\/:*?"<>|=]', '_', str(value).strip())
+
+
+def _file_key(path: str) -> str:
+    """ Gets the name the Parquet files of a raw file are written under;
+    the name of the raw file and a digest of its full path, so files of the
+    same name in different directories don't replace each other.
+    """
+    digest = hashlib.sha1(
+        os.path.abspath(path).encode('utf-8', 'surrogateescape')).hexdigest()
+    return '{}-{}'.format(_partition_value(raw_file_name(path)), digest[:12])
+
+
+def _days(times: np.ndarray) -> np.ndarray:
+    """ Gets the UTC day (YYYY-MM-DD) of each time. Rows without a time are
+    given the day of the previous row with one, so each datagram stays with
+    its neighbours.
+    """
+    days = np.full(len(times), UNKNOWN, dtype=object)
+    timed = np.flatnonzero(~np.isnan(times))
+    if len(timed) == 0:
+        return days
+    timed_days = (times[timed] // 86400).astype(np.int64) \
+        .astype('datetime64[D]').astype(str)
+    # index of the last timed row at or before each row, the first timed
+    # row for any before it
+    previous = np.maximum(
+        np.searchsorted(timed, np.arange(len(times)), side='right') - 1, 0)
+    return timed_days[previous].astype(object)
+
+
+class ParquetExporter:
+    """ Writes the datagram index and the position and attitude data of each
+    scanned file as Parquet, so they can be analysed with pandas, duckdb or
+    pyarrow rather than through QA JSON.
+
+    Each table is written to its own directory under `root`, partitioned by
+    survey, vessel and UTC day in hive style; eg;
+    `root/datagrams/survey=S1/vessel=Investigator/day=2020-01-07/
+    0001_20200107_line.all-<digest>.parquet`, where the digest is of the
+    full path of the file. The `file` column holds the path of the file.
+    Exporting a file again replaces all of its previous Parquet files in
+    the survey. Numeric columns don't have
+    nulls (missing times are NaN, missing counters -1) so they can be read
+    back into NumPy without copying.
+
+    Requires the optional `pyarrow` package.
+    """
+
+    def __init__(
+            self,
+            root: str,
+            survey: str,
+            compression: str = DEFAULT_COMPRESSION):
+        """ `ParquetExporter` constructor
+
+        Args:
+            root (str): directory the tables are written to
+            survey (str): name of the survey the files belong to
+            compression (str): Parquet compression codec
+        """
+        self._pa = _import_pyarrow()
+        self.root = root
+        self.survey = survey
+        self.compression = compression
+
+    def _write_table(
+            self,
+            table: str,
+            columns: Dict[str, np.ndarray],
+            path: str,
+            vessel: Optional[str]) -> List[str]:
+        pa = self._pa
+        days = _days(columns['time'])
+        paths = []
+        for day in np.unique(days):
+            rows = days == day
+            count = int(np.count_nonzero(rows))
+            arrays = {
+                # the file path is the same for every row, so is stored once
+                'file': pa.DictionaryArray.from_arrays(
+                    np.zeros(count, dtype=np.int32), [path])
+            }
+            for name, values in columns.items():
+                arrays[name] = pa.array(values[rows])
+            directory = os.path.join(
+                self.root, table,
+                'survey=' + _partition_value(self.survey),
+                'vessel=' + _partition_value(vessel),
+                'day=' + day)
+            os.makedirs(directory, exist_ok=True)
+            parquet_path = os.path.join(
+                directory, _file_key(path) + '.parquet')
+            pa.parquet.write_table(
+                pa.table(arrays), parquet_path, compression=self.compression)
+            paths.append(parquet_path)
+        return paths
+
+    def _remove_exported(self, path: str):
+        """ Removes the Parquet files of an earlier export of a file from
+        every table, vessel and day of the survey, so rows of days that are
+        no longer in the file don't remain.
+        """
+        pattern = os.path.join(
+            glob.escape(self.root), '*',
+            'survey=' + glob.escape(_partition_value(self.survey)),
+            'vessel=*', 'day=*', glob.escape(_file_key(path)) + '.parquet')
+        for parquet_path in glob.glob(pattern):
+            os.remove(parquet_path)
+
+    def _fingerprint_path(self, path: str, vessel: Optional[str]) -> str:
+        return os.path.join(
+            self.root, EXPORTED_DIR,
+            'survey=' + _partition_value(self.survey),
+            'vessel=' + _partition_value(vessel),
+            _file_key(path))
+
+    def is_exported(
+            self,
+            path: str,
+            vessel: str = None,
+            fingerprint: str = None) -> bool:
+        """ Indicates if this version of a file has already been exported
+
+        Args:
+            path (str): path of the file
+            vessel (str): name of the vessel that recorded the file
+            fingerprint (str): `file_fingerprint` of the file, found if not
+                given
+
+        Returns:
+            True if the file was exported with the same fingerprint
+        """
+        if fingerprint is None:
+            fingerprint = file_fingerprint(path)
+            if fingerprint is None:
+                return False
+        try:
+            with open(self._fingerprint_path(path, vessel)) as f:
+                return f.read() == fingerprint
+        except OSError:
+            return False
+
+    def export(self, scan: Scan, vessel: str = None) -> List[str]:
+        """ Writes the datagram index of a scanned file, and its position and
+        attitude data if the format supports it. Positions and attitude are
+        taken from the datagrams read by the scan, so are incomplete for
+        sampled and metadata scans.
+
+        Args:
+            scan (Scan): scan of the file, the scan must still be open
+            vessel (str): name of the vessel that recorded the file
+
+        Returns:
+            Paths of the Parquet files written
+        """
+        self._remove_exported(scan.file_path)
+        paths = self._write_table(
+            DATAGRAMS_TABLE, scan.datagram_table(), scan.file_path, vessel)
+        for table, get_columns in [
+                (POSITIONS_TABLE, scan.position_table),
+                (ATTITUDE_TABLE, scan.attitude_table)]:
+            try:
+                columns = get_columns()
+            except NotImplementedError:
+                continue
+            if len(columns['time']) > 0:
+                paths.extend(
+                    self._write_table(table, columns, scan.file_path, vessel))
+        fingerprint = file_fingerprint(scan.file_path)
+        if fingerprint is not None:
+            fingerprint_path = self._fingerprint_path(scan.file_path, vessel)
+            os.makedirs(os.path.dirname(fingerprint_path), exist_ok=True)
+            with open(fingerprint_path, 'w') as f:
+                f.write(fingerprint)
+        logger.debug("Exported {} to {}".format(scan.file_path, paths))
+        return paths
+
+
+def read_table(
+        root: str,
+        table: str,
+        survey: str = None,
+        vessel: str = None,
+        day: str = None) -> Dict[str, np.ndarray]:
+    """ Reads an exported table back as NumPy arrays. Numeric columns read
+    as a single chunk (eg; from one Parquet file) are given without copying
+    the data read, columns of several chunks are copied once as the chunks
+    are joined.
+
+    Args:
+        root (str): directory the tables were written to
+        table (str): name of the table, eg; `DATAGRAMS_TABLE`
+        survey (str): only read rows from this survey
+        vessel (str): only read rows from this vessel
+        day (str): only read rows from this UTC day (YYYY-MM-DD)
+
+    Returns:
+        dict of column name to array, including the partition columns
+    """
+    pa = _import_pyarrow()
+    dataset = pa.dataset.dataset(
+        os.path.join(root, table),
+        format='parquet',
+        partitioning=pa.dataset.partitioning(
+            pa.schema([(name, pa.string()) for name in PARTITION_COLUMNS]),
+            flavor='hive'))
+    condition = None
+    for name, value in zip(PARTITION_COLUMNS, [survey, vessel, day]):
+        if value is None:
+            continue
+        expression = pa.dataset.field(name) == _partition_value(value)
+        condition = expression if condition is None \
+            else condition & expression
+    data = dataset.to_table(filter=condition)
+    columns = {}
+    for name in data.column_names:
+        column = data.column(name)
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        # each chunk is converted on its own, numeric chunks without nulls
+        # share their buffer with numpy
+        chunks = [
+            chunk.to_numpy(zero_copy_only=False)
+            for chunk in column.chunks
+        ]
+        if len(chunks) == 1:
+            columns[name] = chunks[0]
+        elif len(chunks) == 0:
+            columns[name] = column.to_numpy()
+        else:
+            columns[name] = np.concatenate(chunks)
+    return columns
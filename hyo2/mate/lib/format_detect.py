@@ -0,0 +1,124 @@
+import os
+import struct
+import threading
+from typing import Dict, Optional, Tuple
+
+from hyo2.mate.lib.datagram_index import ALL_STX, ALL_ETX, ALL_MIN_LENGTH
+from hyo2.mate.lib.integrity import KMALL_MIN_LENGTH, MAX_DATAGRAM_SIZE
+from hyo2.mate.lib.raw_file import open_raw_file, split_archive_path
+
+# number of bytes read from the start of a file to detect its format
+SNIFF_SIZE = 4096
+
+# GSF record id of the header record, which holds the version string. The
+# top bit of the id flags a checksum following the record id.
+GSF_RECORD_HEADER = 1
+GSF_RECORD_ID_MASK = 0x003FFFFF
+GSF_CHECKSUM_FLAG = 0x80000000
+
+
+def _is_all(data: bytes) -> bool:
+    if len(data) < 6:
+        return False
+    length = struct.unpack_from('<I', data)[0]
+    dg_type = chr(data[5])
+    if data[4] != ALL_STX or not (dg_type.isascii() and dg_type.isalnum()):
+        return False
+    if length < ALL_MIN_LENGTH or length > MAX_DATAGRAM_SIZE:
+        return False
+    end = length + 4
+    # check the ETX if the whole datagram was read
+    return end > len(data) or data[end - 3] == ALL_ETX
+
+
+def _is_kmall(data: bytes) -> bool:
+    if len(data) < 8:
+        return False
+    length = struct.unpack_from('<I', data)[0]
+    # datagram types are `#` followed by three upper case letters
+    if data[4] != ord('#') or \
+            not all(ord('A') <= letter <= ord('Z') for letter in data[5:8]):
+        return False
+    if length < KMALL_MIN_LENGTH or length > MAX_DATAGRAM_SIZE:
+        return False
+    # the length is repeated at the end of the datagram
+    return length > len(data) or \
+        struct.unpack_from('<I', data, length - 4)[0] == length
+
+
+def _is_gsf(data: bytes) -> bool:
+    if len(data) < 13:
+        return False
+    record_id = struct.unpack_from('>I', data, 4)[0]
+    if record_id & GSF_RECORD_ID_MASK != GSF_RECORD_HEADER:
+        return False
+    version_offset = 12 if record_id & GSF_CHECKSUM_FLAG else 8
+    return data[version_offset:version_offset + 5] == b'GSF-v'
+
+
+def detect_format_from_bytes(data: bytes) -> Optional[str]:
+    """Detects the format of a raw file from the bytes at the start of it.
+
+    Args:
+        data (bytes): first few KB of the file
+
+    Returns:
+        Extension of the detected format (`all`, `kmall` or `gsf`), or None
+        if the format isn't recognised.
+    """
+    # .kmall is tested first, its `#` type marker is more specific than the
+    # STX and type byte of a .all datagram
+    if _is_kmall(data):
+        return 'kmall'
+    if _is_all(data):
+        return 'all'
+    if _is_gsf(data):
+        return 'gsf'
+    return None
+
+
+_formats: Dict[str, Tuple[Tuple[int, int], Optional[str]]] = {}
+_formats_lock = threading.Lock()
+
+
+def detect_format(path: str) -> Optional[str]:
+    """Detects the format of a raw file from its contents, rather than its
+    extension, so misnamed files are read with the correct reader. At most
+    `SNIFF_SIZE` bytes are read. Results are cached, and only detected
+    again if the file (or the archive containing it) changes.
+
+    Args:
+        path (str): path to the raw file, may be compressed or a member of
+            an archive
+
+    Returns:
+        Extension of the detected format (`all`, `kmall` or `gsf`), or None
+        if the format isn't recognised or the file can't be read.
+    """
+    key = os.path.abspath(path)
+    archive_path, _ = split_archive_path(path)
+    try:
+        stat = os.stat(archive_path)
+    except OSError:
+        return None
+    stat_key = (stat.st_size, stat.st_mtime_ns)
+    with _formats_lock:
+        cached = _formats.get(key)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    try:
+        with open_raw_file(path) as raw_file:
+            data = raw_file.stream.read(SNIFF_SIZE)
+    except (OSError, ValueError, EOFError, RuntimeError):
+        return None
+    detected = detect_format_from_bytes(data)
+    with _formats_lock:
+        _formats[key] = (stat_key, detected)
+    return detected
+
+
+def clear_format_cache():
+    """Forgets the formats detected by `detect_format`"""
+    with _formats_lock:
+        _formats.clear()
@@ -0,0 +1,344 @@
+from struct import unpack_from
+from typing import BinaryIO, Optional, Tuple
+
+import numpy as np
+
+from hyo2.mate.lib.datagram_index import ALL_STX, ALL_ETX, ALL_MIN_LENGTH, \
+    ALL_TYPE_BYTES, find_all_candidates, map_file, read_uint32
+
+# number of bytes verified at a time
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+# datagrams claiming to be larger than this are treated as corrupt
+MAX_DATAGRAM_SIZE = 64 * 1024 * 1024
+
+# smallest window searched when resyncing after a corrupt datagram
+MIN_RESYNC_WINDOW = 1024 * 1024
+
+# smallest .kmall datagram; length, type, version, system and echo sounder
+# id, time and the repeated length
+KMALL_MIN_LENGTH = 24
+
+# bad datagrams and corrupt ranges included in check outputs
+MAX_REPORTED = 100
+
+
+class IntegrityReport:
+    '''
+    Results of verifying the integrity of every datagram in a file.
+
+    :param datagram_count: number of datagrams found
+    :type datagram_count: int
+    :param bad_datagrams: (offset, reason) of each datagram that failed
+        verification. Reasons are `etx`, `checksum` (.all) or `length`
+        (.kmall, the repeated length at the end of the datagram differs)
+    :type bad_datagrams: list
+    :param corrupt_ranges: (start, end) offsets of bytes that couldn't be
+        read as datagrams
+    :type corrupt_ranges: list
+    :param size: number of bytes verified
+    :type size: int
+    '''
+
+    def __init__(self):
+        self.datagram_count = 0
+        self.bad_datagrams = []
+        self.corrupt_ranges = []
+        self.size = 0
+
+    @property
+    def is_valid(self) -> bool:
+        return len(self.bad_datagrams) == 0 and len(self.corrupt_ranges) == 0
+
+
+class _BufferSource:
+    '''
+    Provides windows onto the contents of a file, either from a memory map
+    or by reading a stream (eg; a compressed file) forward.
+    '''
+
+    def __init__(
+            self,
+            buffer: Optional[np.ndarray] = None,
+            stream: Optional[BinaryIO] = None):
+        self._buffer = buffer
+        self._stream = stream
+        self._data = b''
+        self._base = 0
+        self._eof = stream is None
+
+    def window(self, offset: int, size: int) -> np.ndarray:
+        '''gets up to `size` bytes starting at `offset`'''
+        if self._buffer is not None:
+            return self._buffer[offset:offset + size]
+        # data before the offset is no longer needed
+        self._data = self._data[offset - self._base:]
+        self._base = offset
+        while len(self._data) < size and not self._eof:
+            data = self._stream.read(size - len(self._data))
+            if len(data) == 0:
+                self._eof = True
+            self._data += data
+        return np.frombuffer(self._data[:size], dtype=np.uint8)
+
+    def end(self) -> int:
+        '''offset of the end of the file, once it has been reached'''
+        if self._buffer is not None:
+            return len(self._buffer)
+        return self._base + len(self._data)
+
+    def at_end(self, offset: int) -> bool:
+        '''indicates if `offset` is at (or past) the end of the file'''
+        if self._buffer is not None:
+            return offset >= len(self._buffer)
+        return self._eof and offset >= self._base + len(self._data)
+
+
+class _AllFormat:
+    '''verification of Kongsberg .all datagrams'''
+
+    min_size = ALL_MIN_LENGTH + 4
+    # byte following the length field of every datagram
+    marker = ALL_STX
+
+    @staticmethod
+    def datagram_size(length_field: int) -> int:
+        # the length doesn't include the length field itself
+        return length_field + 4
+
+    @staticmethod
+    def valid_headers(buffer, offsets):
+        return (buffer[offsets + 4] == ALL_STX) & \
+            ALL_TYPE_BYTES[buffer[offsets + 5]]
+
+    @staticmethod
+    def verify(buffer, offsets, ends):
+        etx_ok = buffer[ends - 3] == ALL_ETX
+        # checksum is the sum of the bytes between the STX and the ETX
+        bounds = np.empty(len(offsets) * 2, dtype=np.int64)
+        bounds[0::2] = offsets + 5
+        bounds[1::2] = ends - 3
+        sums = np.add.reduceat(buffer, bounds, dtype=np.uint64)[0::2]
+        checksums = buffer[ends - 2].astype(np.uint64) | \
+            (buffer[ends - 1].astype(np.uint64) << 8)
+        checksum_ok = (sums & 0xFFFF) == checksums
+        return [('etx', ~etx_ok), ('checksum', etx_ok & ~checksum_ok)]
+
+    @staticmethod
+    def candidates(buffer):
+        return find_all_candidates(buffer)
+
+
+class _KmallFormat:
+    '''verification of Kongsberg .kmall datagrams'''
+
+    min_size = KMALL_MIN_LENGTH
+    marker = ord('#')
+
+    @staticmethod
+    def datagram_size(length_field: int) -> int:
+        return length_field
+
+    @staticmethod
+    def valid_headers(buffer, offsets):
+        # datagram types are `#` followed by three upper case letters
+        valid = buffer[offsets + 4] == ord('#')
+        for i in range(5, 8):
+            letter = buffer[offsets + i]
+            valid &= (letter >= ord('A')) & (letter <= ord('Z'))
+        return valid
+
+    @staticmethod
+    def verify(buffer, offsets, ends):
+        # the length is repeated in the last four bytes of the datagram
+        length_ok = read_uint32(buffer, ends - 4) == ends - offsets
+        return [('length', ~length_ok)]
+
+    @staticmethod
+    def candidates(buffer):
+        return find_kmall_candidates(buffer)
+
+
+def find_kmall_candidates(
+        buffer: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds every position in a buffer that could be the start of a .kmall
+    datagram; a valid datagram type, and the length is repeated where the
+    length says the datagram ends.
+
+    :return: tuple of arrays of the start and end (exclusive) offset of each
+        candidate datagram, sorted by start
+    '''
+    size = len(buffer)
+    positions = np.flatnonzero(
+        buffer[4:max(4, size - KMALL_MIN_LENGTH + 5)] == ord('#'))
+    positions = positions.astype(np.int64)
+    positions = positions[_KmallFormat.valid_headers(buffer, positions)]
+    lengths = read_uint32(buffer, positions)
+    ends = positions + lengths
+    in_buffer = (lengths >= KMALL_MIN_LENGTH) & (ends <= size)
+    positions = positions[in_buffer]
+    ends = ends[in_buffer]
+    repeated = read_uint32(buffer, ends - 4) == ends - positions
+    return positions[repeated], ends[repeated]
+
+
+def _find_headers(buffer: np.ndarray, fmt) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds every position in a buffer that has a valid datagram header and
+    length. Unlike the candidates used to resync, the datagrams aren't
+    verified and may run past the end of the buffer.
+
+    :return: tuple of arrays of the start and end (exclusive) offset of each
+        datagram, sorted by start
+    '''
+    size = len(buffer)
+    # the type follows the marker, so the marker must be at least four
+    # bytes before the end of the buffer
+    positions = np.flatnonzero(
+        buffer[4:max(4, size - 3)] == fmt.marker).astype(np.int64)
+    positions = positions[fmt.valid_headers(buffer, positions)]
+    sizes = fmt.datagram_size(read_uint32(buffer, positions))
+    valid = (sizes >= fmt.min_size) & (sizes <= MAX_DATAGRAM_SIZE)
+    return positions[valid], positions[valid] + sizes[valid]
+
+
+def _walk(buffer: np.ndarray, fmt) -> Tuple[np.ndarray, np.ndarray, bool]:
+    '''
+    Follows the datagram lengths from the start of the buffer. The
+    datagrams are chained from the vectorised search for headers, so each
+    run of datagrams that follow one another is taken in one step.
+
+    :return: tuple of the offsets and ends of the datagrams found, and True
+        if the walk stopped at a datagram with an invalid header or length
+        (rather than one that runs past the end of the buffer)
+    '''
+    size = len(buffer)
+    starts, ends = _find_headers(buffer, fmt)
+    count = len(starts)
+    runs = []
+    position = 0
+    if count > 0:
+        # index of the last header in each run of headers that
+        # immediately follow one another
+        breaks = np.append(np.flatnonzero(ends[:-1] != starts[1:]), count - 1)
+        while True:
+            i = int(np.searchsorted(starts, position))
+            if i == count or starts[i] != position:
+                break
+            last = int(breaks[np.searchsorted(breaks, i)])
+            runs.append(np.arange(i, last + 1))
+            position = int(ends[last])
+    accepted = np.concatenate(runs) if len(runs) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    if len(accepted) > 0 and ends[accepted[-1]] > size:
+        # the last datagram runs past the end of the buffer
+        position = int(starts[accepted[-1]])
+        accepted = accepted[:-1]
+
+    invalid = False
+    if position + 4 <= size:
+        datagram_size = fmt.datagram_size(
+            unpack_from('<I', buffer, position)[0])
+        invalid = datagram_size < fmt.min_size or \
+            datagram_size > MAX_DATAGRAM_SIZE or \
+            position + datagram_size <= size
+    return starts[accepted], ends[accepted], invalid
+
+
+def _resync(source: _BufferSource, position: int, fmt, chunk_size: int):
+    '''
+    Finds the first datagram after `position` that is followed by another
+    datagram (or the end of the file). Returns None if there isn't one.
+    '''
+    search_from = position + 1
+    # the window must be large enough to hold a pair of datagrams
+    window_size = max(chunk_size, MIN_RESYNC_WINDOW)
+    while True:
+        buffer = source.window(search_from, window_size)
+        starts, ends = fmt.candidates(buffer)
+        if len(starts) > 0:
+            following = np.minimum(
+                np.searchsorted(starts, ends), len(starts) - 1)
+            chained = starts[following] == ends
+            if source.at_end(search_from + len(buffer)):
+                chained |= ends == len(buffer)
+            chained_indexes = np.flatnonzero(chained)
+            if len(chained_indexes) > 0:
+                return search_from + int(starts[chained_indexes[0]])
+        if source.at_end(search_from + len(buffer)):
+            return None
+        # overlap windows so datagrams spanning the end of this window
+        # are found in the next one
+        search_from += max(1, len(buffer) // 2)
+
+
+def _verify(
+        source: _BufferSource,
+        fmt,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> IntegrityReport:
+    report = IntegrityReport()
+    position = 0
+    window_size = chunk_size
+    while not source.at_end(position):
+        buffer = source.window(position, window_size)
+        offsets, ends, invalid = _walk(buffer, fmt)
+        if len(offsets) > 0:
+            report.datagram_count += len(offsets)
+            for reason, bad in fmt.verify(buffer, offsets, ends):
+                report.bad_datagrams.extend(
+                    (position + int(offset), reason)
+                    for offset in offsets[bad]
+                )
+            position += int(ends[-1])
+            window_size = chunk_size
+            if not invalid:
+                continue
+        elif not invalid and not source.at_end(position + len(buffer)):
+            # a single datagram larger than the window
+            window_size *= 2
+            continue
+
+        # the datagram at `position` is invalid, or truncated by the end
+        # of the file
+        if source.at_end(position):
+            break
+        next_start = _resync(source, position, fmt, chunk_size)
+        if next_start is None:
+            report.corrupt_ranges.append((position, source.end()))
+            position = source.end()
+            break
+        report.corrupt_ranges.append((position, next_start))
+        position = next_start
+    report.bad_datagrams.sort()
+    report.size = position
+    return report
+
+
+def _source(path: Optional[str], stream: Optional[BinaryIO]) -> _BufferSource:
+    if path is not None:
+        return _BufferSource(buffer=map_file(path))
+    return _BufferSource(stream=stream)
+
+
+def verify_all(
+        path: Optional[str] = None,
+        stream: Optional[BinaryIO] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> IntegrityReport:
+    '''
+    Verifies the ETX and checksum of every datagram in a .all file. Either
+    the path of an (uncompressed) file that will be memory mapped, or a
+    stream to read from must be given.
+    '''
+    return _verify(_source(path, stream), _AllFormat, chunk_size)
+
+
+def verify_kmall(
+        path: Optional[str] = None,
+        stream: Optional[BinaryIO] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> IntegrityReport:
+    '''
+    Verifies the repeated length field at the end of every datagram in a
+    .kmall file. Either the path of an (uncompressed) file that will be
+    memory mapped, or a stream to read from must be given.
+    '''
+    return _verify(_source(path, stream), _KmallFormat, chunk_size)
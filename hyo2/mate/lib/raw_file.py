@@ -0,0 +1,570 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import threading
+import zipfile
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from hyo2.mate.lib.readahead import ReadAheadFile, open_read_ahead
+
+# compression formats that are decompressed as raw files are read, keyed on
+# the file suffix
+COMPRESSION_SUFFIXES = {
+    '.gz': 'gzip',
+    '.bz2': 'bzip2',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+    '.zst': 'zstd',
+}
+
+# decompressed data is read in smaller blocks than files on disk, it is only
+# read ahead to overlap decompression with decoding of the datagrams
+DECOMPRESSED_BLOCK_SIZE = 1024 * 1024
+
+# separates the path of an archive from the name of a member within it, eg;
+# `survey.zip!/line_0001.all`
+ARCHIVE_SEPARATOR = '!/'
+
+
+def split_compression_suffix(path: str) -> Tuple[str, Optional[str]]:
+    """ Splits the compression suffix (if any) from a file path.
+
+    Args:
+        path (str): path to a file, eg; `0001_line.all.gz`
+
+    Returns:
+        Tuple of the path without the compression suffix and the name of the
+        compression format, eg; (`0001_line.all`, `gzip`). The compression is
+        None if the file is not compressed.
+    """
+    root, suffix = os.path.splitext(path)
+    compression = COMPRESSION_SUFFIXES.get(suffix.lower())
+    if compression is None:
+        return path, None
+    return root, compression
+
+
+def split_archive_path(path: str) -> Tuple[str, Optional[str]]:
+    """ Splits a path to a member of a zip or tar archive into the path of
+    the archive and the name of the member.
+
+    Args:
+        path (str): path to a file, eg; `survey.zip!/line_0001.all`
+
+    Returns:
+        Tuple of the archive path and member name, eg; (`survey.zip`,
+        `line_0001.all`). The member name is None if the path is not to an
+        archive member.
+    """
+    index = path.find(ARCHIVE_SEPARATOR)
+    if index == -1:
+        return path, None
+    return path[:index], path[index + len(ARCHIVE_SEPARATOR):]
+
+
+def raw_file_extension(path: str) -> str:
+    """ Gets the extension of the raw data file, looking through any
+    compression suffix. eg; `all` for both `line.all` and `line.all.gz`.
+    The `.` is not included.
+    """
+    data_path, _ = split_compression_suffix(path)
+    _, extension = os.path.splitext(data_path)
+    return extension[1:]
+
+
+def raw_file_name(path: str) -> str:
+    """ Gets the name of the raw data file as it was originally recorded,
+    without any compression suffix.
+    """
+    data_path, _ = split_compression_suffix(path)
+    return os.path.basename(data_path)
+
+
+def _open_zstd(fileobj: BinaryIO) -> BinaryIO:
+    try:
+        # standard library from Python 3.14
+        from compression import zstd
+        return zstd.ZstdFile(fileobj)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "Reading .zst files requires Python 3.14 or the zstandard "
+            "package")
+    return _RewindableStream(
+        lambda: zstandard.ZstdDecompressor().stream_reader(
+            fileobj, closefd=False),
+        fileobj
+    )
+
+
+class _RewindableStream(io.RawIOBase):
+    """ Adapts a forward only decompression stream to support seeking
+    backwards, by starting decompression again from the beginning. The
+    read ahead layer above this retains recently read data, so this only
+    happens when a reader jumps back a long way.
+    """
+
+    def __init__(self, open_stream, fileobj: BinaryIO):
+        super().__init__()
+        self._open_stream = open_stream
+        self._fileobj = fileobj
+        self._stream = open_stream()
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation(
+                "Can only seek relative to the start of a compressed file")
+        if offset < self._position:
+            self._stream.close()
+            self._fileobj.seek(0)
+            self._stream = self._open_stream()
+            self._position = 0
+        while self._position < offset:
+            data = self._stream.read(
+                min(offset - self._position, DECOMPRESSED_BLOCK_SIZE))
+            if len(data) == 0:
+                break
+            self._position += len(data)
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super().close()
+
+
+class _MemberFile(io.RawIOBase):
+    """ Read only view of the bytes of a single archive member, stored
+    uncompressed at a known offset within the archive.
+    """
+
+    def __init__(self, fileobj: BinaryIO, offset: int, size: int):
+        super().__init__()
+        self._fileobj = fileobj
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence {}".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = max(0, self._size - self._position)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size == 0:
+            return b''
+        self._fileobj.seek(self._offset + self._position)
+        data = self._fileobj.read(size)
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.close()
+        super().close()
+
+
+# compression used by a tar archive, based on the file object tarfile
+# decompresses it with
+_TAR_COMPRESSION = {
+    gzip.GzipFile: 'gzip',
+    bz2.BZ2File: 'bzip2',
+    lzma.LZMAFile: 'xz',
+}
+
+
+class Archive:
+    """ Index of the members of a zip or tar archive. The archive's member
+    list (the central directory of a zip file, or the member headers of a
+    tar file) is read once and shared by all members opened from it.
+
+    Members are streamed from the archive without being extracted. Use
+    `get_archive` rather than creating instances directly, so the index is
+    shared.
+    """
+
+    # number of `RawFile`s reading members of the archive, guarded by
+    # `_archives_lock`. An archive isn't closed while it's in use.
+    users = 0
+
+    def __init__(self, path: str):
+        """ `Archive` constructor
+
+        Args:
+            path (str): path to a zip or tar file. Tar files may be
+                compressed.
+
+        Raises:
+            ValueError: if the file is not a zip or tar archive
+        """
+        self.path = path
+        stat = os.stat(path)
+        self.stat_key = (stat.st_size, stat.st_mtime_ns)
+        self._zip = None
+        self._tar_members = None
+        self._tar_compression = None
+        if zipfile.is_zipfile(path):
+            # zip members share the archive's file handle, ZipFile
+            # serialises access to it
+            self._zip = zipfile.ZipFile(path)
+            self._zip_members = {
+                info.filename: info
+                for info in self._zip.infolist()
+                if not info.is_dir()
+            }
+            return
+        try:
+            with tarfile.open(path) as tar:
+                self._tar_compression = _TAR_COMPRESSION.get(
+                    type(tar.fileobj))
+                self._tar_members = {
+                    member.name: (member.offset_data, member.size)
+                    for member in tar
+                    if member.isfile()
+                }
+        except tarfile.TarError:
+            raise ValueError(
+                "{} is not a zip or tar archive".format(path))
+
+    def member_names(self) -> List[str]:
+        """ Names of all files in the archive """
+        if self._zip is not None:
+            return list(self._zip_members.keys())
+        return list(self._tar_members.keys())
+
+    def _check_member(self, name: str):
+        members = self._zip_members if self._zip is not None \
+            else self._tar_members
+        if name not in members:
+            raise FileNotFoundError(
+                "{} not found in archive {}".format(name, self.path))
+        return members[name]
+
+    def member_size(self, name: str) -> int:
+        """ Number of bytes in the (uncompressed) member """
+        member = self._check_member(name)
+        if self._zip is not None:
+            return member.file_size
+        return member[1]
+
+    def open_member(self, name: str, read_ahead: bool = False) -> BinaryIO:
+        """ Opens a member of the archive for reading.
+
+        Args:
+            name (str): name of the member
+            read_ahead (bool): read the archive in large blocks in a
+                background thread
+
+        Returns:
+            Seekable binary file object
+        """
+        member = self._check_member(name)
+        if self._zip is not None:
+            # seeking backwards in a compressed zip member restarts
+            # decompression, the retained blocks avoid this for the small
+            # backward seeks the format readers make
+            return ReadAheadFile(
+                self._zip.open(member),
+                size=member.file_size,
+                block_size=DECOMPRESSED_BLOCK_SIZE
+            )
+
+        offset, size = member
+        if read_ahead:
+            archive = open_read_ahead(self.path)
+        else:
+            archive = open(self.path, 'rb')
+        if self._tar_compression is not None:
+            archive = ReadAheadFile(
+                _open_decompressor(self._tar_compression, archive),
+                block_size=DECOMPRESSED_BLOCK_SIZE,
+                find_size=False
+            )
+        return _MemberFile(archive, offset, size)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+
+# archives read by `get_archive`, by absolute path
+_archives: Dict[str, Archive] = {}
+_archives_lock = threading.Lock()
+
+
+def get_archive(path: str, use: bool = False) -> Archive:
+    """ Gets the index of an archive, reading it only if it hasn't been
+    read before or the archive has changed since.
+
+    Args:
+        path (str): path to a zip or tar file
+        use (bool): the archive is used to read members, and isn't closed
+            until `release_archive` is called
+
+    Returns:
+        Shared `Archive` instance
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(path)
+    replaced = None
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive is None or \
+                archive.stat_key != (stat.st_size, stat.st_mtime_ns):
+            if archive is not None and archive.users == 0:
+                replaced = archive
+            # an archive that is still in use is closed when released
+            archive = Archive(path)
+            _archives[key] = archive
+        if use:
+            archive.users += 1
+    if replaced is not None:
+        replaced.close()
+    return archive
+
+
+def release_archive(archive: Archive):
+    """ Releases an archive got with `get_archive(path, use=True)`. The
+    archive is closed if it's no longer shared and nothing else is using it.
+    """
+    with _archives_lock:
+        archive.users -= 1
+        close = archive.users == 0 and \
+            _archives.get(os.path.abspath(archive.path)) is not archive
+    if close:
+        archive.close()
+
+
+def close_archives():
+    """ Closes all archives opened by `get_archive`. Archives still in use
+    are closed once they are released.
+    """
+    with _archives_lock:
+        archives = [a for a in _archives.values() if a.users == 0]
+        _archives.clear()
+    for archive in archives:
+        archive.close()
+
+
+def stored_file_size(path: str) -> int:
+    """ Gets the number of bytes of a raw file as stored on disk, or within
+    an archive. Returns 0 if the file does not exist.
+    """
+    archive_path, member = split_archive_path(path)
+    try:
+        if member is None:
+            return os.path.getsize(path)
+        return get_archive(archive_path).member_size(member)
+    except (OSError, ValueError):
+        return 0
+
+
+def _open_decompressor(compression: str, fileobj: BinaryIO) -> BinaryIO:
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif compression == 'bzip2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    elif compression == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+    elif compression == 'zstd':
+        return _open_zstd(fileobj)
+    raise NotImplementedError(
+        "Compression {} is not supported".format(compression))
+
+
+class RawFile:
+    """ A raw data file opened for reading by one of the format readers.
+
+    The file may be a member of a zip or tar archive, given as
+    `survey.zip!/line_0001.all`. Files compressed with gzip, bzip2, xz or
+    zstandard are decompressed as they are read, so they can be scanned
+    without first being decompressed to disk. The size of the decompressed
+    data isn't known until the end of it has been reached, so `at_end`
+    should be used to find the end of the data rather than comparing a
+    position against a file size. `position` is given in bytes of the stored
+    (compressed) file so it can be used for progress reporting.
+    """
+
+    def __init__(self, path: str, read_ahead: bool = False):
+        """ `RawFile` constructor
+
+        Args:
+            path (str): path to the raw file, may include a compression
+                suffix or be a member of an archive
+            read_ahead (bool): read the stored file in large blocks in a
+                background thread
+        """
+        self.path = path
+        self.read_ahead = read_ahead
+        self.archive_path, self.member = split_archive_path(path)
+        _, self.compression = split_compression_suffix(path)
+        self._archive = None
+        if self.member is None:
+            self.stored_size = os.path.getsize(path)
+            if read_ahead:
+                self._stored = open_read_ahead(path)
+            else:
+                self._stored = open(path, 'rb')
+        else:
+            self._archive = get_archive(self.archive_path, use=True)
+            try:
+                self.stored_size = self._archive.member_size(self.member)
+                self._stored = self._archive.open_member(
+                    self.member, read_ahead)
+            except Exception:
+                release_archive(self._archive)
+                raise
+
+        if self.compression is None:
+            self.stream = self._stored
+            self._size = self.stored_size
+        else:
+            # the format readers make small backward seeks, these are served
+            # from the blocks retained by the read ahead layer rather than
+            # restarting decompression
+            self.stream = ReadAheadFile(
+                _open_decompressor(self.compression, self._stored),
+                block_size=DECOMPRESSED_BLOCK_SIZE,
+                find_size=False
+            )
+            self._size = None
+
+    @property
+    def is_compressed(self) -> bool:
+        return self.compression is not None
+
+    @property
+    def disk_path(self) -> str:
+        """ Path of the file on disk holding the data, this is the archive
+        for archive members.
+        """
+        return self.archive_path
+
+    @property
+    def is_plain_file(self) -> bool:
+        """ Indicates if the data can be read directly from `path` without
+        decompression or extraction from an archive.
+        """
+        return self.member is None and self.compression is None
+
+    @property
+    def size(self) -> Optional[int]:
+        """ Number of bytes of (decompressed) data. None if the file is
+        compressed and the end of the data hasn't yet been reached.
+        """
+        if self._size is None:
+            self._size = self.stream.size
+        return self._size
+
+    def refresh_size(self) -> int:
+        """ Finds the size of a file that may still be being written to,
+        eg; by the acquisition software, so data appended since the file
+        was opened can be read.
+
+        Returns:
+            Number of bytes in the file
+
+        Raises:
+            ValueError: if the file is compressed, an archive member or is
+                read ahead, the size of these is fixed when they're opened
+        """
+        if not self.is_plain_file or self.read_ahead:
+            raise ValueError(
+                "Size of {} can't be refreshed, only uncompressed files read "
+                "without read ahead can be followed".format(self.path))
+        self.stored_size = os.path.getsize(self.path)
+        self._size = self.stored_size
+        return self._size
+
+    def position(self) -> int:
+        """ Number of bytes of the stored file that have been read """
+        return self._stored.tell()
+
+    def at_end(self) -> bool:
+        """ Indicates if the format reader has reached the end of the data
+        """
+        size = self.size
+        if size is not None:
+            return self.stream.tell() >= size
+        return len(self.stream.peek(1)) == 0
+
+    def close(self):
+        self.stream.close()
+        self._stored.close()
+        if self._archive is not None:
+            release_archive(self._archive)
+            self._archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_raw_file(path: str, read_ahead: bool = False) -> RawFile:
+    """ Opens a raw data file, decompressing it or streaming it from an
+    archive if needed.
+
+    Args:
+        path (str): path to the raw file, may include a compression suffix
+            or be a member of an archive (eg; `survey.zip!/line_0001.all`)
+        read_ahead (bool): read the stored file in large blocks in a
+            background thread
+
+    Returns:
+        New `RawFile`
+    """
+    return RawFile(path, read_ahead)
@@ -0,0 +1,284 @@
+import io
+import os
+import queue
+import sys
+import threading
+from typing import BinaryIO, Optional
+
+# size of each block read from the underlying file
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+# number of blocks that may be read ahead of the consumer
+DEFAULT_DEPTH = 4
+
+
+class ReadAheadFile(io.RawIOBase):
+    """ Binary file object that reads large sequential blocks from an
+    underlying file in a background thread. The format readers (pyall, pygsf,
+    kmall) issue many small reads and seeks; when the raw data is on a
+    network share each of these can cost a round trip. Reading ahead in large
+    blocks means the readers are served from memory while the next blocks are
+    being fetched.
+
+    The most recently consumed blocks are retained so that the small backward
+    seeks made by the readers (eg; re-reading a datagram header) don't need
+    to go back to the underlying file. Seeks outside of the retained and
+    prefetched data restart the read ahead from the new position.
+
+    The underlying file may also be a stream of unknown length (eg;
+    decompressed data), in which case `size` is None until the end of the
+    stream has been read.
+    """
+
+    def __init__(
+            self,
+            fileobj: BinaryIO,
+            size: Optional[int] = None,
+            block_size: int = DEFAULT_BLOCK_SIZE,
+            depth: int = DEFAULT_DEPTH,
+            find_size: bool = True):
+        """ `ReadAheadFile` constructor
+
+        Args:
+            fileobj (BinaryIO): seekable binary file object to read from. It
+                will be closed when this file is closed.
+            size (int): number of bytes in `fileobj`, determined from the
+                file if not given.
+            block_size (int): number of bytes in each read from `fileobj`
+            depth (int): maximum number of blocks to read ahead
+            find_size (bool): if False and `size` is not given, the size is
+                left unknown until the end of `fileobj` is read rather than
+                being determined by seeking to the end.
+        """
+        super().__init__()
+        self._fileobj = fileobj
+        if size is None and find_size:
+            fileobj.seek(0, io.SEEK_END)
+            size = fileobj.tell()
+        self._size = size
+        self._block_size = block_size
+        self._depth = depth
+        self._position = 0
+        # blocks that have been handed to the consumer, as (offset, data)
+        # tuples. Only the last two are kept.
+        self._retained = []
+        self._file_lock = threading.Lock()
+        self._queue = None
+        self._stop = None
+        self._thread = None
+        self._start(0)
+
+    @property
+    def size(self) -> Optional[int]:
+        return self._size
+
+    def _start(self, offset: int):
+        """ Starts reading ahead from `offset`, abandoning any existing
+        read ahead.
+        """
+        self._cancel()
+        self._next_offset = offset
+        self._queue = queue.Queue(maxsize=self._depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._prefetch,
+            args=(offset, self._queue, self._stop),
+            daemon=True
+        )
+        self._thread.start()
+
+    def _cancel(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        # unblock the thread if it is waiting for space in the queue
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._thread.join()
+        self._thread = None
+
+    def _prefetch(
+            self,
+            offset: int,
+            blocks: queue.Queue,
+            stop: threading.Event):
+        while not stop.is_set():
+            try:
+                with self._file_lock:
+                    self._fileobj.seek(offset)
+                    data = self._fileobj.read(self._block_size)
+            except Exception as e:
+                data = e
+            while not stop.is_set():
+                try:
+                    blocks.put((offset, data), timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(data, Exception) or len(data) == 0:
+                # end of file (or a read error that will be raised by the
+                # consumer)
+                return
+            offset += len(data)
+
+    def _next_block(self):
+        offset, data = self._queue.get()
+        if isinstance(data, Exception):
+            raise data
+        if len(data) == 0:
+            # end of file, which gives the size if it wasn't known
+            self._size = offset
+            self._next_offset = offset
+            return offset, data
+        self._retained = self._retained[-1:] + [(offset, data)]
+        self._next_offset = offset + len(data)
+        return offset, data
+
+    def _find_block(self, position: int):
+        """ Gets the block containing `position`, consuming read ahead blocks
+        or restarting the read ahead as needed. Returns None at end of file.
+        """
+        if self._size is not None and position >= self._size:
+            return None
+        for offset, data in reversed(self._retained):
+            if offset <= position < offset + len(data):
+                return offset, data
+
+        # restart the read ahead if the position won't be reached by it soon
+        lookahead_end = self._next_offset + self._block_size * self._depth
+        if not (self._next_offset <= position < lookahead_end):
+            self._retained = []
+            self._start(position)
+
+        while True:
+            offset, data = self._next_block()
+            if len(data) == 0:
+                return None
+            if offset <= position < offset + len(data):
+                return offset, data
+            if offset > position:
+                # should not happen, but restart rather than return the
+                # wrong data
+                self._retained = []
+                self._start(position)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            if self._size is None:
+                raise io.UnsupportedOperation(
+                    "Can't seek from the end of a stream of unknown size")
+            position = self._size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        # data isn't fetched until it is read
+        self._position = position
+        return position
+
+    def read(self, size: int = -1) -> bytes:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = sys.maxsize
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            block = self._find_block(self._position)
+            if block is None:
+                break
+            offset, data = block
+            start = self._position - offset
+            chunk = data[start:start + remaining]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            remaining -= len(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return b''.join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def peek(self, size: int = 1) -> bytes:
+        position = self._position
+        data = self.read(size)
+        self._position = position
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self._cancel()
+        self._retained = []
+        self._fileobj.close()
+        super().close()
+
+
+def open_read_ahead(
+        path: str,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        depth: int = DEFAULT_DEPTH) -> ReadAheadFile:
+    """ Opens a file for reading with read ahead
+
+    Args:
+        path (str): path to the file
+        block_size (int): number of bytes in each read from the file
+        depth (int): maximum number of blocks to read ahead
+
+    Returns:
+        New `ReadAheadFile`
+    """
+    return ReadAheadFile(
+        open(path, 'rb', buffering=0),
+        size=os.path.getsize(path),
+        block_size=block_size,
+        depth=depth
+    )
+
+
+class FilePrefetcher:
+    """ Reads a file in a background thread, discarding the data, so that
+    it is held in the operating system (or network file system client) cache
+    by the time it is opened for scanning.
+    """
+
+    def __init__(self, path: str, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.path = path
+        self._block_size = block_size
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def _prefetch(self):
+        try:
+            with open(self.path, 'rb', buffering=0) as f:
+                while not self._stop.is_set():
+                    if len(f.read(self._block_size)) == 0:
+                        return
+        except OSError:
+            # the file will be read (and any error reported) when it is
+            # scanned
+            return
+
+    def cancel(self):
+        """ Stops prefetching the file """
+        self._stop.set()
+        self._thread.join()
@@ -2,8 +2,18 @@ from datetime import datetime
 from enum import Enum
 from geojson import Feature, Point, FeatureCollection
 from geojson.mapping import to_mapping
-from typing import Optional, Dict, List, Any, Union
-import os
+from typing import Optional, Dict, List, Any, Union, Callable, Tuple
+import math
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from hyo2.mate.lib.datagram_index import map_file
+from hyo2.mate.lib.integrity import MAX_REPORTED, MAX_DATAGRAM_SIZE
+from hyo2.mate.lib.raw_file import open_raw_file, stored_file_size
+from hyo2.mate.lib.time_index import TimeIndex, to_timestamp
 
 A_NONE = 'None'
 A_PARTIAL = 'Partial'
@@ -11,6 +21,24 @@ A_FULL = 'Full'
 A_FAIL = 'Fail'
 A_PASS = 'Pass'
 
+# defaults for sampled scans; bytes read from the start and end of the file,
+# and the number and size of the windows read from the rest of it
+SAMPLE_HEAD_SIZE = 4 * 1024 * 1024
+SAMPLE_TAIL_SIZE = 4 * 1024 * 1024
+SAMPLE_WINDOW_COUNT = 16
+SAMPLE_WINDOW_SIZE = 1024 * 1024
+# z value of the confidence interval given as the error bound of the counts
+# extrapolated from a sampled scan (95%)
+SAMPLE_ERROR_Z = 1.96
+# bytes read from the start of the file by a metadata scan before looking
+# for the metadata datagrams at the end of the file instead
+METADATA_HEAD_SIZE = 16 * 1024 * 1024
+METADATA_TAIL_SIZE = 1024 * 1024
+# bytes read from each end of the file by `Scan.quick_info`
+QUICK_INFO_SIZE = 64 * 1024
+# scan result counts extrapolated by a sampled scan
+SAMPLED_COUNTS = ['recordCount', 'byteCount', 'pingCount', 'missedPings']
+
 
 class ScanState(str, Enum):
     '''
@@ -39,11 +67,16 @@ class ScanResult:
     def __init__(
         self,
         state: ScanState,
-        messages: Optional[Union[List, str]] = [],
+        messages: Optional[Union[List, str]] = None,
         data: Dict = None
     ):
         self.state = state
-        message_list = [messages] if isinstance(messages, str) else messages
+        if messages is None:
+            message_list = []
+        elif isinstance(messages, str):
+            message_list = [messages]
+        else:
+            message_list = list(messages)
         self.messages = message_list
         self.data = data
 
@@ -55,30 +88,796 @@ class ScanResult:
         )
 
 
+class ScanProgress:
+    '''
+    Tracks progress through a file while it is being scanned. Cancellation
+    is polled, and progress reported, at most once every `poll_bytes` bytes.
+    Progress callbacks are further limited to one every `min_interval`
+    seconds so that the cost of reporting doesn't depend on the number of
+    datagrams in the file.
+
+    :param file_size: Number of bytes in the file being scanned
+    :type file_size: int
+    :param progress_callback: Passed a float between 0.0 and 1.0 to indicate
+        progress through the file
+    :type progress_callback: Callable, optional
+    :param is_stopped: If this returns True the scan should stop
+    :type is_stopped: Callable, optional
+    :param poll_bytes: Bytes read between checks of `is_stopped`
+    :type poll_bytes: int, optional
+    :param min_interval: Minimum number of seconds between progress callbacks
+    :type min_interval: float, optional
+    '''
+
+    def __init__(
+        self,
+        file_size: int,
+        progress_callback: Optional[Callable] = None,
+        is_stopped: Optional[Callable] = None,
+        poll_bytes: int = 4 * 1024 * 1024,
+        min_interval: float = 0.2
+    ):
+        self.file_size = file_size
+        self.progress_callback = progress_callback
+        self.is_stopped = is_stopped
+        self.poll_bytes = poll_bytes
+        self.min_interval = min_interval
+        self.stopped = False
+        self._next_poll = 0
+        self._last_callback = None
+
+    def update(self, position: int) -> bool:
+        '''
+        Records the current position in the file.
+
+        :param position: Number of bytes of the file that have been read
+        :return: True if the scan has been stopped and should not continue
+        '''
+        if position < self._next_poll:
+            return self.stopped
+        self._next_poll = position + self.poll_bytes
+
+        if self.is_stopped is not None and self.is_stopped():
+            self.stopped = True
+            return True
+
+        if self.progress_callback is not None:
+            now = time.monotonic()
+            if (self._last_callback is None or
+                    now - self._last_callback >= self.min_interval):
+                self._last_callback = now
+                self.progress_callback(self.fraction(position))
+        return False
+
+    def fraction(self, position: int) -> float:
+        '''return progress through the file between 0.0 and 1.0'''
+        if not self.file_size:
+            return 1.0
+        return min(1.0, max(0.0, position / self.file_size))
+
+    def finish(self):
+        '''report the scan as complete, unless it was stopped'''
+        if self.progress_callback is not None and not self.stopped:
+            self.progress_callback(1.0)
+
+
 class Scan:
-    '''abstract class to scan a raw data file'''
-
-    file_path = None
-    file_size = None
-    reader = None
-    progress = 0       # completed percentage (0 - 100)
-    scan_result = {}
-
-    default_info = {
-        'byteCount': 0,
-        'recordCount': 0,
-        'pingCount': 0,
-        'missedPings': 0,
-        'startTime': None,
-        'stopTime': None,
-        'other': None,
-    }
+    '''
+    abstract class to scan a raw data file. All state is held by the
+    instance, so separate files can be scanned concurrently in threads.
+    '''
+
+    # datagram types that record a ping, in order of preference for
+    # `get_ping`
+    ping_datagram_types = []
+    # datagram types holding the metadata read by `scan_metadata`
+    metadata_datagram_types = []
 
     def __init__(self, file_path):
         self.file_path = file_path
-        self.file_size = 0
-        if os.path.exists(file_path):
-            self.file_size = os.path.getsize(file_path)
+        # size of the file as stored, which may be compressed
+        self.file_size = stored_file_size(file_path)
+        # number of bytes of datagrams in the file. Differs from file_size
+        # for compressed files, where it is only known once the whole file
+        # has been scanned.
+        self.data_size = self.file_size
+        # `RawFile` the datagrams are read from, if any
+        self.raw_file = None
+        # (start, end) offsets of parts of the file that couldn't be read as
+        # datagrams
+        self.corrupt_ranges = []
+        # `TimeIndex` of the datagrams in the file, built when first needed
+        self.time_index = None
+        # True if the scan results were extrapolated from parts of the file
+        # by `scan_sampled`
+        self.sampled = False
+        # True if only the metadata datagrams were read, by `scan_metadata`
+        self.metadata_only = False
+        # offset of the end of the last datagram read by an incremental
+        # scan, where the next incremental scan continues from
+        self.scanned_offset = None
+        self.reader = None
+        self.progress = 0       # completed fraction (0.0 - 1.0)
+        self.scan_result = {}
+        self.datagrams = {}
+        # summary information initially recorded for each datagram type,
+        # copied into scan_result
+        self.default_info = {
+            'byteCount': 0,
+            'recordCount': 0,
+            'pingCount': 0,
+            'missedPings': 0,
+            'startTime': None,
+            'stopTime': None,
+            'other': None,
+        }
+
+    def close(self):
+        '''
+        Releases the file handles held by this scan, and the datagrams that
+        were decoded when the file was scanned. Checks can no longer be run
+        on a closed scan.
+        '''
+        if self.raw_file is not None:
+            self.raw_file.close()
+            self.raw_file = None
+        self.datagrams = {}
+
+    def _open_raw_file(self, read_ahead=False):
+        '''
+        Opens the file for reading datagrams, decompressing it as it is
+        read if needed.
+
+        :param read_ahead: read the file in large blocks in a background
+            thread
+        :return: :class:`hyo2.mate.lib.raw_file.RawFile`
+        '''
+        self.raw_file = open_raw_file(self.file_path, read_ahead)
+        return self.raw_file
+
+    def _finish_raw_file(self):
+        '''
+        Records the size of the datagrams read from the raw file, once the
+        scan has reached the end of it.
+        '''
+        if self.raw_file is not None and self.raw_file.size is not None:
+            self.data_size = self.raw_file.size
+
+    def _begin_scan(self, incremental: bool = False) -> int:
+        '''
+        Prepares for a scan of the datagrams in the file. A full scan
+        clears the results of any earlier scan. An incremental scan finds
+        how much has been appended to the file, and continues from where
+        the last incremental scan stopped keeping its results, or starts
+        from the beginning if the file is new or has been replaced by a
+        smaller one.
+
+        :param incremental: follow a file that is still being written to
+        :return: offset of the datagram the scan starts from
+        '''
+        stream = self.raw_file.stream
+        if incremental:
+            size = self.raw_file.refresh_size()
+            self.file_size = size
+            self.data_size = size
+            self.time_index = None
+            self._update_size(size)
+            if self.scanned_offset is not None and \
+                    self.scanned_offset <= size:
+                stream.seek(self.scanned_offset)
+                return self.scanned_offset
+            stream.seek(0)
+
+        self.scan_result = {}
+        self.datagrams = {}
+        self.corrupt_ranges = []
+        self.sampled = False
+        self.metadata_only = False
+        self.scanned_offset = None
+        return stream.tell()
+
+    def _update_size(self, size: int):
+        '''
+        Called when an incremental scan has found the current size of the
+        file, so the format reader can read the datagrams appended to it.
+        '''
+
+    def _datagram_end(self, position: int, length: int) -> int:
+        '''
+        Gets the offset of the end of a datagram from the length at the
+        start of it. Overridden by formats where the length doesn't include
+        the length field itself.
+        '''
+        return position + length
+
+    def _datagram_available(self) -> bool:
+        '''
+        Indicates if the whole of the datagram at the current position has
+        been written to the file, rather than only the start of it.
+        '''
+        stream = self.raw_file.stream
+        position = stream.tell()
+        header = stream.read(4)
+        stream.seek(position)
+        if len(header) < 4:
+            return False
+        length = struct.unpack('<I', header)[0]
+        if length > MAX_DATAGRAM_SIZE:
+            # corrupt rather than partly written, the format reader deals
+            # with this
+            return True
+        return self._datagram_end(position, length) <= self.data_size
+
+    def _scan_datagrams(
+            self,
+            progress_callback=None,
+            is_stopped=None,
+            incremental: bool = False) -> bool:
+        '''
+        Reads the datagrams in the file with `_scan_next`, from the start
+        or, for an incremental scan, from the end of the last incremental
+        scan. An incremental scan stops before a datagram that is still
+        being written, leaving it for the next incremental scan, so the
+        cost of each scan depends only on the data appended since the last
+        one.
+
+        :return: False if the scan was stopped before all datagrams were
+            read
+        '''
+        start = self._begin_scan(incremental)
+        scan_progress = ScanProgress(
+            self.file_size - start, progress_callback, is_stopped)
+        while self._more_datagrams():
+            if incremental and not self._datagram_available():
+                break
+            # update progress, based on the bytes read from disk
+            position = self.raw_file.position() - start
+            self.progress = scan_progress.fraction(position)
+            if scan_progress.update(position):
+                if incremental:
+                    self.scanned_offset = self.raw_file.stream.tell()
+                return False
+
+            self._scan_next()
+
+        if incremental:
+            self.scanned_offset = self.raw_file.stream.tell()
+        else:
+            self._finish_raw_file()
+        scan_progress.finish()
+        return True
+
+    def _scan_next(self):
+        '''
+        Reads the datagram at the current position in the file, adding its
+        details to `scan_result` and `datagrams`. Implemented by each
+        format.
+        '''
+        raise NotImplementedError(
+            "Datagram scans not supported for {}".format(type(self).__name__))
+
+    def _more_datagrams(self) -> bool:
+        '''indicates if there are datagrams left to be read by _scan_next'''
+        return not self.raw_file.at_end()
+
+    def _find_candidates(
+            self, buffer: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Finds the positions in part of the file that could be the start of
+        a datagram. Implemented by each format.
+
+        :return: tuple of arrays of the start and end (exclusive) offset of
+            each candidate datagram, sorted by start
+        '''
+        raise NotImplementedError(
+            "Sampled scans not supported for {}".format(type(self).__name__))
+
+    def _sync_position(
+            self, buffer: np.ndarray, start: int, end: int) -> Optional[int]:
+        '''
+        Finds the first datagram in a window of the file that is followed
+        by another datagram, where reading can start.
+        '''
+        starts, ends = self._find_candidates(buffer[start:end])
+        if len(starts) == 0:
+            return None
+        following = np.minimum(np.searchsorted(starts, ends), len(starts) - 1)
+        chained = np.flatnonzero(starts[following] == ends)
+        if len(chained) == 0:
+            return None
+        return start + int(starts[chained[0]])
+
+    def _sample_windows(
+            self,
+            head_size: int,
+            tail_size: int,
+            window_count: int,
+            window_size: int) -> List[Tuple[int, int]]:
+        '''
+        Gets the (start, end) offsets of the parts of the file read by a
+        sampled scan; the start, evenly spaced windows, and the end.
+        '''
+        size = self.data_size
+        middle_size = size - head_size - tail_size
+        windows = [(0, head_size)]
+        spacing = middle_size / window_count
+        for i in range(window_count):
+            centre = head_size + (i + 0.5) * spacing
+            # GSF records are aligned to four bytes
+            start = int(centre - window_size / 2) // 4 * 4
+            windows.append((start, start + window_size))
+        windows.append((size - tail_size, size))
+        return windows
+
+    def _window_counts(self) -> Dict:
+        '''copy of the counts in scan_result for each datagram type'''
+        return {
+            dg_type: {key: info.get(key, 0) for key in SAMPLED_COUNTS}
+            for dg_type, info in self.scan_result.items()
+        }
+
+    def scan_sampled(
+            self,
+            progress_callback=None,
+            is_stopped=None,
+            head_size: int = SAMPLE_HEAD_SIZE,
+            tail_size: int = SAMPLE_TAIL_SIZE,
+            window_count: int = SAMPLE_WINDOW_COUNT,
+            window_size: int = SAMPLE_WINDOW_SIZE):
+        '''
+        Quick look scan that reads only the start and end of the file, and
+        a number of evenly spaced windows through the rest of it. Datagrams
+        are read from each of these as they would be by `scan_datagram`,
+        then the counts in `scan_result` are extrapolated to the whole
+        file. The counts of each datagram type include `sampled: True` and
+        an `errorBounds` dict giving the 95% confidence interval (+/-) of
+        each count.
+
+        Files too small to be worth sampling, compressed files, and archive
+        members (which can't be seeked) are scanned in full by
+        `scan_datagram`, and `sampled` is left False.
+
+        :param progress_callback: passed a float between 0.0 and 1.0 to
+            indicate progress of the scan
+        :param is_stopped: if this function returns True the scan will stop
+        :param head_size: bytes read from the start of the file
+        :param tail_size: bytes read from the end of the file
+        :param window_count: number of windows read between the start and
+            end of the file
+        :param window_size: bytes read in each window
+        '''
+        sampled_size = head_size + tail_size + window_count * window_size
+        # windows need to be well spaced for the samples to be independent
+        if not self.raw_file.is_plain_file or \
+                self.data_size < 2 * sampled_size:
+            self.scan_datagram(progress_callback, is_stopped)
+            return
+
+        self._begin_scan()
+        buffer = map_file(self.raw_file.path)
+        stream = self.raw_file.stream
+        scan_progress = ScanProgress(
+            sampled_size, progress_callback, is_stopped)
+        windows = self._sample_windows(
+            head_size, tail_size, window_count, window_size)
+        # (bytes read, counts read) for each window
+        samples = []
+        read_size = 0
+        for i, (start, end) in enumerate(windows):
+            is_tail = i == len(windows) - 1
+            if i > 0:
+                start = self._sync_position(buffer, start, end)
+                if start is None:
+                    # no datagrams found, eg; a corrupt part of the file
+                    continue
+                # ping counters aren't continuous between windows
+                for info in self.scan_result.values():
+                    info['_seqNo'] = None
+            stream.seek(start)
+            before = self._window_counts()
+            while self._more_datagrams() and \
+                    (is_tail or stream.tell() < end):
+                position = read_size + stream.tell() - start
+                self.progress = scan_progress.fraction(position)
+                if scan_progress.update(position):
+                    return
+                self._scan_next()
+            window_read = stream.tell() - start
+            read_size += window_read
+            if 0 < i < len(windows) - 1:
+                after = self._window_counts()
+                samples.append((window_read, before, after))
+
+        self._extrapolate_counts(samples, read_size)
+        self.sampled = True
+        scan_progress.finish()
+
+    def _has_metadata(self) -> bool:
+        return all(
+            dg_type in self.datagrams
+            for dg_type in self.metadata_datagram_types)
+
+    def scan_metadata(
+            self,
+            progress_callback=None,
+            is_stopped=None,
+            head_size: int = METADATA_HEAD_SIZE,
+            tail_size: int = METADATA_TAIL_SIZE):
+        '''
+        Reads only the datagrams needed for checks of the file metadata,
+        such as the installation parameters, rather than the whole file.
+        Datagrams are read from the start of the file until one of each of
+        `metadata_datagram_types` has been read. If these aren't found in
+        the first `head_size` bytes, the datagrams in the last `tail_size`
+        bytes are read instead (eg; for the installation parameters
+        recorded when logging stopped). The end of the file can't be found
+        without reading all of it for compressed files and archive members.
+
+        `scan_result` only includes the datagrams read, and
+        `metadata_only` is set True.
+
+        :param progress_callback: passed a float between 0.0 and 1.0 to
+            indicate progress of the scan
+        :param is_stopped: if this function returns True the scan will stop
+        :param head_size: bytes read from the start of the file
+        :param tail_size: bytes read from the end of the file
+        '''
+        start = self._begin_scan()
+        stream = self.raw_file.stream
+        scan_progress = ScanProgress(
+            head_size + tail_size, progress_callback, is_stopped)
+        while self._more_datagrams() and not self._has_metadata():
+            position = stream.tell() - start
+            if position >= head_size:
+                break
+            self.progress = scan_progress.fraction(position)
+            if scan_progress.update(position):
+                return
+            self._scan_next()
+
+        if not self._has_metadata() and self._more_datagrams() and \
+                self.raw_file.is_plain_file:
+            buffer = map_file(self.raw_file.path)
+            size = len(buffer)
+            tail_start = self._sync_position(
+                buffer, max(stream.tell(), size - tail_size), size)
+            if tail_start is not None:
+                stream.seek(tail_start)
+                while self._more_datagrams() and not self._has_metadata():
+                    position = head_size + stream.tell() - tail_start
+                    self.progress = scan_progress.fraction(position)
+                    if scan_progress.update(position):
+                        return
+                    self._scan_next()
+
+        self.metadata_only = True
+        scan_progress.finish()
+
+    def _header_info(self, header: bytes) -> Optional[Tuple]:
+        '''
+        Decodes the header of a datagram. Implemented by each format.
+
+        :param header: the start of the datagram, at least 64 bytes unless
+            the datagram is shorter
+        :return: tuple of the datagram type, time (seconds since the unix
+            epoch), model and serial number of the system that recorded it,
+            any of which may be None if not recorded in the header. None if
+            the header isn't valid.
+        '''
+        raise NotImplementedError(
+            "Quick info not supported for {}".format(type(self).__name__))
+
+    def _probe_datagrams(self, data: bytes) -> List[Tuple[int, int, Tuple]]:
+        '''
+        Finds the valid datagrams in part of the file. Only datagrams that
+        are followed by, or follow, another datagram are included, so a
+        datagram cut off at the end of `data` is excluded as is data that
+        only happens to look like a datagram.
+
+        :return: list of the start, end and header info of each datagram
+        '''
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        starts, ends = self._find_candidates(buffer)
+        if len(starts) > 1:
+            linked = np.isin(ends, starts) | np.isin(starts, ends)
+            starts = starts[linked]
+            ends = ends[linked]
+        datagrams = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            info = self._header_info(data[start:start + 64])
+            if info is not None:
+                datagrams.append((start, end, info))
+        return datagrams
+
+    def quick_info(self, probe_size: int = QUICK_INFO_SIZE) -> Dict:
+        '''
+        Gets the start and stop time of the file, and the systems that
+        recorded it, from the first and last datagrams alone. Only
+        `probe_size` bytes are read from each end of the file, so this is
+        much faster than `scan_datagram` (which gives the same times in
+        `scan_result`). The last valid datagram is found by resynchronising
+        in the data read from the end of the file, so a truncated or
+        partly overwritten end of the file is skipped. Compressed files have
+        to be decompressed to find the end of their data.
+
+        :param probe_size: bytes read from the start and end of the file
+        :return: dict with the `startTime` and `stopTime` of the file (as
+            UTC datetimes), the `firstDatagramOffset` and
+            `lastDatagramEnd` bounding the valid datagrams, and the
+            `models` and `serialNumbers` found in the datagram headers.
+            Values that couldn't be found are None.
+        '''
+        with open_raw_file(self.file_path) as raw_file:
+            stream = raw_file.stream
+            head = stream.read(probe_size)
+            size = raw_file.size
+            if size is not None:
+                # GSF records are aligned to four bytes
+                tail_offset = max(0, size - probe_size) // 4 * 4
+                stream.seek(tail_offset)
+                tail = stream.read()
+            else:
+                # read through to the end, keeping the last blocks
+                tail_offset = 0
+                tail = head
+                while True:
+                    block = stream.read(probe_size)
+                    if len(block) == 0:
+                        break
+                    tail += block
+                    if len(tail) > 2 * probe_size:
+                        drop = (len(tail) - probe_size) // 4 * 4
+                        tail = tail[drop:]
+                        tail_offset += drop
+
+        head_datagrams = self._probe_datagrams(head)
+        tail_datagrams = [
+            (start + tail_offset, end + tail_offset, info)
+            for start, end, info in self._probe_datagrams(tail)
+        ]
+        times = [
+            info[1] for _, _, info in head_datagrams if info[1] is not None]
+        start_time = times[0] if len(times) > 0 else None
+        times = [
+            info[1] for _, _, info in tail_datagrams if info[1] is not None]
+        stop_time = times[-1] if len(times) > 0 else None
+        datagrams = head_datagrams + tail_datagrams
+        return {
+            'startTime': None if start_time is None
+            else datetime.utcfromtimestamp(start_time),
+            'stopTime': None if stop_time is None
+            else datetime.utcfromtimestamp(stop_time),
+            'firstDatagramOffset': head_datagrams[0][0]
+            if len(head_datagrams) > 0 else None,
+            'lastDatagramEnd': tail_datagrams[-1][1]
+            if len(tail_datagrams) > 0 else None,
+            'models': sorted({
+                info[2] for _, _, info in datagrams if info[2] is not None}),
+            'serialNumbers': sorted({
+                info[3] for _, _, info in datagrams if info[3] is not None}),
+        }
+
+    def _extrapolate_counts(self, samples: List, read_size: int):
+        '''
+        Scales the counts read by a sampled scan up to the whole file. The
+        density of each count (per byte) in the windows between the start
+        and end of the file is used to estimate the count in the parts of
+        the file that weren't read. The error bound is the confidence
+        interval of this ratio estimate, based on the variation between the
+        windows. Gaps in ping counters are only found within each window, so
+        missed pings are slightly under estimated.
+        '''
+        unread_size = max(0, self.data_size - read_size)
+        sizes = np.array([size for size, _, _ in samples], dtype=np.float64)
+        for dg_type, info in self.scan_result.items():
+            error_bounds = {}
+            for key in SAMPLED_COUNTS:
+                if key not in info:
+                    continue
+                counts = np.array([
+                    after.get(dg_type, {}).get(key, 0) -
+                    before.get(dg_type, {}).get(key, 0)
+                    for _, before, after in samples
+                ], dtype=np.float64)
+                if len(samples) == 0 or sizes.sum() == 0:
+                    error_bounds[key] = None
+                    continue
+                density = counts.sum() / sizes.sum()
+                info[key] = int(round(info[key] + density * unread_size))
+                if len(samples) < 2:
+                    error_bounds[key] = None
+                    continue
+                residuals = counts - density * sizes
+                density_error = math.sqrt(
+                    (residuals ** 2).sum() /
+                    (len(samples) * (len(samples) - 1))) / sizes.mean()
+                error_bounds[key] = int(math.ceil(
+                    SAMPLE_ERROR_Z * density_error * unread_size))
+            info['sampled'] = True
+            info['errorBounds'] = error_bounds
+
+    def _build_time_index(self) -> TimeIndex:
+        '''
+        Indexes the time and type of every datagram in the file, reading
+        only the datagram headers. Implemented by each format.
+        '''
+        raise NotImplementedError(
+            "Time index not supported for {}".format(type(self).__name__))
+
+    def _read_datagram_at(self, offset: int):
+        '''
+        Reads and decodes the datagram starting at `offset`. Implemented by
+        each format.
+
+        :return: tuple of the datagram type and the decoded datagram
+        '''
+        raise NotImplementedError(
+            "Random access not supported for {}".format(type(self).__name__))
+
+    def get_time_index(self) -> TimeIndex:
+        '''
+        Gets the index of datagram offsets sorted by time, building it
+        from the datagram headers if this hasn't been done already.
+
+        :return: :class:`hyo2.mate.lib.time_index.TimeIndex`
+        '''
+        if self.time_index is None:
+            self.time_index = self._build_time_index()
+        return self.time_index
+
+    def datagram_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the offset, type, time, counter and size of every datagram in
+        the file as columns, eg; for export to Parquet. Only the datagram
+        headers are read, using the time index.
+
+        :return: dict of equal length arrays in file order. Times are in
+            seconds since the unix epoch (NaN if not recorded), counters
+            are -1 where the format doesn't record one in the header.
+        '''
+        index = self.get_time_index()
+        sizes = index.sizes
+        if sizes is None:
+            sizes = np.diff(np.append(index.offsets, self.data_size))
+        return {
+            'offset': index.offsets,
+            'type': index.types.astype(str),
+            'time': index.times,
+            'counter': self._datagram_counters(index),
+            'size': sizes,
+        }
+
+    def _datagram_counters(self, index: TimeIndex) -> np.ndarray:
+        '''
+        Gets the counter recorded in the header of each datagram in the
+        index. Implemented by formats that have one.
+        '''
+        return np.full(len(index), -1, dtype=np.int64)
+
+    def position_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the time (seconds since the unix epoch), latitude and
+        longitude of the positions read by the scan as columns.
+        Implemented by each format.
+        '''
+        raise NotImplementedError(
+            "Position table not supported for {}".format(type(self).__name__))
+
+    def attitude_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the time (seconds since the unix epoch), roll, pitch, heave
+        and heading of the attitude samples read by the scan as columns.
+        Implemented by each format.
+        '''
+        raise NotImplementedError(
+            "Attitude table not supported for {}".format(type(self).__name__))
+
+    def iter_datagrams(self, types=None, start_time=None, end_time=None):
+        '''
+        Reads the datagrams recorded within a time window, without scanning
+        the rest of the file. The first call indexes the datagram headers,
+        later calls seek directly to the datagrams required. Compressed
+        files and archive members can't be seeked, so each call may need to
+        decompress from the start of the file.
+
+        :param types: only read datagrams of these types (as used for the
+            `scan_result` keys), all types are read if None
+        :param start_time: datetime or seconds since the unix epoch, if None
+            datagrams from the start of the file are read
+        :param end_time: datetime or seconds since the unix epoch
+            (inclusive), if None datagrams to the end of the file are read
+        :return: generator of (datagram type, decoded datagram) tuples, in
+            time order
+        '''
+        offsets = self.get_time_index().find(types, start_time, end_time)
+        stream = self.raw_file.stream
+        position = stream.tell()
+        try:
+            for offset in offsets:
+                yield self._read_datagram_at(int(offset))
+        finally:
+            # leave the file where a scan would expect it
+            stream.seek(position)
+
+    def get_ping(self, n: int, datagram_type=None):
+        '''
+        Reads the datagram of the `n`th ping (starting from 0) in the file.
+
+        :param n: number of the ping in the file, negative numbers count
+            back from the last ping
+        :param datagram_type: type of ping datagram to read, if None the
+            first of `ping_datagram_types` found in the file is used
+        :return: tuple of the datagram type and the decoded datagram
+        :raises IndexError: if the file doesn't contain `n` pings
+        '''
+        index = self.get_time_index()
+        if datagram_type is None:
+            datagram_type = next(
+                (t for t in self.ping_datagram_types if index.has_type(t)),
+                None)
+            if datagram_type is None:
+                raise IndexError("No ping datagrams found")
+        offsets = index.type_offsets(datagram_type)
+        if not -len(offsets) <= n < len(offsets):
+            raise IndexError(
+                "Ping {} not found, {} {} datagrams in file".format(
+                    n, len(offsets), datagram_type))
+        stream = self.raw_file.stream
+        position = stream.tell()
+        try:
+            return self._read_datagram_at(int(offsets[n]))
+        finally:
+            stream.seek(position)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _read_datagram_bytes(self, start: int) -> bytes:
+        '''
+        Reads the bytes of a datagram from `start` up to the current
+        position, where the format reader leaves the stream once it has
+        read the datagram. The stream is left at the same position.
+        '''
+        stream = self.raw_file.stream
+        end = stream.tell()
+        stream.seek(start)
+        return stream.read(end - start)
+
+    def _parameters_changed(self, datagram_type, payload: bytes) -> bool:
+        '''
+        Indicates if the payload of a parameters datagram differs from that
+        of the last datagram of its type. Only a hash of the last payload is
+        kept (in `scan_result`, so incremental scans carry on from it), so
+        the datagrams that haven't changed don't need to be decoded. Whether
+        a decoded datagram is kept is decided by
+        `_push_changed_parameters`.
+
+        :param payload: bytes of the datagram, without the fields that
+            change in every datagram such as its time and counter
+        '''
+        digest = zlib.crc32(payload)
+        info = self.scan_result[datagram_type]
+        if info.get('_parametersHash') == digest:
+            return False
+        info['_parametersHash'] = digest
+        return True
+
+    def _push_changed_parameters(self, datagram_type, datagram):
+        '''
+        Keeps a decoded parameters datagram if the string given by its
+        `parameters()` differs from that of the last datagram kept. Some
+        values are rounded in this string, so a change in the bytes of the
+        datagram isn't always a change in its parameters.
+        '''
+        parameters = datagram.parameters()
+        info = self.scan_result[datagram_type]
+        if info.get('_parameters') == parameters:
+            return
+        info['_parameters'] = parameters
+        self._push_datagram(datagram_type, datagram)
 
     def _time_str(self, unix_time):
         '''return time string in ISO format'''
@@ -103,10 +902,21 @@ class Scan:
             self.datagrams[name] = []
         self.datagrams[name].append(datagram)
 
-    def scan_datagram(self):
+    def scan_datagram(
+            self, progress_callback=None, is_stopped=None, incremental=False):
         '''
         scan data to extract basic information for each type of datagram
         and save to scan_result
+
+        :param progress_callback: passed a float between 0.0 and 1.0 to
+            indicate progress of the scan
+        :param is_stopped: if this function returns True the scan will stop
+            before reaching the end of the file
+        :param incremental: follow a file that is still being written to.
+            Each incremental scan reads only the datagrams appended since
+            the last one, adding them to `scan_result`. Only supported by
+            some formats, and only for uncompressed files read without read
+            ahead.
         '''
 
     def get_datagram_info(self, datagram_type):
@@ -137,6 +947,47 @@ class Scan:
             total += self.scan_result[datagram_type]['missedPings']
         return total
 
+    def ping_bounds(self) -> Dict:
+        '''
+        Gets the ping counter and time of the first and last ping found by
+        the scan, used to compare consecutive files. Taken from the scan
+        results, so the file isn't read again.
+
+        :return: dict with the `pingType` the bounds are taken from, its
+            `firstCounter` and `lastCounter` (None if the format doesn't
+            record a ping counter) and the `startTime` and `stopTime` of the
+            file in seconds since the unix epoch (None if not known)
+        '''
+        ping_types = [
+            dg_type for dg_type in self.ping_datagram_types
+            if self.scan_result.get(dg_type, {}).get('pingCount', 0) > 0
+        ]
+        if len(ping_types) > 0:
+            ping_type = ping_types[0]
+            infos = [self.scan_result[ping_type]]
+        else:
+            # times of the file as a whole
+            ping_type = None
+            infos = list(self.scan_result.values())
+        start_times = [
+            to_timestamp(info['startTime']) for info in infos
+            if info.get('startTime') is not None]
+        stop_times = [
+            to_timestamp(info['stopTime']) for info in infos
+            if info.get('stopTime') is not None]
+        first_counter = None
+        last_counter = None
+        if ping_type is not None:
+            first_counter = self.scan_result[ping_type].get('_firstSeqNo')
+            last_counter = self.scan_result[ping_type].get('_seqNo')
+        return {
+            'pingType': ping_type,
+            'firstCounter': first_counter,
+            'lastCounter': last_counter,
+            'startTime': min(start_times, default=None),
+            'stopTime': max(stop_times, default=None),
+        }
+
     def total_datagram_bytes(self):
         '''return number of bytes of all datagrams'''
         total_bytes = 0
@@ -145,8 +996,66 @@ class Scan:
         return total_bytes
 
     def is_size_matched(self):
-        '''check if number of bytes of all datagrams is equal to file size'''
-        return (self.total_datagram_bytes() == self.file_size)
+        '''
+        check if number of bytes of all datagrams is equal to file size.
+        If not, `unaccounted_bytes` gives the bytes that aren't part of a
+        datagram.
+        '''
+        return (self.total_datagram_bytes() == self.data_size)
+
+    def unaccounted_bytes(self):
+        '''
+        Gets the parts of the file that aren't part of any valid datagram,
+        eg; where the file has been truncated or overwritten.
+
+        :return: list of (start, end) byte offsets, the end is exclusive
+        '''
+        return list(self.corrupt_ranges)
+
+    def _check_integrity(self, verify: Callable) -> ScanResult:
+        '''
+        Verifies every datagram in the file, and summarises the bad
+        datagrams and corrupt byte ranges found as a check result.
+
+        :param verify: format specific verification function from
+            :mod:`hyo2.mate.lib.integrity`
+        :return: :class:`hyo2.mate.lib.scan.ScanResult`
+        '''
+        with open_raw_file(self.file_path) as raw_file:
+            if raw_file.is_plain_file:
+                # memory mapped, rather than read through Python
+                report = verify(path=self.file_path)
+            else:
+                report = verify(stream=raw_file.stream)
+
+        corrupt_byte_count = sum(
+            end - start for start, end in report.corrupt_ranges)
+        data = {
+            'datagramCount': report.datagram_count,
+            'badDatagramCount': len(report.bad_datagrams),
+            'badDatagrams': [
+                {'offset': offset, 'reason': reason}
+                for offset, reason in report.bad_datagrams[:MAX_REPORTED]
+            ],
+            'corruptRanges': [
+                {'start': start, 'end': end}
+                for start, end in report.corrupt_ranges[:MAX_REPORTED]
+            ],
+            'corruptByteCount': corrupt_byte_count,
+        }
+        if report.is_valid:
+            return ScanResult(state=ScanState.PASS, data=data)
+
+        messages = []
+        if len(report.bad_datagrams) > 0:
+            messages.append(
+                "{} of {} datagrams failed verification".format(
+                    len(report.bad_datagrams), report.datagram_count))
+        if len(report.corrupt_ranges) > 0:
+            messages.append(
+                "{} bytes in {} ranges could not be read as datagrams".format(
+                    corrupt_byte_count, len(report.corrupt_ranges)))
+        return ScanResult(state=ScanState.FAIL, messages=messages, data=data)
 
     def _to_points_geojson(self, items):
         '''
@@ -5,26 +5,118 @@ from geojson import Feature, Point, FeatureCollection, LineString
 from geojson.mapping import to_mapping
 from typing import List, Dict
 import functools
-import os
 import struct
+import sys
+import numpy as np
 import pyall
 
 from hyo2.mate.lib.scan import Scan, A_NONE, A_PARTIAL, A_FULL, A_FAIL, A_PASS
 from hyo2.mate.lib.scan import ScanState, ScanResult
+from hyo2.mate.lib.raw_file import raw_file_name, open_raw_file
+from hyo2.mate.lib.integrity import verify_all
+from hyo2.mate.lib.serialise import datagrams_to_dicts
+from hyo2.mate.lib.datagram_index import AllDatagramIndex, ALL_STX, \
+    ALL_MIN_LENGTH, ALL_TYPE_BYTES, map_file, read_uint32, \
+    find_all_candidates
+from hyo2.mate.lib.time_index import TimeIndex, walk_headers
+
+
+def _all_timestamps(dates: np.ndarray, times_ms: np.ndarray) -> np.ndarray:
+    '''
+    Converts the date (YYYYMMDD) and time (milliseconds since midnight)
+    recorded in .all datagram headers to seconds since the unix epoch. NaN
+    is given for invalid dates.
+    '''
+    year = dates // 10000
+    month = dates // 100 % 100
+    day = dates % 100
+    valid = (year >= 1970) & (year < 2200) & \
+        (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0)
+    days = months.astype('datetime64[M]').astype('datetime64[D]') \
+        .astype(np.int64) + day - 1
+    return np.where(valid, days * 86400 + times_ms / 1000.0, np.nan)
+
+
+def _parse_all_header(header: bytes):
+    '''
+    Gets the size, type and time of a datagram from its header, or None if
+    the header isn't valid. Used to build a `TimeIndex`.
+    '''
+    if len(header) < 16:
+        return None
+    num_bytes, stx, dg_type, _, record_date, record_time = \
+        struct.unpack_from('<LBBHLL', header)
+    if stx != ALL_STX or not ALL_TYPE_BYTES[dg_type] or \
+            num_bytes < ALL_MIN_LENGTH:
+        return None
+    dg_type = chr(dg_type)
+    time = _all_timestamps(
+        np.array([record_date]), np.array([record_time]))[0]
+    return num_bytes + 4, dg_type, None if np.isnan(time) else float(time)
+
+
+def _all_parameters_bytes(datagram: bytes) -> bytes:
+    '''
+    Gets the body of a datagram, without the common header (holding its
+    date, time and counter) or the ETX and checksum at the end, so the
+    parameters of datagrams can be compared.
+    '''
+    return datagram[20:-3]
+
+
+def _all_header_info(header: bytes):
+    '''
+    Gets the type, time, model and serial number of a datagram from its
+    header, or None if the header isn't valid. Used by `Scan.quick_info`.
+    '''
+    parsed = _parse_all_header(header)
+    if parsed is None or len(header) < 20:
+        return None
+    _, dg_type, time = parsed
+    em_model, _, _, _, serial_number = \
+        struct.unpack_from('<HLLHH', header, 6)
+    return dg_type, time, em_model, serial_number
 
 
 class ScanALL(Scan):
     '''
     A Scan object that contains check information on the contents of a Kongsberg .all file
-      :param file_path: The file path to the .all file
+      :param file_path: The file path to the .all file, may be compressed
+        (eg; .all.gz) or a member of an archive (eg; survey.zip!/line.all)
       :type file_path: str
+      :param read_ahead: Read the file in large blocks in a background thread
+      :type read_ahead: bool, optional
     
     '''
 
-    def __init__(self, file_path):
+    # bathymetry datagrams are preferred for `get_ping`
+    ping_datagram_types = ['X', 'D', 'N', 'F', 'f', 'S', 'Y']
+    # installation parameters, holding the original file name and date
+    metadata_datagram_types = ['I']
+
+    def __init__(self, file_path, read_ahead=False):
         Scan.__init__(self, file_path)
-        self.reader = open(self.file_path, 'rb')
-        self.all_reader = pyall.ALLReader(self.file_path)
+        # datagrams are read through the raw file so that compressed files
+        # are decompressed, and archive members extracted, as they are read
+        raw_file = self._open_raw_file(read_ahead)
+        self.all_reader = pyall.ALLReader(raw_file.disk_path)
+        self.all_reader.fileptr.close()
+        self.all_reader.fileptr = raw_file.stream
+        if raw_file.size is None:
+            # size of the decompressed data isn't known, stop pyall
+            # truncating datagrams it thinks run past the end of the file
+            self.all_reader.fileSize = sys.maxsize
+        else:
+            self.all_reader.fileSize = raw_file.size
+        # index of valid datagrams, only built if the file is found to be
+        # corrupt
+        self._datagram_index = None
+
+    def close(self):
+        '''close the .all file and release decoded datagrams'''
+        self.all_reader.close()
+        Scan.close(self)
 
     def get_size_n_pings(self, pings):
         '''
@@ -59,104 +151,258 @@ class ScanALL(Scan):
                 return None
         return c_bytes
 
-    def scan_datagram(self, progress_callback=None):
-        '''scan data to extract basic information for each type of datagram'''
-
-        # summary type information stored in plain dict
-        self.scan_result = {}
-        # datagram objects
-        self.datagrams = {}
-        while self.all_reader.moreData():
-            # update progress
-            self.progress = 1.0 - (self.all_reader.moreData() / self.file_size)
-            if progress_callback is not None:
-                progress_callback(self.progress)
-
-            # read datagram header
-            header = self.all_reader.readDatagramHeader()
-            num_bytes, stx, dg_type, em_model, record_date, record_time, \
-                counter, serial_number = header
-
-            time_stamp = pyall.to_DateTime(record_date, record_time)
-
-            dg_type, datagram = self.all_reader.readDatagram()
+    def scan_datagram(
+            self, progress_callback=None, is_stopped=None, incremental=False):
+        '''
+        scan data to extract basic information for each type of datagram.
+        With `incremental` only the datagrams appended to the file since the
+        last incremental scan are read, see `Scan.scan_datagram`.
+        '''
+        self._scan_datagrams(progress_callback, is_stopped, incremental)
 
-            if dg_type not in self.scan_result.keys():
-                self.scan_result[dg_type] = copy(self.default_info)
-                self.scan_result[dg_type]['_seqNo'] = None
+    def _update_size(self, size):
+        self.all_reader.fileSize = size
+        # the index of valid datagrams doesn't include appended datagrams
+        self._datagram_index = None
 
-            # save datagram info
-            self.scan_result[dg_type]['byteCount'] += num_bytes
-            self.scan_result[dg_type]['recordCount'] += 1
-            if self.scan_result[dg_type]['startTime'] is None:
-                self.scan_result[dg_type]['startTime'] = time_stamp
-            self.scan_result[dg_type]['stopTime'] = time_stamp
+    def _datagram_end(self, position, length):
+        # the length doesn't include the length field
+        return position + length + 4
 
-            if dg_type == 'I':
-                # Instrument parameters
-                # we care about this datagram so read its contents
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'h':
-                # height
-                if 'h' not in self.datagrams:
-                    # only read the first h datagram, this is all we need
-                    # to check the height type (assuming all h datagrams)
-                    # share the same type
-                    datagram.read()
-                    self._push_datagram(dg_type, datagram)
-            elif dg_type == 'R':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'A':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'n':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'P':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'G':
-                # problem
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'U':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'D':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'X':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'F':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'f':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'N':
-                datagram.read()
-                self._push_datagram(dg_type, datagram)
-            elif dg_type == 'S':
+    def _scan_next(self):
+        '''
+        Reads the datagram at the current position in the file, adding its
+        details to the scan results
+        '''
+        # read datagram header
+        datagram_start = self.raw_file.stream.tell()
+        header = self.all_reader.readDatagramHeader()
+        num_bytes, stx, dg_type, em_model, record_date, record_time, \
+            counter, serial_number = header
+        if not self._is_valid_header(header) or (
+                self._datagram_index is not None and
+                not self._datagram_index.is_start(datagram_start)):
+            self._skip_corrupt_bytes(datagram_start)
+            return
+
+        time_stamp = pyall.to_DateTime(record_date, record_time)
+
+        dg_type, datagram = self.all_reader.readDatagram()
+
+        if dg_type not in self.scan_result.keys():
+            self.scan_result[dg_type] = copy(self.default_info)
+            self.scan_result[dg_type]['_seqNo'] = None
+
+        # save datagram info
+        self.scan_result[dg_type]['byteCount'] += num_bytes
+        self.scan_result[dg_type]['recordCount'] += 1
+        if self.scan_result[dg_type]['startTime'] is None:
+            self.scan_result[dg_type]['startTime'] = time_stamp
+        self.scan_result[dg_type]['stopTime'] = time_stamp
+
+        if dg_type == 'I':
+            # Instrument parameters
+            # we care about this datagram so read its contents
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'h':
+            # height
+            if 'h' not in self.datagrams:
+                # only read the first h datagram, this is all we need
+                # to check the height type (assuming all h datagrams)
+                # share the same type
                 datagram.read()
                 self._push_datagram(dg_type, datagram)
-            elif dg_type == 'Y':
+        elif dg_type == 'R':
+            # runtime parameters are only decoded where their bytes differ
+            # from those of the last R datagram, and kept where their
+            # parameters differ
+            payload = _all_parameters_bytes(
+                self._read_datagram_bytes(datagram_start))
+            if self._parameters_changed(dg_type, payload):
                 datagram.read()
-                self._push_datagram(dg_type, datagram)
+                self._push_changed_parameters(dg_type, datagram)
+        elif dg_type == 'A':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'n':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'P':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'G':
+            # problem
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'U':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'D':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'X':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'F':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'f':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'N':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'S':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+        elif dg_type == 'Y':
+            datagram.read()
+            self._push_datagram(dg_type, datagram)
+
+        if dg_type in ['D', 'X', 'F', 'f', 'N', 'S', 'Y']:
+            this_count = counter
+            last_count = self.scan_result[dg_type]['_seqNo']
+            if last_count is None:
+                last_count = this_count
+            # kept for comparing the ping counters of consecutive files
+            self.scan_result[dg_type].setdefault('_firstSeqNo', this_count)
+            if this_count - last_count >= 1:
+                self.scan_result[dg_type]['missedPings'] += \
+                    this_count - last_count - 1
+                self.scan_result[dg_type]['pingCount'] += 1
+            self.scan_result[dg_type]['_seqNo'] = this_count
+
+    def _find_candidates(self, buffer):
+        return find_all_candidates(buffer)
+
+    def _header_info(self, header):
+        return _all_header_info(header)
+
+    def _is_valid_header(self, header) -> bool:
+        '''
+        Checks the header read by pyall is for a whole datagram. pyall
+        reports datagrams that run past the end of the file with an `XXX`
+        type, and a header it couldn't unpack as all zeros. The type is
+        checked against the same table as `AllDatagramIndex`.
+        '''
+        num_bytes, stx, dg_type = header[0:3]
+        return (
+            stx == ALL_STX and
+            isinstance(dg_type, str) and
+            len(dg_type) == 1 and
+            ord(dg_type) < len(ALL_TYPE_BYTES) and
+            ALL_TYPE_BYTES[ord(dg_type)] and
+            num_bytes >= ALL_MIN_LENGTH + 4
+        )
 
-            if dg_type in ['D', 'X', 'F', 'f', 'N', 'S', 'Y']:
-                this_count = counter
-                last_count = self.scan_result[dg_type]['_seqNo']
-                if last_count is None:
-                    last_count = this_count
-                if this_count - last_count >= 1:
-                    self.scan_result[dg_type]['missedPings'] += \
-                        this_count - last_count - 1
-                    self.scan_result[dg_type]['pingCount'] += 1
-                self.scan_result[dg_type]['_seqNo'] = this_count
-        return
+    def _skip_corrupt_bytes(self, position):
+        '''
+        Moves the reader past a corrupt part of the file, starting at
+        `position`, to the next valid datagram. The corrupt byte range is
+        recorded in `corrupt_ranges`.
+
+        The file is memory mapped and indexed to find the valid datagrams
+        (see :class:`hyo2.mate.lib.datagram_index.AllDatagramIndex`). This
+        isn't possible for compressed files or archive members, for these
+        the rest of the file is treated as corrupt.
+        '''
+        next_start = None
+        if self.raw_file.is_plain_file:
+            if self._datagram_index is None:
+                self._datagram_index = AllDatagramIndex.from_file(
+                    self.raw_file.path)
+            next_start = self._datagram_index.next_start(position)
+        stream = self.raw_file.stream
+        if next_start is None:
+            # read to the end to find where the data ends
+            stream.seek(position)
+            while len(stream.read(1024 * 1024)) > 0:
+                pass
+            next_start = stream.tell()
+
+        if len(self.corrupt_ranges) > 0 and \
+                self.corrupt_ranges[-1][1] == position:
+            self.corrupt_ranges[-1] = (self.corrupt_ranges[-1][0], next_start)
+        else:
+            self.corrupt_ranges.append((position, next_start))
+        stream.seek(next_start)
+
+    def _build_time_index(self) -> TimeIndex:
+        '''
+        Indexes the time and type of every valid datagram. Plain files are
+        memory mapped and their datagrams followed by length, only searching
+        for valid datagrams past a corrupt one. Compressed files and
+        archive members are read up to the first invalid datagram.
+        '''
+        if not self.raw_file.is_plain_file:
+            with open_raw_file(self.file_path) as raw_file:
+                return walk_headers(raw_file.stream, _parse_all_header)
+
+        buffer = map_file(self.raw_file.path)
+        index = self._datagram_index
+        if index is None:
+            index = AllDatagramIndex.from_lengths(buffer)
+        starts = index.starts
+        types = buffer[starts + 5].view('S1').astype('U1')
+        times = _all_timestamps(
+            read_uint32(buffer, starts + 8), read_uint32(buffer, starts + 12))
+        return TimeIndex(starts, types, times, index.ends - starts)
+
+    def _datagram_counters(self, index: TimeIndex) -> np.ndarray:
+        '''
+        Reads the counter from the header of each datagram. Compressed
+        files and archive members would have to be decompressed again, so
+        give -1.
+        '''
+        if not self.raw_file.is_plain_file:
+            return Scan._datagram_counters(self, index)
+        buffer = map_file(self.raw_file.path)
+        offsets = index.offsets
+        return buffer[offsets + 16].astype(np.int64) | \
+            (buffer[offsets + 17].astype(np.int64) << 8)
+
+    def position_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the time, latitude, longitude and heading of each position (P)
+        datagram read by the scan as columns.
+        '''
+        p_datagrams = self.datagrams.get('P', [])
+        return {
+            'time': _all_timestamps(
+                np.array([d.RecordDate for d in p_datagrams], dtype=np.int64),
+                np.array([d.Time for d in p_datagrams]) * 1000.0),
+            'latitude': np.array([d.Latitude for d in p_datagrams]),
+            'longitude': np.array([d.Longitude for d in p_datagrams]),
+            'heading': np.array([d.Heading for d in p_datagrams]),
+        }
+
+    def attitude_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the time, roll, pitch, heave and heading of each sample in the
+        attitude (A) datagrams read by the scan as columns.
+        '''
+        # each sample is the date, time, sensor status, roll, pitch, heave
+        # and heading
+        samples = np.array([
+            sample[:7]
+            for datagram in self.datagrams.get('A', [])
+            for sample in datagram.Attitude
+        ], dtype=np.float64).reshape(-1, 7)
+        return {
+            'time': _all_timestamps(
+                samples[:, 0].astype(np.int64), samples[:, 1] * 1000.0),
+            'roll': samples[:, 3],
+            'pitch': samples[:, 4],
+            'heave': samples[:, 5],
+            'heading': samples[:, 6],
+        }
+
+    def _read_datagram_at(self, offset: int):
+        self.all_reader.fileptr.seek(offset)
+        dg_type, datagram = self.all_reader.readDatagram()
+        datagram.read()
+        return dg_type, datagram
 
     def get_installation_parameters(self):
         '''
@@ -211,7 +457,7 @@ class ScanALL(Scan):
                     "'I' datagram not found, cannot extract original filename"]
             )
 
-        base_fn = os.path.basename(self.file_path)
+        base_fn = raw_file_name(self.file_path)
 
         found_filenames = []
         installationParametersDatagrams = self.datagrams['I']
@@ -259,7 +505,7 @@ class ScanALL(Scan):
                     "'I' datagram not found, cannot extract startTime"]
             )
 
-        base_fn = os.path.basename(self.file_path)
+        base_fn = raw_file_name(self.file_path)
 
         installationParametersDatagrams = self.datagrams['I']
         # assume we just use the first one we find
@@ -645,38 +891,6 @@ class ScanALL(Scan):
                 data=data
             )
 
-    def __dg_to_dict(self, datagram) -> Dict:
-        '''
-        Utils function to convert a datagram into a python
-        dict that can be serialised. The assumption is that all attributes
-        not starting with "__" are json serialisable and this may not be
-        the case.
-        '''
-        # ignore the following attributes. They are either unecessary or
-        # are know to not be json serialisable.
-        ignore_attrs = {
-            'offset',
-            'fileptr',
-            'data',
-            'typeOfDatagram',
-            'numberOfBytes',
-            'header',
-            'parameters',
-            'read',
-        }
-        dg_dict = {}
-        # get a list of all the attributes
-        attrs = [
-            a
-            for a in dir(datagram)
-            if not (a.startswith('__') or a in ignore_attrs)
-        ]
-        # loop through each attribute and add it to the dict
-        for attr in attrs:
-            value = getattr(datagram, attr)
-            dg_dict[attr] = value
-        return dg_dict
-
     def _merge_position(self, positions: List, to_merge_list: List):
         '''
         Adds position (Latitude and Longitude) to the `to_merge` list based
@@ -719,14 +933,9 @@ class ScanALL(Scan):
                 messages="Runtime parameters datagram (R) not found in file",
                 data={})
 
-        r_datagrams = self.datagrams['R']
-        runtime_parameters = []
-        string = ""
-        for r_datagram in r_datagrams:
-            if r_datagram.parameters() != string:
-                dg_dict = self.__dg_to_dict(r_datagram)
-                runtime_parameters.append(dg_dict)
-                string = r_datagram.parameters()
+        # only the R datagrams where the parameters changed are kept by the
+        # scan
+        runtime_parameters = datagrams_to_dicts(self.datagrams['R'])
 
         data = {}
 
@@ -784,6 +993,14 @@ class ScanALL(Scan):
             data=data
         )
 
+    def datagram_integrity(self) -> ScanResult:
+        '''
+        Verifies the ETX and checksum of every datagram in the file. Fails
+        if any datagram is bad, or part of the file couldn't be read as
+        datagrams.
+        '''
+        return self._check_integrity(verify_all)
+
     def installation_parameters(self) -> ScanResult:
         '''
         Extracts installation parameters from datagram (of same name).
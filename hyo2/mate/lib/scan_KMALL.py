@@ -5,111 +5,291 @@ from geojson import Feature, Point, FeatureCollection, LineString
 from geojson.mapping import to_mapping
 from typing import List, Dict
 import functools
-import os
 import struct
+import sys
+import numpy as np
 from KMALL.kmall import kmall
 
 from hyo2.mate.lib.scan import Scan, A_NONE, A_PARTIAL, A_FULL, A_FAIL, A_PASS
 from hyo2.mate.lib.scan import ScanState, ScanResult
+from hyo2.mate.lib.raw_file import raw_file_name, open_raw_file
+from hyo2.mate.lib.integrity import verify_kmall, KMALL_MIN_LENGTH, \
+    find_kmall_candidates
+from hyo2.mate.lib.time_index import TimeIndex, walk_headers
+
+
+def _parse_kmall_header(header: bytes):
+    '''
+    Gets the size, type and time of a datagram from its header, or None if
+    the header isn't valid. Used to build a `TimeIndex`.
+    '''
+    if len(header) < 20:
+        return None
+    num_bytes, dgm_type, _, _, _, time_sec, time_nanosec = \
+        struct.unpack_from('<I4sBBHII', header)
+    if dgm_type[0:1] != b'#' or num_bytes < KMALL_MIN_LENGTH:
+        return None
+    dg_type = dgm_type[1:].decode('ascii', errors='replace')
+    return num_bytes, dg_type, time_sec + time_nanosec / 1e9
+
+
+def _kmall_header_info(header: bytes):
+    '''
+    Gets the type, time and echo sounder model of a datagram from its
+    header, or None if the header isn't valid. The serial number isn't
+    recorded in the header. Used by `Scan.quick_info`.
+    '''
+    parsed = _parse_kmall_header(header)
+    if parsed is None:
+        return None
+    _, dg_type, time = parsed
+    echo_sounder_id = struct.unpack_from('<H', header, 10)[0]
+    return dg_type, time, echo_sounder_id, None
 
 
 class ScanKMALL(Scan):
     '''
     A Scan object that contains check information on the contents of a Kongsberg .all file
 
-    :param file_path: The file path to the .all file
+    :param file_path: The file path to the .kmall file, may be compressed
+        (eg; .kmall.zst) or a member of an archive (eg; survey.zip!/l.kmall)
     :type file_path: str
+    :param read_ahead: Read the file in large blocks in a background thread
+    :type read_ahead: bool, optional
     '''
 
-    def __init__(self, file_path):
+    ping_datagram_types = ['MRZ']
+    # installation parameters, holding the date of the file
+    metadata_datagram_types = ['IIP']
+
+    def __init__(self, file_path, read_ahead=False):
         Scan.__init__(self, file_path)
-        self.reader = open(self.file_path, 'rb')
-        self.kmall_reader = kmall(self.file_path)
-
-    def scan_datagram(self, progress_callback=None):
-        '''scan data to extract basic information for each type of datagram'''
-
-        # summary type information stored in plain dict
-        self.scan_result = {}
-        # datagram objects
-        self.datagrams = {}
-        while not self.kmall_reader.eof:
-            # update progress
-            if self.kmall_reader.FID is not None:
-                self.progress = 1.0 - ((self.kmall_reader.file_size - self.kmall_reader.FID.tell()) / self.kmall_reader.file_size)
-                if progress_callback is not None:
-                    progress_callback(self.progress)
-
-            # read datagram information
-            self.kmall_reader.decode_datagram()
-            dg_type = self.kmall_reader.datagram_ident
-            # Large amounts of data in MRZ packets in only reading
-            # header, common and ping data as full data not required
-            if dg_type == 'MRZ':
-                dg = {}
-                start = self.kmall_reader.FID.tell()
-                dg['header'] = self.kmall_reader.read_EMdgmHeader()
-                dg['partition'] = self.kmall_reader.read_EMdgmMpartition()
-                dg['cmnPart'] = self.kmall_reader.read_EMdgmMbody()
-                dg['pingInfo'] = self.kmall_reader.read_EMdgmMRZ_pingInfo()
-                numBytesDgm, dgmType, dgmVersion, dgm_version, systemID, \
-                    dgtime, dgdatetime = dg['header'].values()
-                self.kmall_reader.FID.seek(start + numBytesDgm, 0)
-            else:
-                self.kmall_reader.read_datagram()
-                numBytesDgm, dgmType, dgmVersion, dgm_version, systemID, \
-                    dgtime, dgdatetime = self.kmall_reader.datagram_data['header'].values()
-
-            if dg_type not in self.scan_result.keys():
-                self.scan_result[dg_type] = copy(self.default_info)
-                self.scan_result[dg_type]['_seqNo'] = None
-
-            self.scan_result[dg_type]['byteCount'] += numBytesDgm
-            self.scan_result[dg_type]['recordCount'] += 1
-            if self.scan_result[dg_type]['startTime'] is None:
-                self.scan_result[dg_type]['startTime'] = dgdatetime
-            self.scan_result[dg_type]['stopTime'] = dgdatetime
-
-            if dgmType == b'#IIP':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#IOP':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#IBE':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data['BISTText'])
-            if dgmType == b'#IBR':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data['BISTText'])
-            if dgmType == b'#IBS':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data['BISTText'])
-            if dgmType == b'#MRZ':
-                self._push_datagram(dg_type, dg)
-            if dgmType == b'#MWC':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SPO':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SKM':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SVP':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SVT':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SCL':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SDE':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#SHI':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#CPO':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#CHE':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-            if dgmType == b'#FCF':
-                self._push_datagram(dg_type, self.kmall_reader.datagram_data)
-
-        filename, totalpings, NpingsMissed, MissingMRZCount = self.kmall_reader.check_ping_count()
+        # datagrams are read through the raw file so that compressed files
+        # are decompressed, and archive members extracted, as they are read.
+        # The kmall reader only opens the file itself if it hasn't already
+        # been given one.
+        raw_file = self._open_raw_file(read_ahead)
+        self.kmall_reader = kmall(raw_file.disk_path)
+        self.kmall_reader.FID = raw_file.stream
+        if raw_file.size is None:
+            # size of the decompressed data isn't known until the end of it
+            # has been read
+            self.kmall_reader.file_size = sys.maxsize
+        else:
+            self.kmall_reader.file_size = raw_file.size
+
+    def close(self):
+        '''close the .kmall file and release decoded datagrams'''
+        # the kmall reader may have opened the file itself (eg; to index it)
+        if self.kmall_reader.FID is not None:
+            self.kmall_reader.FID.close()
+            self.kmall_reader.FID = None
+        Scan.close(self)
+
+    def scan_datagram(
+            self, progress_callback=None, is_stopped=None, incremental=False):
+        '''
+        scan data to extract basic information for each type of datagram.
+        With `incremental` only the datagrams appended to the file since the
+        last incremental scan are read, see `Scan.scan_datagram`.
+        '''
+        if not self._scan_datagrams(
+                progress_callback, is_stopped, incremental):
+            return
+        if 'MRZ' not in self.scan_result:
+            return
+
+        if incremental:
+            # pings and fans have been counted as the MRZ datagrams were
+            # read, which carries over from one incremental scan to the next
+            mrz_info = self.scan_result['MRZ']
+            mrz_info['missingPackets'] = \
+                mrz_info['_missingFans'] + mrz_info['_pingFans']
+            return
+        # counted from the MRZ datagrams already read, rather than having the
+        # kmall reader re-read the whole file
+        totalpings, NpingsMissed, MissingMRZCount = self._count_mrz_pings()
         self.scan_result['MRZ']['missedPings'] = NpingsMissed
         self.scan_result['MRZ']['pingCount'] = totalpings
         self.scan_result['MRZ']['missingPackets'] = MissingMRZCount
-        return
+
+    def _update_size(self, size):
+        self.kmall_reader.file_size = size
+        # the reader flags the end of the file once it has reached it
+        self.kmall_reader.eof = False
+
+    def _scan_next(self):
+        '''
+        Reads the datagram at the current position in the file, adding its
+        details to the scan results
+        '''
+        # read datagram information
+        self.kmall_reader.decode_datagram()
+        dg_type = self.kmall_reader.datagram_ident
+        # Large amounts of data in MRZ packets in only reading
+        # header, common and ping data as full data not required
+        if dg_type == 'MRZ':
+            dg = {}
+            start = self.kmall_reader.FID.tell()
+            dg['header'] = self.kmall_reader.read_EMdgmHeader()
+            dg['partition'] = self.kmall_reader.read_EMdgmMpartition()
+            dg['cmnPart'] = self.kmall_reader.read_EMdgmMbody()
+            dg['pingInfo'] = self.kmall_reader.read_EMdgmMRZ_pingInfo()
+            numBytesDgm, dgmType, dgmVersion, dgm_version, systemID, \
+                dgtime, dgdatetime = dg['header'].values()
+            self.kmall_reader.FID.seek(start + numBytesDgm, 0)
+        else:
+            self.kmall_reader.read_datagram()
+            numBytesDgm, dgmType, dgmVersion, dgm_version, systemID, \
+                dgtime, dgdatetime = self.kmall_reader.datagram_data['header'].values()
+
+        if dg_type not in self.scan_result.keys():
+            self.scan_result[dg_type] = copy(self.default_info)
+            self.scan_result[dg_type]['_seqNo'] = None
+
+        self.scan_result[dg_type]['byteCount'] += numBytesDgm
+        self.scan_result[dg_type]['recordCount'] += 1
+        if self.scan_result[dg_type]['startTime'] is None:
+            self.scan_result[dg_type]['startTime'] = dgdatetime
+        self.scan_result[dg_type]['stopTime'] = dgdatetime
+
+        if dgmType == b'#IIP':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#IOP':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#IBE':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data['BISTText'])
+        if dgmType == b'#IBR':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data['BISTText'])
+        if dgmType == b'#IBS':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data['BISTText'])
+        if dgmType == b'#MRZ':
+            self._push_datagram(dg_type, dg)
+        if dgmType == b'#MWC':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SPO':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SKM':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SVP':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SVT':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SCL':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SDE':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#SHI':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#CPO':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#CHE':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+        if dgmType == b'#FCF':
+            self._push_datagram(dg_type, self.kmall_reader.datagram_data)
+
+        if dgmType == b'#MRZ':
+            # pings are counted as they're read for sampled scans, a full
+            # scan counts them again once the whole file has been read
+            ping_counter = dg['cmnPart']['pingCnt']
+            last_counter = self.scan_result[dg_type]['_seqNo']
+            # kept for comparing the ping counters of consecutive files
+            self.scan_result[dg_type].setdefault('_firstSeqNo', ping_counter)
+            # fans missing from the pings before the current one, and the
+            # fans of the current ping not yet read
+            self.scan_result[dg_type].setdefault('_missingFans', 0)
+            self.scan_result[dg_type].setdefault('_pingFans', 0)
+            if last_counter is None or ping_counter != last_counter:
+                self.scan_result[dg_type]['pingCount'] += 1
+                self.scan_result[dg_type]['_missingFans'] += \
+                    self.scan_result[dg_type]['_pingFans']
+                self.scan_result[dg_type]['_pingFans'] = \
+                    dg['cmnPart']['rxFansPerPing']
+            self.scan_result[dg_type]['_pingFans'] -= 1
+            if last_counter is not None:
+                # ping counter is a uint16 that wraps around
+                step = (ping_counter - last_counter) % 65536
+                if 0 < step < 32768:
+                    self.scan_result[dg_type]['missedPings'] += step - 1
+            self.scan_result[dg_type]['_seqNo'] = ping_counter
+
+    def _more_datagrams(self) -> bool:
+        return not self.kmall_reader.eof and not self.raw_file.at_end()
+
+    def _find_candidates(self, buffer):
+        return find_kmall_candidates(buffer)
+
+    def _header_info(self, header):
+        return _kmall_header_info(header)
+
+    def _count_mrz_pings(self):
+        '''
+        Counts pings from the MRZ datagrams read by the scan, rather than
+        re-reading the file.
+
+        :return: tuple of the number of pings, the number of pings missed
+            (gaps in the ping counter) and the number of MRZ datagrams
+            missing from the pings that were found (each ping has one MRZ
+            datagram per receive fan)
+        '''
+        fans_per_ping = {}
+        fans_found = {}
+        for dg in self.datagrams.get('MRZ', []):
+            ping_counter = dg['cmnPart']['pingCnt']
+            fans_per_ping[ping_counter] = dg['cmnPart']['rxFansPerPing']
+            fans_found[ping_counter] = fans_found.get(ping_counter, 0) + 1
+
+        missed = 0
+        last_counter = None
+        for dg in self.datagrams.get('MRZ', []):
+            ping_counter = dg['cmnPart']['pingCnt']
+            if last_counter is not None:
+                # ping counter is a uint16 that wraps around
+                step = (ping_counter - last_counter) % 65536
+                if 0 < step < 32768:
+                    missed += step - 1
+            last_counter = ping_counter
+
+        missing_packets = sum(
+            fans_per_ping[ping_counter] - fans_found[ping_counter]
+            for ping_counter in fans_found
+        )
+        return len(fans_found), missed, missing_packets
+
+    def _build_time_index(self) -> TimeIndex:
+        '''
+        Indexes the time and type of every datagram, reading only the
+        datagram headers, up to the first invalid datagram.
+        '''
+        with open_raw_file(self.file_path) as raw_file:
+            return walk_headers(raw_file.stream, _parse_kmall_header)
+
+    def position_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the time, latitude and longitude of each position (SPO)
+        datagram read by the scan as columns.
+        '''
+        p_datagrams = self.datagrams.get('SPO', [])
+        return {
+            'time': np.array(
+                [d['header']['dgtime'] for d in p_datagrams],
+                dtype=np.float64),
+            'latitude': np.array(
+                [d['sensorData']['correctedLat_deg'] for d in p_datagrams],
+                dtype=np.float64),
+            'longitude': np.array(
+                [d['sensorData']['correctedLong_deg'] for d in p_datagrams],
+                dtype=np.float64),
+        }
+
+    def _read_datagram_at(self, offset: int):
+        self.kmall_reader.FID.seek(offset, 0)
+        self.kmall_reader.decode_datagram()
+        self.kmall_reader.read_datagram()
+        return (
+            self.kmall_reader.datagram_ident,
+            self.kmall_reader.datagram_data
+        )
 
     def get_installation_parameters(self):
         '''
@@ -130,6 +310,14 @@ class ScanKMALL(Scan):
 
         return None
 
+    def datagram_integrity(self) -> ScanResult:
+        '''
+        Verifies the length repeated at the end of every datagram in the
+        file matches the length at the start. Fails if any datagram is bad,
+        or part of the file couldn't be read as datagrams.
+        '''
+        return self._check_integrity(verify_kmall)
+
     def installation_parameters(self) -> ScanResult:
         '''
         Gets the installation parameters in a ScanResult format
@@ -201,7 +389,7 @@ class ScanKMALL(Scan):
                     "'IIP' datagram not found, cannot extract startTime"]
             )
 
-        base_fn = os.path.basename(self.file_path)
+        base_fn = raw_file_name(self.file_path)
 
         installationParametersDatagrams = self.datagrams['IIP']
         # assume we just use the first one we find
@@ -561,38 +749,6 @@ class ScanKMALL(Scan):
                 data=data
             )
 
-    def __dg_to_dict(self, datagram) -> Dict:
-        '''
-        Utils function to convert a datagram into a python
-        dict that can be serialised. The assumption is that all attributes
-        not starting with "__" are json serialisable and this may not be
-        the case.
-        '''
-        # ignore the following attributes. They are either unecessary or
-        # are know to not be json serialisable.
-        ignore_attrs = {
-            'offset',
-            'fileptr',
-            'data',
-            'typeOfDatagram',
-            'numberOfBytes',
-            'header',
-            'parameters',
-            'read',
-        }
-        dg_dict = {}
-        # get a list of all the attributes
-        attrs = [
-            a
-            for a in dir(datagram)
-            if not (a.startswith('__') or a in ignore_attrs)
-        ]
-        # loop through each attribute and add it to the dict
-        for attr in attrs:
-            value = getattr(datagram, attr)
-            dg_dict[attr] = value
-        return dg_dict
-
     def _merge_position(self, positions: List, to_merge_list: List):
         '''
         Adds position (Latitude and Longitude) to the `to_merge` list based
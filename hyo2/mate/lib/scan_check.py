@@ -1,6 +1,12 @@
-from typing import List
+from typing import Any, Dict, List
 
+import numpy as np
+
+from hyo2.mate.lib.continuity import check_continuity, \
+    DEFAULT_MAX_TIME_GAP, DEFAULT_MAX_PING_GAP
 from hyo2.mate.lib.scan import Scan, ScanResult, ScanState
+from hyo2.mate.lib.track_index import check_tracks, simplify_track, \
+    DEFAULT_SIMPLIFY_TOLERANCE
 from ausseabed.qajson.model import QajsonParam, QajsonOutputs
 
 
@@ -8,11 +14,19 @@ class ScanCheck:
     # list including default params to be used for the check
     # objects included in list will have a `name` and `value` attribute
     default_params = []
+    # True if the check only needs the metadata datagrams read by
+    # `Scan.scan_metadata`, such as the installation parameters
+    metadata_only = False
+    # True if the check compares each file with the other files checked.
+    # `run_check` only gathers a `summary` of each file, the files are
+    # compared by `run_survey_check` once all of them have been scanned.
+    survey_level = False
 
     def __init__(self, scan: Scan, params: List[QajsonParam]):
         self.scan = scan
         self.params = params
         self._output = None  # QajsonOutputs
+        self.summary = None
 
     @property
     def output(self) -> QajsonOutputs:
@@ -41,6 +55,54 @@ class ScanCheck:
         """
         raise NotImplementedError("run_check must be overwritten")
 
+    @classmethod
+    def run_survey_check(
+            cls,
+            summaries: Dict[str, Any],
+            params: List[QajsonParam]) -> Dict[str, QajsonOutputs]:
+        """Compares the files of a survey level check.
+
+        Args:
+            summaries (dict): `summary` gathered by `run_check` from each
+                file, by file path
+            params (list): parameters of the check
+
+        Returns:
+            dict of the outputs for each file, by file path
+
+        Raises:
+            NotImplementedError: If the check is a survey level check and
+                this method has not been overwritten.
+        """
+        raise NotImplementedError("run_survey_check must be overwritten")
+
+    @classmethod
+    def _param_values(cls, params: List[QajsonParam]) -> Dict[str, Any]:
+        """Gets the value of each parameter, using the value in
+        `default_params` for those not given.
+        """
+        values = {p.name: p.value for p in cls.default_params}
+        values.update({p.name: p.value for p in params or []})
+        return values
+
+    @staticmethod
+    def _survey_outputs(results: Dict[str, Any]) -> Dict[str, QajsonOutputs]:
+        """Builds the outputs of each file from the results of a survey level
+        check, each having a `state`, `messages` and `data`.
+        """
+        return {
+            path: QajsonOutputs(
+                execution=None,
+                files=None,
+                count=None,
+                percentage=None,
+                messages=result.messages,
+                data=result.data,
+                check_state=result.state
+            )
+            for path, result in results.items()
+        }
+
 
 class FilenameChangedCheck(ScanCheck):
     """Checks if the name of the file matches that recorded in the metadata/
@@ -49,6 +111,7 @@ class FilenameChangedCheck(ScanCheck):
     id = '7761e08b-1380-46fa-a7eb-f1f41db38541'
     name = "Filename checked"
     version = '1'
+    metadata_only = True
 
     def __init__(self, scan: Scan, params):
         ScanCheck.__init__(self, scan, params)
@@ -74,6 +137,7 @@ class DateChangedCheck(ScanCheck):
     id = '4a3f3371-3a21-44f2-93cf-d9ed19d0c002'
     name = "Date checked"
     version = '1'
+    metadata_only = True
 
     def __init__(self, scan: Scan, params):
         ScanCheck.__init__(self, scan, params)
@@ -214,7 +278,7 @@ class MinimumPingCheck(ScanCheck):
 class EllipsoidHeightAvailableCheck(ScanCheck):
     """Checks Ellipsoid Height is available.
     """
-    id = 'bbce47c0-54c9-4c60-8de8-b174a8905091'
+    id = '7448ab91-ab97-4dd4-905a-8337b4b9d792'
     name = "Ellipsoid Height Available"
     version = '1'
 
@@ -386,6 +450,7 @@ class InstallationParametersCheck(ScanCheck):
     id = '9e2d78aa-cdc1-4d15-9ac1-6f8e6aa0891d'
     name = "Installation Parameters"
     version = '1'
+    metadata_only = True
 
     def __init__(self, scan: Scan, params):
         ScanCheck.__init__(self, scan, params)
@@ -402,3 +467,106 @@ class InstallationParametersCheck(ScanCheck):
             data=scan_result.data,
             check_state=scan_result.state
         )
+
+
+class DatagramIntegrityCheck(ScanCheck):
+    '''
+    Verifies every datagram is complete and uncorrupted (ETX and checksum
+    for .all files, the repeated length for .kmall files)
+    '''
+    id = '6fa05300-1838-48bd-acd8-7a86241f4331'
+    name = "Datagram Integrity"
+    version = '1'
+
+    def __init__(self, scan: Scan, params):
+        ScanCheck.__init__(self, scan, params)
+
+    def run_check(self):
+        scan_result = self.scan.datagram_integrity()
+
+        self._output = QajsonOutputs(
+            execution=None,
+            files=None,
+            count=None,
+            percentage=None,
+            messages=scan_result.messages,
+            data=scan_result.data,
+            check_state=scan_result.state
+        )
+
+
+class LineContinuityCheck(ScanCheck):
+    '''
+    Checks each line follows on from the line before it. Files are ordered
+    by start time and the ping counters and times at the end of each file
+    compared with the start of the next, flagging gaps, overlaps and
+    duplicate files.
+    '''
+    id = '231f063b-74f7-43d4-bc9f-c8159f4af4f7'
+    name = "Line Continuity"
+    version = '1'
+    survey_level = True
+    default_params = [
+        QajsonParam(name='max_time_gap', value=DEFAULT_MAX_TIME_GAP),
+        QajsonParam(name='max_ping_gap', value=DEFAULT_MAX_PING_GAP),
+    ]
+
+    def __init__(self, scan: Scan, params):
+        ScanCheck.__init__(self, scan, params)
+
+    def run_check(self):
+        # taken from the scan results, so no more of the file is read
+        self.summary = self.scan.ping_bounds()
+
+    @classmethod
+    def run_survey_check(cls, summaries, params):
+        values = cls._param_values(params)
+        results = check_continuity(
+            summaries,
+            float(values['max_time_gap']),
+            int(values['max_ping_gap']))
+        return cls._survey_outputs(results)
+
+
+class SurveyTracksCheck(ScanCheck):
+    '''
+    Compares the tracks of the lines of a survey, reporting the lines each
+    line crosses, its nearest neighbouring line and, if a maximum line
+    spacing is given, the parts of it too far from any other line. Only a
+    simplified track of each file is kept, held in a grid index so that only
+    nearby parts of the tracks are compared.
+    '''
+    id = 'afe9b667-f878-45fc-bd5e-a55ac7cee2c3'
+    name = "Survey Tracks"
+    version = '1'
+    survey_level = True
+    default_params = [
+        QajsonParam(
+            name='simplify_tolerance', value=DEFAULT_SIMPLIFY_TOLERANCE),
+        QajsonParam(name='max_line_spacing', value=None),
+    ]
+
+    def __init__(self, scan: Scan, params):
+        ScanCheck.__init__(self, scan, params)
+
+    def run_check(self):
+        tolerance_param = self.get_param('simplify_tolerance')
+        tolerance = DEFAULT_SIMPLIFY_TOLERANCE if tolerance_param is None \
+            else float(tolerance_param.value)
+        try:
+            positions = self.scan.position_table()
+        except NotImplementedError:
+            # the survey check warns about files without a track
+            self.summary = None
+            return
+        self.summary = simplify_track(
+            np.column_stack([positions['longitude'], positions['latitude']]),
+            tolerance)
+
+    @classmethod
+    def run_survey_check(cls, summaries, params):
+        max_line_spacing = cls._param_values(params)['max_line_spacing']
+        results = check_tracks(
+            summaries,
+            None if max_line_spacing is None else float(max_line_spacing))
+        return cls._survey_outputs(results)
@@ -3,12 +3,86 @@ from geojson import Feature, Point, FeatureCollection, LineString
 from geojson.mapping import to_mapping
 from typing import List, Dict
 from copy import copy
-import os
+import struct
+import sys
 import pygsf
 import functools
+import numpy as np
 
 from hyo2.mate.lib.scan import Scan
 from hyo2.mate.lib.scan import ScanState, ScanResult
+from hyo2.mate.lib.raw_file import raw_file_name, open_raw_file
+from hyo2.mate.lib.format_detect import GSF_RECORD_ID_MASK, \
+    GSF_CHECKSUM_FLAG
+from hyo2.mate.lib.integrity import MAX_DATAGRAM_SIZE
+from hyo2.mate.lib.serialise import datagram_attributes, datagrams_to_dicts
+from hyo2.mate.lib.time_index import TimeIndex, walk_headers, \
+    to_timestamp
+
+# largest GSF record identifier
+GSF_MAX_RECORD_ID = 12
+
+
+def _parse_gsf_header(header: bytes):
+    '''
+    Gets the size, record identifier and time of a record from its header,
+    or None if the header isn't valid. Every record other than the header
+    record starts with its time. Used to build a `TimeIndex`.
+    '''
+    if len(header) < 8:
+        return None
+    data_size, record_id = struct.unpack_from('>II', header)
+    header_size = 12 if record_id & GSF_CHECKSUM_FLAG else 8
+    record_id &= GSF_RECORD_ID_MASK
+    if not 1 <= record_id <= GSF_MAX_RECORD_ID or \
+            data_size > MAX_DATAGRAM_SIZE:
+        return None
+    time = None
+    if record_id != pygsf.HEADER and len(header) >= header_size + 8:
+        time_sec, time_nanosec = struct.unpack_from(
+            '>ii', header, header_size)
+        time = time_sec + time_nanosec / 1e9
+    return header_size + data_size, record_id, time
+
+
+def _gsf_parameters_bytes(record: bytes) -> bytes:
+    '''
+    Gets the data of a parameters record after its time (and the header
+    and checksum), so the parameters of records can be compared.
+    '''
+    _, record_id = struct.unpack_from('>II', record)
+    header_size = 12 if record_id & GSF_CHECKSUM_FLAG else 8
+    return record[header_size + 8:]
+
+
+def _find_gsf_candidates(buffer: np.ndarray):
+    '''
+    Finds every position in a buffer that could be the start of a GSF
+    record; a valid record identifier, with reserved bits clear, and a size
+    that is a multiple of four bytes. Records are aligned to four bytes so
+    the buffer must start at an offset in the file that is a multiple of
+    four.
+
+    :return: tuple of arrays of the start and end (exclusive) offset of each
+        candidate record, sorted by start
+    '''
+    word_count = len(buffer) // 4
+    if word_count < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    words = np.asarray(buffer[:word_count * 4]).view('>u4').astype(np.int64)
+    data_sizes = words[:-1]
+    record_ids = words[1:]
+    reserved = ~(GSF_RECORD_ID_MASK | GSF_CHECKSUM_FLAG) & 0xFFFFFFFF
+    masked_ids = record_ids & GSF_RECORD_ID_MASK
+    valid = (masked_ids >= 1) & (masked_ids <= GSF_MAX_RECORD_ID) & \
+        (record_ids & reserved == 0) & (data_sizes % 4 == 0) & \
+        (data_sizes <= MAX_DATAGRAM_SIZE)
+    indexes = np.flatnonzero(valid)
+    header_sizes = np.where(record_ids[indexes] & GSF_CHECKSUM_FLAG, 12, 8)
+    starts = indexes * 4
+    ends = starts + header_sizes + data_sizes[indexes]
+    in_buffer = ends <= len(buffer)
+    return starts[in_buffer], ends[in_buffer]
 
 
 class ScanGsf(Scan):
@@ -16,70 +90,161 @@ class ScanGsf(Scan):
     A Scan object that contains check information on the contents of a 
     Generic Sensor Format .gsf file
     
-    :param file_path: The file path to the .gsf file
+    :param file_path: The file path to the .gsf file, may be compressed
+        (eg; .gsf.bz2) or a member of an archive (eg; survey.zip!/line.gsf)
     :type file_path: str
+    :param read_ahead: Read the file in large blocks in a background thread
+    :type read_ahead: bool, optional
     '''
 
-    def __init__(self, file_path):
+    ping_datagram_types = [pygsf.SWATH_BATHYMETRY]
+    # installation parameters are held in the processing parameters, and
+    # the date is taken from the first ping
+    metadata_datagram_types = [
+        pygsf.PROCESSING_PARAMETERS, pygsf.SWATH_BATHYMETRY]
+
+    def __init__(self, file_path, read_ahead=False):
         Scan.__init__(self, file_path)
-        self.reader = pygsf.GSFREADER(file_path)
-
-    def scan_datagram(self, progress_callback=None):
-        '''scan data to extract basic information for each type of datagram'''
-
-        # summary type information stored in plain dict
-        self.scan_result = {}
-        # datagram objects
-        self.datagrams = {}
-        while self.reader.moreData():
-            # update progress
-            self.progress = 1.0 - (self.reader.moreData() / self.file_size)
-            #print(self.progress)
-            if progress_callback is not None:
-                progress_callback(self.progress)
-
-            number_of_bytes, record_identifier, datagram = \
-                self.reader.readDatagram()
-            
-            if record_identifier not in self.scan_result.keys():
-                self.scan_result[record_identifier] = copy(self.default_info)
-                self.scan_result[record_identifier]['_seqNo'] = None
-                
-            # save datagram info
-            self.scan_result[record_identifier]['byteCount'] += number_of_bytes
-            self.scan_result[record_identifier]['recordCount'] += 1
+        # records are read through the raw file so that compressed files
+        # are decompressed, and archive members extracted, as they are read
+        raw_file = self._open_raw_file(read_ahead)
+        self.reader = pygsf.GSFREADER(raw_file.disk_path)
+        self.reader.fileptr.close()
+        self.reader.fileptr = raw_file.stream
+        if raw_file.size is None:
+            # size of the decompressed data isn't known until the end of it
+            # has been read
+            self.reader.fileSize = sys.maxsize
+        else:
+            self.reader.fileSize = raw_file.size
 
-            if record_identifier == pygsf.PROCESSING_PARAMETERS:
-                datagram.read()
-                self._push_datagram(record_identifier, datagram)
-            elif record_identifier == pygsf.SENSOR_PARAMETERS:
-                datagram.read()
-                self._push_datagram(record_identifier, datagram)
-            elif record_identifier == pygsf.HEADER:
-                datagram.read()
-                self._push_datagram(record_identifier, datagram)
-            elif record_identifier == pygsf.SWATH_BATHYMETRY:
+    def close(self):
+        '''close the .gsf file and release decoded datagrams'''
+        self.reader.close()
+        Scan.close(self)
+
+    def scan_datagram(
+            self, progress_callback=None, is_stopped=None, incremental=False):
+        '''
+        scan data to extract basic information for each type of datagram.
+        With `incremental` only the records appended to the file since the
+        last incremental scan are read, see `Scan.scan_datagram`.
+        '''
+        self._scan_datagrams(progress_callback, is_stopped, incremental)
+
+    def _update_size(self, size):
+        self.reader.fileSize = size
+
+    def _datagram_available(self):
+        # the size in the record header is big endian, and doesn't include
+        # the header itself
+        stream = self.raw_file.stream
+        position = stream.tell()
+        header = stream.read(8)
+        stream.seek(position)
+        if len(header) < 8:
+            return False
+        parsed = _parse_gsf_header(header)
+        if parsed is None:
+            # corrupt rather than partly written, the reader deals with this
+            return True
+        return position + parsed[0] <= self.data_size
+
+    def _scan_next(self):
+        '''
+        Reads the record at the current position in the file, adding its
+        details to the scan results
+        '''
+        record_start = self.raw_file.stream.tell()
+        number_of_bytes, record_identifier, datagram = \
+            self.reader.readDatagram()
+
+        if record_identifier not in self.scan_result.keys():
+            self.scan_result[record_identifier] = copy(self.default_info)
+            self.scan_result[record_identifier]['_seqNo'] = None
+
+        # save datagram info
+        self.scan_result[record_identifier]['byteCount'] += number_of_bytes
+        self.scan_result[record_identifier]['recordCount'] += 1
+
+        if record_identifier == pygsf.PROCESSING_PARAMETERS:
+            datagram.read()
+            self._push_datagram(record_identifier, datagram)
+        elif record_identifier == pygsf.SENSOR_PARAMETERS:
+            # sensor parameters are only decoded where their bytes differ
+            # from those of the last sensor parameters record, and kept
+            # where their parameters differ
+            payload = _gsf_parameters_bytes(
+                self._read_datagram_bytes(record_start))
+            if self._parameters_changed(record_identifier, payload):
                 datagram.read()
-                if self.scan_result[record_identifier]['startTime'] is None:
-                    self.scan_result[record_identifier]['startTime'] = \
-                    datagram.currentRecordDateTime()
-                self.scan_result[record_identifier]['stopTime'] = \
+                self._push_changed_parameters(record_identifier, datagram)
+        elif record_identifier == pygsf.HEADER:
+            datagram.read()
+            self._push_datagram(record_identifier, datagram)
+        elif record_identifier == pygsf.SWATH_BATHYMETRY:
+            datagram.read()
+            if self.scan_result[record_identifier]['startTime'] is None:
+                self.scan_result[record_identifier]['startTime'] = \
                 datagram.currentRecordDateTime()
-                self._push_datagram(record_identifier, datagram)
-            elif record_identifier == pygsf.SWATH_BATHY_SUMMARY:
-                datagram.read()
-                self._push_datagram(record_identifier, datagram)
-            elif record_identifier == pygsf.ATTITUDE_DATA:
-                datagram.read()
-                self._push_datagram(record_identifier, datagram)
-            elif record_identifier == pygsf.SOUND_VELOCITY:
-                datagram.read()
-                self._push_datagram(record_identifier, datagram)
-        self.scan_result[pygsf.SWATH_BATHYMETRY]['pingCount'] = \
-        self.reader.getrecordcount()      
-        
-        return
-        
+            self.scan_result[record_identifier]['stopTime'] = \
+            datagram.currentRecordDateTime()
+            self._push_datagram(record_identifier, datagram)
+        elif record_identifier == pygsf.SWATH_BATHY_SUMMARY:
+            datagram.read()
+            self._push_datagram(record_identifier, datagram)
+        elif record_identifier == pygsf.ATTITUDE_DATA:
+            datagram.read()
+            self._push_datagram(record_identifier, datagram)
+        elif record_identifier == pygsf.SOUND_VELOCITY:
+            datagram.read()
+            self._push_datagram(record_identifier, datagram)
+
+        if record_identifier == pygsf.SWATH_BATHYMETRY:
+            # each swath bathymetry record is a ping
+            self.scan_result[record_identifier]['pingCount'] += 1
+
+    def _find_candidates(self, buffer):
+        return _find_gsf_candidates(buffer)
+
+    def _header_info(self, header):
+        # the sonar model is only recorded in the body of each ping
+        parsed = _parse_gsf_header(header)
+        if parsed is None:
+            return None
+        _, record_id, time = parsed
+        return record_id, time, None, None
+
+    def _build_time_index(self) -> TimeIndex:
+        '''
+        Indexes the time and identifier of every record, reading only the
+        record headers, up to the first invalid record.
+        '''
+        with open_raw_file(self.file_path) as raw_file:
+            return walk_headers(raw_file.stream, _parse_gsf_header)
+
+    def position_table(self) -> Dict[str, np.ndarray]:
+        '''
+        Gets the time, latitude and longitude of each swath bathymetry
+        record read by the scan as columns.
+        '''
+        p_datagrams = self.datagrams.get(pygsf.SWATH_BATHYMETRY, [])
+        return {
+            'time': np.array(
+                [to_timestamp(d.currentRecordDateTime()) for d in p_datagrams],
+                dtype=np.float64),
+            'latitude': np.array(
+                [d.latitude for d in p_datagrams], dtype=np.float64),
+            'longitude': np.array(
+                [d.longitude for d in p_datagrams], dtype=np.float64),
+        }
+
+    def _read_datagram_at(self, offset: int):
+        self.reader.fileptr.seek(offset, 0)
+        number_of_bytes, record_identifier, datagram = \
+            self.reader.readDatagram()
+        datagram.read()
+        return record_identifier, datagram
 
     def get_installation_parameters(self):
         '''
@@ -127,7 +292,7 @@ class ScanGsf(Scan):
         first_date = first_swath_datagram.currentRecordDateTime()
         first_date_str = first_date.strftime('%Y%m%d')
 
-        base_fn = os.path.basename(self.file_path)
+        base_fn = raw_file_name(self.file_path)
         found = first_date_str in base_fn
 
         if found:
@@ -305,7 +470,13 @@ class ScanGsf(Scan):
         # tl;dr this cuts down on amount of code that was duplicated across
         # a number of check functions
         present_datagrams = self.datagrams
-        present_arrays = self.__dg_to_dict(self.datagrams[pygsf.SWATH_BATHYMETRY][0])
+        # only the presence of the arrays is needed, so they aren't
+        # converted to lists
+        swath = self.datagrams[pygsf.SWATH_BATHYMETRY][0]
+        present_arrays = {
+            name: getattr(swath, name, None)
+            for name in datagram_attributes(swath)
+        }
         # identify empty data arrays
         empty_data = [
             key
@@ -455,38 +626,6 @@ class ScanGsf(Scan):
             messages=["Check unable to be implemented for GSF format"]
         )
 
-    def __dg_to_dict(self, datagram) -> Dict:
-        '''
-        Utils function to convert a datagram into a python
-        dict that can be serialised. The assumption is that all attributes
-        not starting with "__" are json serialisable and this may not be
-        the case.
-        '''
-        # ignore the following attributes. They are either unecessary or
-        # are know to not be json serialisable.
-        ignore_attrs = {
-            'offset',
-            'fileptr',
-            'data',
-            'typeOfDatagram',
-            'numberOfBytes',
-            'header',
-            'parameters',
-            'read',
-        }
-        dg_dict = {}
-        # get a list of all the attributes
-        attrs = [
-            a
-            for a in dir(datagram)
-            if not (a.startswith('__') or a in ignore_attrs)
-        ]
-        # loop through each attribute and add it to the dict
-        for attr in attrs:
-            value = getattr(datagram, attr)
-            dg_dict[attr] = value
-        return dg_dict
-    
     def _merge_position(self, positions: List, to_merge_list: List):
         '''
         Adds position (Latitude and Longitude) to the `to_merge` list based
@@ -529,14 +668,10 @@ class ScanGsf(Scan):
                 messages="Sensor parameters record not found in file",
                 data={})
 
-        r_datagrams = self.datagrams[pygsf.SENSOR_PARAMETERS]
-        runtime_parameters = []
-        string = ""
-        for r_datagram in r_datagrams:
-            if r_datagram.parameters() != string:
-                dg_dict = self.__dg_to_dict(r_datagram)
-                runtime_parameters.append(dg_dict)
-                string = r_datagram.parameters()
+        # only the records where the parameters changed are kept by the
+        # scan
+        runtime_parameters = datagrams_to_dicts(
+            self.datagrams[pygsf.SENSOR_PARAMETERS])
 
         data = {}
 
@@ -598,6 +733,12 @@ class ScanGsf(Scan):
             data=data
         )
 
+    def datagram_integrity(self) -> ScanResult:
+        return ScanResult(
+            state=ScanState.WARNING,
+            messages=["Check unable to be implemented for GSF format"]
+        )
+
     def installation_parameters(self) -> ScanResult:
         '''
         Extracts installation parameters which are contained in the 
@@ -5,7 +5,7 @@ from hyo2.mate.lib.scan import Scan
 from hyo2.mate.lib.scan import ScanState, ScanResult
 
 
-class ScanTrueheave:
+class ScanTrueheave(Scan):
     '''scan a trueheave file and provide some indicators of the contents'''
 
     def __init__(self, file_path):
@@ -15,7 +15,7 @@ class ScanTrueheave:
         self.file_exits = None
         self.file_non_zero_size = None
 
-    def scan_datagram(self, progress_callback=None):
+    def scan_datagram(self, progress_callback=None, is_stopped=None):
         # we would normally read the file here and cache interesting data
         # to use in the checks, but for the SVP files checking to see if they
         # exist and have a non-zero size is sufficient.
@@ -27,4 +27,5 @@ class ScanTrueheave:
         else:
             self.file_non_zero_size = False
 
-        progress_callback(1.0)
+        if progress_callback is not None:
+            progress_callback(1.0)
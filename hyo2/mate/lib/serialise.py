@@ -0,0 +1,103 @@
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# attributes of the datagrams decoded by pyall and pygsf that aren't
+# serialised. They are either unnecessary or are known to not be JSON
+# serialisable.
+IGNORED_ATTRIBUTES = frozenset([
+    'offset',
+    'fileptr',
+    'data',
+    'typeOfDatagram',
+    'numberOfBytes',
+    'header',
+    'parameters',
+    'read',
+])
+
+# serialisable attributes of datagrams, by their class and the names of
+# their instance attributes
+_datagram_attributes: Dict[Tuple, Tuple[str, ...]] = {}
+
+
+def _is_serialised(name: str) -> bool:
+    return not (name.startswith('__') or name in IGNORED_ATTRIBUTES)
+
+
+def datagram_attributes(datagram) -> Tuple[str, ...]:
+    """ Gets the names of the serialisable attributes of a datagram; all
+    those not starting with "__" that aren't in `IGNORED_ATTRIBUTES`.
+    Datagrams of the same class can have different attributes (eg; a GSF
+    swath only has the arrays of the subrecords in its ping), so the names
+    are only looked up (with `dir`) for the first datagram of each class
+    with the same instance attributes.
+
+    Args:
+        datagram: decoded datagram
+
+    Returns:
+        tuple of the attribute names, in sorted order
+    """
+    key = (type(datagram), tuple(getattr(datagram, '__dict__', ())))
+    attributes = _datagram_attributes.get(key)
+    if attributes is None:
+        attributes = tuple(a for a in dir(datagram) if _is_serialised(a))
+        _datagram_attributes[key] = attributes
+    return attributes
+
+
+def _to_native(value: Any) -> Any:
+    """ Converts a NumPy array or scalar to the equivalent JSON native
+    value, leaving other values unchanged
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _column_to_native(values: List[Any]) -> List[Any]:
+    """ Converts the values of one attribute of many datagrams. A column of
+    NumPy scalars is converted with a single call.
+    """
+    if len(values) > 0 and all(isinstance(v, np.generic) for v in values):
+        return np.array(values).tolist()
+    return [_to_native(v) for v in values]
+
+
+def datagrams_to_dicts(datagrams: List[Any]) -> List[Dict[str, Any]]:
+    """ Converts datagrams into python dicts that can be serialised. The
+    assumption is that the attributes given by `datagram_attributes` are
+    json serialisable once NumPy values have been converted, and this may
+    not be the case.
+
+    Args:
+        datagrams (list): decoded datagrams, of any classes
+
+    Returns:
+        list of a dict of the attributes of each datagram, in the same order
+    """
+    dicts = [{} for _ in datagrams]
+    by_attributes = {}
+    for i, datagram in enumerate(datagrams):
+        by_attributes.setdefault(
+            datagram_attributes(datagram), []).append(i)
+    for attributes, indexes in by_attributes.items():
+        for name in attributes:
+            values = _column_to_native(
+                [getattr(datagrams[i], name, None) for i in indexes])
+            for i, value in zip(indexes, values):
+                dicts[i][name] = value
+    return dicts
+
+
+def datagram_to_dict(datagram) -> Dict[str, Any]:
+    """ Converts a datagram into a python dict that can be serialised, see
+    `datagrams_to_dicts`.
+    """
+    return {
+        name: _to_native(getattr(datagram, name, None))
+        for name in datagram_attributes(datagram)
+    }
@@ -0,0 +1,156 @@
+from datetime import datetime, timezone
+from typing import BinaryIO, Callable, Iterable, Optional, Tuple, Union
+
+import numpy as np
+
+# number of header bytes read at a time when walking a stream
+HEADER_READ_SIZE = 64
+
+
+def to_timestamp(value: Union[datetime, float, None]) -> Optional[float]:
+    '''
+    Converts a time to seconds since the unix epoch. Datetimes without a
+    timezone are taken to be UTC, as are the times recorded in raw files.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+class TimeIndex:
+    '''
+    Offsets of the datagrams in a raw file, sorted by time so the datagrams
+    recorded within a time window are found by binary search rather than by
+    reading the file.
+
+    :param offsets: offset of each datagram, in file order
+    :type offsets: numpy.ndarray
+    :param types: type of each datagram, as used for the `scan_result` keys
+    :type types: numpy.ndarray
+    :param times: time of each datagram in seconds since the unix epoch,
+        NaN for datagrams that don't record a time
+    :type times: numpy.ndarray
+    :param sizes: size of each datagram in bytes, if known
+    :type sizes: numpy.ndarray, optional
+    '''
+
+    def __init__(
+            self,
+            offsets: np.ndarray,
+            types: np.ndarray,
+            times: np.ndarray,
+            sizes: Optional[np.ndarray] = None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.types = np.asarray(types)
+        self.times = np.asarray(times, dtype=np.float64)
+        self.sizes = None if sizes is None else \
+            np.asarray(sizes, dtype=np.int64)
+        # stable, so datagrams with the same time stay in file order. NaN
+        # times are sorted to the end.
+        self._order = np.argsort(self.times, kind='stable')
+        self._sorted_times = self.times[self._order]
+        self._timed_count = int(np.count_nonzero(~np.isnan(self.times)))
+        # offsets of each type of datagram in file order, found when first
+        # needed
+        self._type_offsets = {}
+
+    @classmethod
+    def from_headers(
+            cls,
+            headers: Iterable[Tuple[int, object, Optional[float]]],
+            sizes: Optional[Iterable[int]] = None
+    ) -> 'TimeIndex':
+        '''
+        Builds an index from (offset, type, time) tuples given in file
+        order, and optionally the size of each datagram.
+        '''
+        offsets = []
+        types = []
+        times = []
+        for offset, dg_type, time in headers:
+            offsets.append(offset)
+            types.append(dg_type)
+            times.append(np.nan if time is None else time)
+        return cls(
+            np.array(offsets, dtype=np.int64),
+            np.array(types),
+            np.array(times, dtype=np.float64),
+            None if sizes is None else np.array(sizes, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def find(
+            self,
+            types: Optional[Iterable] = None,
+            start_time: Union[datetime, float, None] = None,
+            end_time: Union[datetime, float, None] = None) -> np.ndarray:
+        '''
+        Gets the offsets of the datagrams recorded between `start_time`
+        and `end_time` (inclusive), in time order. Datagrams without a time
+        are only included if neither time is given.
+
+        :param types: only include datagrams of these types
+        :param start_time: datetime or seconds since the unix epoch
+        :param end_time: datetime or seconds since the unix epoch
+        :return: array of datagram offsets
+        '''
+        start = to_timestamp(start_time)
+        end = to_timestamp(end_time)
+        if start is None and end is None:
+            lo, hi = 0, len(self._order)
+        else:
+            timed = self._sorted_times[:self._timed_count]
+            lo = 0 if start is None else \
+                int(np.searchsorted(timed, start, side='left'))
+            hi = self._timed_count if end is None else \
+                int(np.searchsorted(timed, end, side='right'))
+        selected = self._order[lo:hi]
+        if types is not None:
+            selected = selected[np.isin(self.types[selected], list(types))]
+        return self.offsets[selected]
+
+    def type_offsets(self, dg_type) -> np.ndarray:
+        '''offsets of the datagrams of the given type, in file order'''
+        if dg_type not in self._type_offsets:
+            self._type_offsets[dg_type] = \
+                self.offsets[self.types == dg_type]
+        return self._type_offsets[dg_type]
+
+    def has_type(self, dg_type) -> bool:
+        return len(self.type_offsets(dg_type)) > 0
+
+
+def walk_headers(
+        stream: BinaryIO,
+        parse: Callable[[bytes], Optional[Tuple[int, object, Optional[float]]]]
+) -> TimeIndex:
+    '''
+    Builds a time index by following the datagram lengths through a stream,
+    reading only the start of each datagram.
+
+    :param stream: file positioned at the first datagram
+    :param parse: given the first `HEADER_READ_SIZE` bytes (or fewer at the
+        end of the file) of a datagram returns a tuple of the size of the
+        datagram in bytes, its type and time. Returns None if the bytes
+        aren't a valid header, which ends the walk.
+    :return: :class:`TimeIndex`
+    '''
+    headers = []
+    sizes = []
+    offset = stream.tell()
+    while True:
+        header = stream.read(HEADER_READ_SIZE)
+        parsed = parse(header) if len(header) > 0 else None
+        if parsed is None:
+            break
+        size, dg_type, time = parsed
+        headers.append((offset, dg_type, time))
+        sizes.append(size)
+        offset += size
+        stream.seek(offset)
+    return TimeIndex.from_headers(headers, sizes)
@@ -0,0 +1,475 @@
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from hyo2.mate.lib.scan import ScanResult, ScanState
+
+# mean radius of the earth in metres
+EARTH_RADIUS = 6371008.8
+
+# tracks are simplified so no position is moved more than this many metres
+DEFAULT_SIMPLIFY_TOLERANCE = 5.0
+
+# offsets used to combine the grid cell column and row into a single key
+_CELL_OFFSET = 2 ** 30
+_CELL_STRIDE = 2 ** 31
+
+
+def project(
+        lonlat: np.ndarray,
+        origin: Tuple[float, float]) -> np.ndarray:
+    """ Projects longitudes and latitudes to metres east and north of an
+    origin. An equirectangular projection is accurate enough over the area
+    of a survey.
+
+    Args:
+        lonlat (np.ndarray): (n, 2) array of longitude and latitude
+        origin (tuple): longitude and latitude of the origin
+
+    Returns:
+        (n, 2) array of x and y in metres
+    """
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    scale = math.cos(math.radians(origin[1]))
+    return np.column_stack([
+        np.radians(lonlat[:, 0] - origin[0]) * EARTH_RADIUS * scale,
+        np.radians(lonlat[:, 1] - origin[1]) * EARTH_RADIUS,
+    ])
+
+
+def unproject(xy: np.ndarray, origin: Tuple[float, float]) -> np.ndarray:
+    """ Inverse of `project` """
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    scale = math.cos(math.radians(origin[1]))
+    return np.column_stack([
+        origin[0] + np.degrees(xy[:, 0] / (EARTH_RADIUS * scale)),
+        origin[1] + np.degrees(xy[:, 1] / EARTH_RADIUS),
+    ])
+
+
+def simplify(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """ Simplifies a line with the Douglas-Peucker algorithm.
+
+    Args:
+        points (np.ndarray): (n, 2) array of projected positions
+        tolerance (float): maximum distance a removed position may be from
+            the simplified line
+
+    Returns:
+        indexes of the positions that are kept, in order
+    """
+    count = len(points)
+    if count < 3:
+        return np.arange(count)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = points[first + 1:last]
+        distances = _point_segment_distances(
+            inner, points[first], points[last])
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            split = first + 1 + i
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+def _point_segment_distances(
+        points: np.ndarray,
+        start: np.ndarray,
+        end: np.ndarray) -> np.ndarray:
+    """ Distance from each point to the segment from `start` to `end`. The
+    segment ends may be arrays of the same length as `points`.
+    """
+    direction = end - start
+    length_sq = np.sum(direction * direction, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.sum((points - start) * direction, axis=-1) / length_sq
+    t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+    nearest = start + t[..., np.newaxis] * direction
+    return np.hypot(*(points - nearest).T)
+
+
+def _cross(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def simplify_track(
+        lonlat: np.ndarray,
+        tolerance: float = DEFAULT_SIMPLIFY_TOLERANCE) -> List[List[float]]:
+    """ Simplifies the track of a file, so the tracks of a whole survey can
+    be held in memory and compared.
+
+    Args:
+        lonlat (np.ndarray): (n, 2) array of longitude and latitude
+        tolerance (float): maximum distance in metres a position may be
+            moved by
+
+    Returns:
+        list of the [longitude, latitude] of the positions kept
+    """
+    lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+    lonlat = lonlat[~np.isnan(lonlat).any(axis=1)]
+    if len(lonlat) == 0:
+        return []
+    origin = tuple((lonlat.min(axis=0) + lonlat.max(axis=0)) / 2)
+    kept = simplify(project(lonlat, origin), tolerance)
+    return lonlat[kept].tolist()
+
+
+class TrackIndex:
+    """ Uniform grid index over the segments of the tracks of a survey, so
+    crossing lines, neighbouring lines and gaps in coverage are found by
+    comparing only the segments that are near each other rather than every
+    pair of tracks.
+
+    Positions are projected to metres around the centre of the survey. Each
+    segment is added to every grid cell its bounding box overlaps.
+    """
+
+    def __init__(
+            self,
+            tracks: Dict[str, np.ndarray],
+            cell_size: Optional[float] = None):
+        """ `TrackIndex` constructor
+
+        Args:
+            tracks (dict): (n, 2) array of longitude and latitude of each
+                track, by name (eg; file path)
+            cell_size (float): size of the grid cells in metres. Defaults to
+                twice the median segment length.
+        """
+        tracks = {
+            name: np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+            for name, lonlat in tracks.items()
+        }
+        tracks = {
+            name: lonlat[~np.isnan(lonlat).any(axis=1)]
+            for name, lonlat in tracks.items()
+        }
+        self.names = list(tracks.keys())
+        points = [lonlat for lonlat in tracks.values() if len(lonlat) > 0]
+        if len(points) > 0:
+            all_points = np.concatenate(points)
+            self.origin = tuple(
+                (all_points.min(axis=0) + all_points.max(axis=0)) / 2)
+        else:
+            self.origin = (0.0, 0.0)
+        self.tracks = {
+            name: project(lonlat, self.origin)
+            for name, lonlat in tracks.items()
+        }
+
+        starts = []
+        ends = []
+        track_ids = []
+        for track_id, name in enumerate(self.names):
+            xy = self.tracks[name]
+            if len(xy) == 1:
+                # a track of a single position is a zero length segment
+                xy = np.concatenate([xy, xy])
+            starts.append(xy[:-1])
+            ends.append(xy[1:])
+            track_ids.append(np.full(max(len(xy) - 1, 0), track_id))
+        self.starts = np.concatenate(starts) if starts else np.zeros((0, 2))
+        self.ends = np.concatenate(ends) if ends else np.zeros((0, 2))
+        self.track_ids = np.concatenate(track_ids).astype(np.int64) \
+            if track_ids else np.zeros(0, dtype=np.int64)
+
+        if cell_size is None:
+            lengths = np.hypot(*(self.ends - self.starts).T)
+            cell_size = 2 * float(np.median(lengths)) \
+                if len(lengths) > 0 else 1.0
+        self.cell_size = max(cell_size, 1.0)
+        self._build_grid()
+
+    def _cell(self, values: np.ndarray) -> np.ndarray:
+        return np.floor(values / self.cell_size).astype(np.int64)
+
+    def _build_grid(self):
+        """ Adds each segment to the grid cells it passes through. Starting
+        from the cell of its start, a segment steps into the neighbouring
+        cell at each grid line it crosses, so the number of cells is
+        proportional to its length rather than its bounding box.
+        """
+        start = self.starts / self.cell_size
+        end = self.ends / self.cell_size
+        first = np.floor(start).astype(np.int64)
+        last = np.floor(end).astype(np.int64)
+        segment_ids = np.arange(len(first))
+
+        # the first cell of each segment, then a step for each grid line
+        # crossed, ordered by how far along the segment it is
+        ids = [segment_ids]
+        distances = [np.full(len(first), -np.inf)]
+        steps = [first]
+        for axis in range(2):
+            crossings = np.abs(last[:, axis] - first[:, axis])
+            direction = np.sign(last[:, axis] - first[:, axis])
+            crossing_ids = np.repeat(segment_ids, crossings)
+            # number of each crossing within its segment, from 1
+            number = np.arange(crossings.sum()) - np.repeat(
+                np.cumsum(crossings) - crossings, crossings) + 1
+            moving = direction[crossing_ids]
+            line = first[crossing_ids, axis] + \
+                np.where(moving > 0, number, 1 - number)
+            distances.append(
+                (line - start[crossing_ids, axis]) /
+                (end[crossing_ids, axis] - start[crossing_ids, axis]))
+            ids.append(crossing_ids)
+            step = np.zeros((len(crossing_ids), 2), dtype=np.int64)
+            step[:, axis] = moving
+            steps.append(step)
+        ids = np.concatenate(ids)
+        order = np.lexsort((np.concatenate(distances), ids))
+        ids = ids[order]
+        cells = np.cumsum(np.concatenate(steps)[order], axis=0)
+        # the sums run on from one segment to the next, so remove the sum
+        # of the segments before each one
+        counts = np.bincount(ids, minlength=len(first))
+        totals = cells[np.cumsum(counts) - 1] if len(ids) > 0 \
+            else np.zeros((0, 2), dtype=np.int64)
+        previous = np.concatenate(
+            [np.zeros((1, 2), dtype=np.int64), totals])[:-1]
+        cells = cells - np.repeat(previous, counts, axis=0)
+
+        keys = self._key(cells[:, 0], cells[:, 1])
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._segments = ids[order]
+
+    def _key(self, cell_x, cell_y):
+        return (cell_x + _CELL_OFFSET) * _CELL_STRIDE + cell_y + _CELL_OFFSET
+
+    def _segments_near(
+            self,
+            lower: np.ndarray,
+            upper: np.ndarray) -> np.ndarray:
+        """ Segments in the grid cells overlapping a bounding box """
+        low = self._cell(lower)
+        high = self._cell(upper)
+        found = []
+        for cell_x in range(low[0], high[0] + 1):
+            first = np.searchsorted(
+                self._keys, self._key(cell_x, low[1]), side='left')
+            last = np.searchsorted(
+                self._keys, self._key(cell_x, high[1]), side='right')
+            found.append(self._segments[first:last])
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    def crossings(self) -> List[Tuple[str, str, Tuple[float, float]]]:
+        """ Finds the places where the tracks of different files cross.
+
+        Returns:
+            list of the names of the two tracks, and the longitude and
+            latitude where they cross
+        """
+        if len(self._keys) == 0:
+            return []
+        # pairs of segments sharing a cell
+        boundaries = np.flatnonzero(np.diff(self._keys)) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(self._keys)]])
+        pairs = set()
+        for start, end in zip(starts, ends):
+            if end - start < 2:
+                continue
+            segments = self._segments[start:end]
+            tracks = self.track_ids[segments]
+            if np.all(tracks == tracks[0]):
+                continue
+            i, j = np.triu_indices(len(segments), k=1)
+            different = tracks[i] != tracks[j]
+            for a, b in zip(segments[i[different]], segments[j[different]]):
+                pairs.add((min(a, b), max(a, b)))
+        if len(pairs) == 0:
+            return []
+
+        pairs = np.array(sorted(pairs), dtype=np.int64)
+        a_start = self.starts[pairs[:, 0]]
+        a_dir = self.ends[pairs[:, 0]] - a_start
+        b_start = self.starts[pairs[:, 1]]
+        b_dir = self.ends[pairs[:, 1]] - b_start
+        denominator = _cross(a_dir, b_dir)
+        offset = b_start - a_start
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = _cross(offset, b_dir) / denominator
+            u = _cross(offset, a_dir) / denominator
+        # parallel segments aren't considered to cross, nor are the end of
+        # one file's track and the start of the next file's
+        crossing = (denominator != 0) & \
+            (t > 0) & (t < 1) & (u > 0) & (u < 1)
+        points = unproject(
+            a_start[crossing] + t[crossing, np.newaxis] * a_dir[crossing],
+            self.origin)
+        return [
+            (self.names[self.track_ids[a]], self.names[self.track_ids[b]],
+                (float(point[0]), float(point[1])))
+            for (a, b), point in zip(pairs[crossing], points)
+        ]
+
+    def nearest_distances(
+            self,
+            points: np.ndarray,
+            exclude: Optional[str] = None,
+            max_distance: Optional[float] = None
+    ) -> Tuple[np.ndarray, List[Optional[str]]]:
+        """ Finds the nearest track to each of a set of projected points.
+
+        Args:
+            points (np.ndarray): (n, 2) array of positions in metres, as
+                given by `project` with `origin`
+            exclude (str): name of a track to ignore, eg; the track the
+                points are on
+            max_distance (float): tracks further than this aren't searched
+                for, the distance is given as infinite
+
+        Returns:
+            tuple of the distance to the nearest track of each point, and
+            the name of that track (None if there isn't one)
+        """
+        exclude_id = self.names.index(exclude) \
+            if exclude in self.names else -1
+        distances = np.full(len(points), np.inf)
+        nearest = [None] * len(points)
+        if len(self.starts) == 0:
+            return distances, nearest
+        extent = np.ptp(np.concatenate([self.starts, self.ends]), axis=0)
+        limit = max_distance if max_distance is not None else \
+            float(np.hypot(*extent)) + self.cell_size
+        for i, point in enumerate(points):
+            radius = self.cell_size
+            while True:
+                radius = min(radius, limit)
+                segments = self._segments_near(point - radius, point + radius)
+                segments = segments[self.track_ids[segments] != exclude_id]
+                if len(segments) > 0:
+                    d = _point_segment_distances(
+                        point, self.starts[segments], self.ends[segments])
+                    j = int(np.argmin(d))
+                    # only segments within the radius are certain to have
+                    # been found
+                    if d[j] <= radius:
+                        distances[i] = d[j]
+                        nearest[i] = self.names[self.track_ids[segments[j]]]
+                        break
+                if radius >= limit:
+                    break
+                radius *= 2
+        return distances, nearest
+
+    def _sample(self, name: str, spacing: float) -> np.ndarray:
+        """ Positions along a track no more than `spacing` metres apart """
+        xy = self.tracks[name]
+        if len(xy) < 2:
+            return xy
+        samples = [xy[:1]]
+        for start, end in zip(xy[:-1], xy[1:]):
+            count = max(int(math.ceil(np.hypot(*(end - start)) / spacing)), 1)
+            t = np.arange(1, count + 1)[:, np.newaxis] / count
+            samples.append(start + t * (end - start))
+        return np.concatenate(samples)
+
+    def nearest_line(self, name: str) -> Tuple[Optional[str], float]:
+        """ Finds the track nearest to a track. Distances are measured from
+        the positions of the simplified track, so a track that crosses it
+        may not be at distance 0.
+
+        Returns:
+            tuple of the name of the nearest track and the distance to it
+            in metres, or None and infinity if there are no other tracks
+        """
+        distances, nearest = self.nearest_distances(
+            self.tracks[name], exclude=name)
+        if len(distances) == 0 or np.isinf(distances.min()):
+            return None, math.inf
+        i = int(np.argmin(distances))
+        return nearest[i], float(distances[i])
+
+    def coverage_gaps(
+            self,
+            name: str,
+            max_spacing: float) -> List[Tuple[float, float]]:
+        """ Finds the parts of a track that are further than `max_spacing`
+        from any other track.
+
+        Returns:
+            longitude and latitude of positions along the track, at most
+            `max_spacing / 2` apart, that are too far from another track
+        """
+        points = self._sample(name, max(max_spacing / 2, 1.0))
+        distances, _ = self.nearest_distances(
+            points, exclude=name, max_distance=max_spacing)
+        gaps = unproject(points[distances > max_spacing], self.origin)
+        return [(float(lon), float(lat)) for lon, lat in gaps]
+
+
+def check_tracks(
+        tracks: Dict[str, Optional[List]],
+        max_line_spacing: Optional[float] = None) -> Dict[str, ScanResult]:
+    """ Compares the tracks of the files of a survey, finding the lines each
+    line crosses, its nearest neighbouring line and, if `max_line_spacing`
+    is given, the parts of it further than this from any other line.
+
+    Args:
+        tracks (dict): simplified track of each file, by file path, as
+            given by `simplify_track`
+        max_line_spacing (float): distance in metres a line may be from its
+            neighbours before it is flagged as a gap in coverage
+
+    Returns:
+        dict of the result for each file, by file path
+    """
+    results = {}
+    valid = {}
+    for path, track in tracks.items():
+        if not track:
+            results[path] = ScanResult(
+                state=ScanState.WARNING,
+                messages=(
+                    "No positions found, the track of the file could not be "
+                    "compared with other lines"),
+                data={})
+        else:
+            valid[path] = track
+
+    index = TrackIndex(valid)
+    crossings = {path: [] for path in valid}
+    for a, b, point in index.crossings():
+        crossings[a].append({'file': b, 'position': list(point)})
+        crossings[b].append({'file': a, 'position': list(point)})
+
+    for path in valid:
+        state = ScanState.PASS
+        messages = []
+        crossed = {c['file'] for c in crossings[path]}
+        if len(crossed) > 0:
+            messages.append("Crosses {} other lines".format(len(crossed)))
+        gaps = []
+        if max_line_spacing is not None and len(valid) > 1:
+            gaps = index.coverage_gaps(path, max_line_spacing)
+            if len(gaps) > 0:
+                state = ScanState.WARNING
+                messages.append(
+                    "{} positions are more than {} m from another line"
+                    .format(len(gaps), max_line_spacing))
+        nearest, distance = index.nearest_line(path)
+        results[path] = ScanResult(
+            state=state,
+            messages=messages,
+            data={
+                'crossings': crossings[path],
+                'nearestLine': nearest,
+                'nearestDistance': None if nearest is None else distance,
+                'coverageGaps': [list(gap) for gap in gaps],
+            })
+    return results
@@ -1,3 +1,9 @@
+from importlib.metadata import entry_points
+from typing import Dict, Tuple, Type
+import logging
+
+from hyo2.mate.lib.format_detect import detect_format
+from hyo2.mate.lib.raw_file import COMPRESSION_SUFFIXES, raw_file_extension
 from hyo2.mate.lib.scan import Scan
 from hyo2.mate.lib.scan_check import *
 from hyo2.mate.lib.scan_ALL import ScanALL
@@ -20,6 +26,9 @@ raw_data_checks = [
     RuntimeParametersCheck,
     PositionsCheck,
     InstallationParametersCheck,
+    DatagramIntegrityCheck,
+    LineContinuityCheck,
+    SurveyTracksCheck,
 ]
 
 svp_checks = [
@@ -32,14 +41,92 @@ trueheave_checks = [
 
 all_checks = raw_data_checks + svp_checks + trueheave_checks
 
+# Entry point group other packages can use to provide additional checks. Each
+# entry point must refer to a `ScanCheck` class, or a list of them. These
+# checks are treated as raw data checks.
+CHECK_ENTRY_POINT_GROUP = 'hyo2.mate.checks'
+
+logger = logging.getLogger(__name__)
+
+# Lookup of check implementation by (id, version). Populated once at import.
+check_registry: Dict[Tuple[str, str], Type[ScanCheck]] = {}
+
+
+def _add_to_registry(
+        check: Type[ScanCheck],
+        registry: Dict[Tuple[str, str], Type[ScanCheck]]):
+    """Adds a check implementation to `registry`, see `register_check`."""
+    key = (check.id, check.version)
+    existing = registry.get(key)
+    if existing is not None and existing is not check:
+        raise ValueError(
+            "Check {} has the same id {} and version {} as check {}".format(
+                check.__name__, check.id, check.version, existing.__name__
+            ))
+    registry[key] = check
+
+
+def register_check(check: Type[ScanCheck]):
+    """Adds a check implementation to the registry of supported checks.
 
-def get_scan(path: str, file_extension: str, file_type: str) -> Scan:
+    Args:
+        check (ScanCheck): check class to register
+
+    Raises:
+        ValueError: if a different check has already been registered with
+            the same id and version
+    """
+    _add_to_registry(check, check_registry)
+
+
+def _load_check_plugins():
+    """Registers checks provided by other packages via entry points. A
+    plugin that fails to load, or has a check that clashes with an existing
+    check, is logged and ignored (none of its checks are registered) so it
+    can't prevent the built in checks from running.
+    """
+    for entry_point in entry_points(group=CHECK_ENTRY_POINT_GROUP):
+        try:
+            loaded = entry_point.load()
+            plugin_checks = loaded if isinstance(loaded, list) else [loaded]
+            # every check of the plugin is validated before any of them
+            # are registered
+            staged = dict(check_registry)
+            for plugin_check in plugin_checks:
+                _add_to_registry(plugin_check, staged)
+        except Exception:
+            logger.exception(
+                "Failed to register checks from plugin {}".format(
+                    entry_point.name))
+            continue
+        check_registry.update(staged)
+        for plugin_check in plugin_checks:
+            if plugin_check not in raw_data_checks:
+                raw_data_checks.append(plugin_check)
+                all_checks.append(plugin_check)
+
+
+# built in checks must not clash, so let any ValueError escape on import
+for _check in all_checks:
+    register_check(_check)
+_load_check_plugins()
+
+
+def get_scan(
+    path: str, file_extension: str, file_type: str, read_ahead: bool = False
+) -> Scan:
     """Factory method to return a new Scan instance for the given file type.
 
     Args:
         path (str): Path to the file that will be read by the `Scan`
-        file_extension (str): Extension of file to scan.
+        file_extension (str): Extension of file to scan. Raw files may be
+            compressed (eg; `.all.gz`), in which case the extension under the
+            compression suffix is used. The format of raw files is detected
+            from their contents, the extension is only used if the format
+            can't be detected.
         file_type (str): type of file. eg "Raw Files", "SVP Files"
+        read_ahead (bool): raw files are read in large blocks in a background
+            thread. Improves throughput when files are on a network share.
 
     Returns:
         New `Scan` instance
@@ -47,12 +134,21 @@ def get_scan(path: str, file_extension: str, file_type: str) -> Scan:
     Raises:
         NotImplementedError: if `file_type` is not supported
     """
+    if '.' + file_extension.lower() in COMPRESSION_SUFFIXES:
+        file_extension = raw_file_extension(path)
+    if file_type == 'Raw Files':
+        # misnamed files (eg; a .kmall file renamed to .all) are read with
+        # the reader for their actual format
+        detected = detect_format(path)
+        if detected is not None:
+            file_extension = detected
+
     if (file_extension.lower() == 'all' and file_type == 'Raw Files'):
-        return ScanALL(path)
+        return ScanALL(path, read_ahead)
     elif (file_extension.lower() == 'kmall' and file_type == 'Raw Files'):
-        return ScanKMALL(path)
+        return ScanKMALL(path, read_ahead)
     elif (file_extension.lower() == 'gsf' and file_type == 'Raw Files'):
-        return ScanGsf(path)
+        return ScanGsf(path, read_ahead)
     elif (file_type == 'SVP Files'):
         # could have any extension
         return ScanSvp(path)
@@ -83,9 +179,32 @@ def get_check(
     Raises:
         NotImplementedError: if check with `id` and `version` is not found
     """
-    for check in all_checks:
-        if id == check.id and version == check.version:
-            return check(scan, params)
+    check = check_registry.get((id, version))
+    if check is not None:
+        return check(scan, params)
+
+    raise NotImplementedError(
+        "Check with id {} and version {} could not be found".format(
+            id, version
+        ))
+
+
+def get_check_class(id: str, version: str) -> Type[ScanCheck]:
+    """Gets the ScanCheck class for the given id and version.
+
+    Args:
+        id (str): UUID for the check
+        version (str): Version of the check
+
+    Returns:
+        `ScanCheck` subclass
+
+    Raises:
+        NotImplementedError: if check with `id` and `version` is not found
+    """
+    check = check_registry.get((id, version))
+    if check is not None:
+        return check
 
     raise NotImplementedError(
         "Check with id {} and version {} could not be found".format(
@@ -103,7 +222,36 @@ def is_check_supported(id: str, version: str) -> bool:
     Returns:
         True if the check is supported (eg; it exists), otherwise false.
     """
-    for check in all_checks:
-        if id == check.id and version == check.version:
-            return True
-    return False
+    return (id, version) in check_registry
+
+
+def is_metadata_check(id: str, version: str) -> bool:
+    """ Indicates if the check only needs the metadata at the start of the
+    file (see `ScanCheck.metadata_only`), so the file can be read with
+    `Scan.scan_metadata` rather than being scanned in full.
+
+    Args:
+        id (str): UUID for the check
+        version (str): Version of the check
+
+    Returns:
+        True if the check only needs the file metadata
+    """
+    check = check_registry.get((id, version))
+    return check is not None and check.metadata_only
+
+
+def is_survey_check(id: str, version: str) -> bool:
+    """ Indicates if the check compares the files of a survey with each other
+    (see `ScanCheck.survey_level`), so can only be completed once all files
+    have been scanned.
+
+    Args:
+        id (str): UUID for the check
+        version (str): Version of the check
+
+    Returns:
+        True if the check is a survey level check
+    """
+    check = check_registry.get((id, version))
+    return check is not None and check.survey_level
@@ -0,0 +1,326 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ausseabed.qajson.model import QajsonCheck
+
+from hyo2.mate.lib.catalogue import SurveyCatalogue
+from hyo2.mate.lib.check_cache import CheckCache
+from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.export import ParquetExporter
+from hyo2.mate.lib.raw_file import raw_file_extension
+
+logger = logging.getLogger(__name__)
+
+# extensions of the raw files picked up by the watcher, compressed copies of
+# these (eg; `.all.gz`) are included
+RAW_EXTENSIONS = ('all', 'kmall', 'gsf')
+
+# seconds a file must go without changing before it's considered closed by
+# the acquisition software
+DEFAULT_SETTLE_TIME = 10.0
+# seconds between checks of the watched directories
+DEFAULT_POLL_INTERVAL = 2.0
+
+
+class ProcessedFiles:
+    """ Record of the raw files that have been checked by the watcher, so a
+    restarted watcher doesn't check them again. Kept in an append only file
+    of JSON lines, one per processed file. A file is only considered
+    processed if its size and modification time are unchanged.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """ `ProcessedFiles` constructor
+
+        Args:
+            path (str): file the record is kept in, loaded if it exists. If
+                None the record is only kept in memory.
+        """
+        self.path = path
+        self._files: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self._files[entry['path']] = (
+                        entry['size'], entry['mtime_ns'])
+                except (ValueError, KeyError, TypeError):
+                    # eg; the last line, if the watcher was killed while
+                    # writing it
+                    continue
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._files)
+
+    def is_processed(self, path: str, size: int, mtime_ns: int) -> bool:
+        with self._lock:
+            return self._files.get(os.path.abspath(path)) == (size, mtime_ns)
+
+    def add(self, path: str, size: int, mtime_ns: int):
+        """ Records a file as processed """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._files[path] = (size, mtime_ns)
+            if self.path is None:
+                return
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(
+                    {'path': path, 'size': size, 'mtime_ns': mtime_ns}
+                ) + '\n')
+
+
+class DirectoryWatcher:
+    """ Finds raw files in a set of directories once the acquisition
+    software has stopped writing to them.
+
+    A file is ready once its size and modification time haven't changed for
+    `settle_time` seconds. Each file is given by `poll` only once, unless it
+    changes again afterwards. If the optional `watchdog` package is
+    installed file system events (eg; inotify) are used to find the files
+    that have changed, so large directories aren't listed on every poll.
+    Otherwise, or for file systems that don't give events such as network
+    shares, the directories are listed on each poll.
+    """
+
+    def __init__(
+            self,
+            directories: Iterable[str],
+            settle_time: float = DEFAULT_SETTLE_TIME,
+            recursive: bool = False,
+            use_events: bool = True,
+            processed: ProcessedFiles = None,
+            extensions: Iterable[str] = RAW_EXTENSIONS):
+        """ `DirectoryWatcher` constructor
+
+        Args:
+            directories (list): paths of the directories to watch
+            settle_time (float): seconds a file must be unchanged for
+            recursive (bool): also watch sub directories
+            use_events (bool): use file system events if `watchdog` is
+                installed, rather than listing the directories each poll
+            processed (ProcessedFiles): files that don't need to be given
+                again, if unchanged
+            extensions (list): extensions of the files to watch for
+        """
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.settle_time = settle_time
+        self.recursive = recursive
+        self.processed = processed
+        self.extensions = {e.lower() for e in extensions}
+        # files that haven't yet settled; (size, mtime_ns) and the time the
+        # file was last seen to change
+        self._pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        # (size, mtime_ns) of the files given by `poll`
+        self._given: Dict[str, Tuple[int, int]] = {}
+        # files changed since the last poll, found by file system events
+        self._changed = set()
+        self._changed_lock = threading.Lock()
+        self._listed = False
+        self._observer = None
+        if use_events:
+            self._observer = self._start_observer()
+
+    @property
+    def uses_events(self) -> bool:
+        return self._observer is not None
+
+    @property
+    def pending_count(self) -> int:
+        """ Number of files found that haven't yet settled """
+        return len(self._pending)
+
+    def _start_observer(self):
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            logger.info(
+                "watchdog is not installed, directories will be polled")
+            return None
+
+        watcher = self
+
+        class _Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                for path in [event.src_path, getattr(event, 'dest_path', '')]:
+                    if path:
+                        watcher._mark_changed(os.fsdecode(path))
+
+        observer = Observer()
+        handler = _Handler()
+        for directory in self.directories:
+            observer.schedule(handler, directory, recursive=self.recursive)
+        observer.daemon = True
+        observer.start()
+        return observer
+
+    def close(self):
+        """ Stops watching for file system events """
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def relative_path(self, path: str) -> str:
+        """ Gets the path of a file given by `poll` relative to the
+        watched directory it was found in. Files of the same name in
+        different sub directories have different relative paths.
+        """
+        path = os.path.abspath(path)
+        # the deepest directory, in case watched directories are nested
+        for directory in sorted(self.directories, key=len, reverse=True):
+            if os.path.commonpath([directory, path]) == directory:
+                return os.path.relpath(path, directory)
+        return os.path.basename(path)
+
+    def _is_raw_file(self, path: str) -> bool:
+        return raw_file_extension(path).lower() in self.extensions
+
+    def _mark_changed(self, path: str):
+        if self._is_raw_file(path):
+            with self._changed_lock:
+                self._changed.add(os.path.abspath(path))
+
+    def _list_files(self) -> List[str]:
+        paths = []
+        for directory in self.directories:
+            if self.recursive:
+                for root, _, names in os.walk(directory):
+                    paths.extend(os.path.join(root, n) for n in names)
+            else:
+                with os.scandir(directory) as entries:
+                    paths.extend(e.path for e in entries if e.is_file())
+        return [p for p in paths if self._is_raw_file(p)]
+
+    def _observe(self, path: str, now: float):
+        """ Records the current size and modification time of a file """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # deleted or renamed since it was found
+            self._pending.pop(path, None)
+            return
+        key = (stat.st_size, stat.st_mtime_ns)
+        if self._given.get(path) == key:
+            return
+        if self.processed is not None and \
+                self.processed.is_processed(path, *key):
+            self._given[path] = key
+            return
+        pending = self._pending.get(path)
+        if pending is None and path not in self._given:
+            # a file that was last modified a while ago (eg; a backlog of
+            # files present when the watcher starts) is ready straight away
+            self._pending[path] = (key, min(now, stat.st_mtime_ns / 1e9))
+        elif pending is None or pending[0] != key:
+            self._pending[path] = (key, now)
+
+    def poll(self, now: float = None) -> List[str]:
+        """ Finds the files that have settled since the last poll.
+
+        Args:
+            now (float): current time in seconds since the unix epoch
+
+        Returns:
+            Paths of the files that are ready to be checked, sorted
+        """
+        if now is None:
+            now = time.time()
+        if self._observer is None or not self._listed:
+            paths = set(self._list_files())
+            self._listed = True
+        else:
+            paths = set()
+        with self._changed_lock:
+            paths.update(self._changed)
+            self._changed.clear()
+        paths.update(self._pending.keys())
+        for path in paths:
+            self._observe(path, now)
+
+        ready = sorted(
+            path for path, (_, changed) in self._pending.items()
+            if now - changed >= self.settle_time
+        )
+        for path in ready:
+            self._given[path] = self._pending.pop(path)[0]
+        return ready
+
+
+def file_checks(template_checks: List[dict], path: str) -> List[QajsonCheck]:
+    """ Builds the checks to run on a single raw file from the checks of a
+    QA JSON file, replacing their input files with the raw file.
+
+    Args:
+        template_checks (list): checks block of the raw data section of a QA
+            JSON file
+        path (str): raw file to check
+
+    Returns:
+        List of `QajsonCheck`
+    """
+    checks = []
+    for check in template_checks:
+        check = copy.deepcopy(check)
+        check.setdefault('inputs', {})['files'] = [{
+            'path': path,
+            'description': 'raw input',
+            'file_type': 'Raw Files',
+        }]
+        check.pop('outputs', None)
+        checks.append(QajsonCheck.from_dict(check))
+    return checks
+
+
+def check_raw_file(
+        template_checks: List[dict],
+        path: str,
+        cache: CheckCache = None,
+        read_ahead: bool = False,
+        catalogue: SurveyCatalogue = None,
+        vessel: str = None,
+        exporter: ParquetExporter = None) -> List[QajsonCheck]:
+    """ Runs the checks of a QA JSON file on a single raw file.
+
+    Args:
+        template_checks (list): checks block of the raw data section of a QA
+            JSON file
+        path (str): raw file to check
+        cache (CheckCache): optional store of previous check outputs
+        read_ahead (bool): read the file in large blocks in a background
+            thread
+        catalogue (SurveyCatalogue): optional survey catalogue the results
+            are added to
+        vessel (str): name of the vessel that recorded the file
+        exporter (ParquetExporter): optional exporter the datagram index and
+            position data of the file is written with
+
+    Returns:
+        List of `QajsonCheck`, with outputs
+    """
+    checks = file_checks(template_checks, path)
+    checkrunner = CheckRunner(
+        checks, cache=cache, catalogue=catalogue, vessel=vessel,
+        exporter=exporter)
+    checkrunner.initialize()
+    checkrunner.run_checks(read_ahead=read_ahead)
+    return checks
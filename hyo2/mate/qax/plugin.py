@@ -1,14 +1,20 @@
+import logging
+import os
+import sqlite3
 from timeit import default_timer as timer
 from typing import List, Dict, NoReturn, Callable
 from pathlib import Path
 
 from hyo2.mate.lib.utils import raw_data_checks, svp_checks, trueheave_checks
+from hyo2.mate.lib.check_cache import CheckCache
 from hyo2.mate.lib.check_runner import CheckRunner
 from hyo2.qax.lib.plugin import QaxCheckToolPlugin, QaxCheckReference, \
     QaxFileType
 from ausseabed.qajson.model import QajsonRoot, QajsonDataLevel, QajsonCheck, \
     QajsonFile, QajsonInputs
 
+logger = logging.getLogger(__name__)
+
 
 class MateQaxPlugin(QaxCheckToolPlugin):
 
@@ -54,6 +60,12 @@ class MateQaxPlugin(QaxCheckToolPlugin):
         self.name = 'Mate'
         self._check_references = self._build_check_references()
         self.check_runner = None
+        # QAX will re-submit the same QA JSON each time the user runs the
+        # checks, so check outputs can be cached to avoid re-scanning
+        # unchanged files. Caching is off unless a path to the cache database
+        # is given, by default with the MATE_CHECK_CACHE environment variable.
+        self.check_cache_path = os.environ.get('MATE_CHECK_CACHE')
+        self.check_cache = None
 
     def _build_check_references(self) -> List[QaxCheckReference]:
         data_level = "raw_data"
@@ -132,7 +144,16 @@ class MateQaxPlugin(QaxCheckToolPlugin):
 
         start = timer()
 
-        self.check_runner = CheckRunner(rawdatachecks)
+        if self.check_cache is None and self.check_cache_path:
+            try:
+                self.check_cache = CheckCache(self.check_cache_path)
+            except (OSError, sqlite3.Error) as e:
+                # the checks can still be run, just not cached
+                logger.warning("Check cache {} unavailable, {}".format(
+                    self.check_cache_path, e))
+
+        self.check_runner = CheckRunner(
+            rawdatachecks, cache=self.check_cache)
         self.check_runner.initialize()
 
         # the check_runner callback accepts only a float, whereas the qax
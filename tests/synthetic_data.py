@@ -0,0 +1,112 @@
+'''
+Utils to write small, structurally valid raw data files for tests that
+don't depend on the (large) files in test_data_remote.
+'''
+import struct
+
+ALL_STX = 0x02
+ALL_ETX = 0x03
+
+
+def all_datagram(
+        dg_type: str,
+        body: bytes = b'',
+        record_date: int = 20200107,
+        record_time: int = 0,
+        counter: int = 0,
+        serial_number: int = 100,
+        em_model: int = 710) -> bytes:
+    '''
+    Builds a single Kongsberg .all datagram including the leading length
+    field, ETX and checksum.
+
+    :param dg_type: single character datagram type eg; `h`
+    :param body: datagram contents following the common header
+    :param record_time: milliseconds since midnight
+    '''
+    header = struct.pack(
+        '<BBHLLHH', ALL_STX, ord(dg_type), em_model, record_date,
+        record_time, counter, serial_number)
+    # checksum is the sum of all bytes between the STX and ETX
+    checksum = (sum(header[1:]) + sum(body)) & 0xFFFF
+    datagram = header + body + struct.pack('<BH', ALL_ETX, checksum)
+    return struct.pack('<L', len(datagram)) + datagram
+
+
+def all_height_datagram(
+        height_cm: int = 0, height_type: int = 0, **kwargs) -> bytes:
+    '''Builds a height (`h`) datagram'''
+    return all_datagram('h', struct.pack('<lB', height_cm, height_type),
+                        **kwargs)
+
+
+def all_clock_datagram(**kwargs) -> bytes:
+    '''Builds a clock (`C`) datagram'''
+    body = struct.pack(
+        '<LLB', kwargs.get('record_date', 20200107),
+        kwargs.get('record_time', 0), 1)
+    return all_datagram('C', body, **kwargs)
+
+
+def write_all_file(path: str, datagram_count: int = 100) -> str:
+    '''
+    Writes a .all file made up of height and clock datagrams, one second
+    apart.
+    '''
+    with open(path, 'wb') as f:
+        for i in range(datagram_count):
+            kwargs = {'record_time': i * 1000, 'counter': i}
+            if i % 2 == 0:
+                f.write(all_height_datagram(**kwargs))
+            else:
+                f.write(all_clock_datagram(**kwargs))
+    return path
+
+
+def kmall_datagram(
+        dg_type: str,
+        body: bytes = b'',
+        time_sec: int = 1578369600,
+        time_nanosec: int = 0,
+        version: int = 0,
+        system_id: int = 0,
+        echo_sounder_id: int = 2040) -> bytes:
+    '''
+    Builds a single Kongsberg .kmall datagram, including the repeated
+    length field at the end.
+
+    :param dg_type: datagram type eg; `#SKM`
+    :param body: datagram contents following the header
+    '''
+    size = 20 + len(body) + 4
+    header = struct.pack(
+        '<I4sBBHII', size, dg_type.encode('ascii'), version, system_id,
+        echo_sounder_id, time_sec, time_nanosec)
+    return header + body + struct.pack('<I', size)
+
+
+def write_kmall_file(path: str, datagram_count: int = 100) -> str:
+    '''
+    Writes a .kmall file made up of datagrams with small bodies, one second
+    apart.
+    '''
+    with open(path, 'wb') as f:
+        for i in range(datagram_count):
+            dg_type = '#SKM' if i % 2 == 0 else '#SPO'
+            f.write(kmall_datagram(
+                dg_type, bytes(8 + i % 5), time_sec=1578369600 + i))
+    return path
+
+
+def gsf_record(record_id: int, body: bytes = b'') -> bytes:
+    '''
+    Builds a single GSF record, the body is padded to a multiple of four
+    bytes.
+    '''
+    body = body + bytes(-len(body) % 4)
+    return struct.pack('>II', len(body), record_id) + body
+
+
+def gsf_header_record(version: bytes = b'GSF-v03.09') -> bytes:
+    '''Builds the GSF header record, which holds the format version'''
+    return gsf_record(1, version)
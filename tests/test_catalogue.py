@@ -0,0 +1,266 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from ausseabed.qajson.model import QajsonCheck, QajsonOutputs
+
+from hyo2.mate.lib.catalogue import SurveyCatalogue, SCAN_MODE_FULL, \
+    SCAN_MODE_METADATA
+from hyo2.mate.lib.check_cache import CheckCache, file_fingerprint
+from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.scan_check import FilenameChangedCheck, \
+    SurveyTracksCheck
+from hyo2.mate.lib.track_index import simplify_track
+
+from tests.synthetic_data import all_datagram, write_all_file
+from tests.test_scan import HeaderScan
+from tests.test_track_index import _line
+
+
+class PingScan(HeaderScan):
+    '''
+    Counts the pings of the X, N and Y datagrams of a .all file, as well as
+    the height datagrams of the synthetic files
+    '''
+
+    ping_datagram_types = ['X', 'N', 'Y', 'h']
+
+    def _scan_next(self):
+        start = self.raw_file.stream.tell()
+        HeaderScan._scan_next(self)
+        data = self._read_datagram_bytes(start)
+        dg_type = chr(data[5])
+        if dg_type not in ['X', 'N', 'Y']:
+            return
+        counter = struct.unpack_from('<H', data, 16)[0]
+        info = self.scan_result[dg_type]
+        if info['_seqNo'] is not None:
+            info['missedPings'] += counter - info['_seqNo'] - 1
+        info.setdefault('_firstSeqNo', counter)
+        info['pingCount'] += 1
+        info['_seqNo'] = counter
+
+
+def _check(name, check_state, status='completed'):
+    check = QajsonCheck.from_dict({
+        'info': {
+            'id': name, 'name': name, 'description': '', 'version': '1',
+            'group': {'id': '1', 'name': '1'}
+        },
+        'inputs': {}
+    })
+    check.outputs = QajsonOutputs.from_dict({
+        'check_state': check_state,
+        'execution': {'status': status}
+    })
+    return check
+
+
+class TestMateSurveyCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.catalogue = SurveyCatalogue(
+            os.path.join(self.temp_dir, "survey", "catalogue.db"))
+        self.paths = [
+            write_all_file(os.path.join(self.temp_dir, name), 100)
+            for name in ["0001_20200107_line.all", "0002_20200107_line.all"]
+        ]
+
+    def tearDown(self):
+        self.catalogue.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _record(self, path, vessel, checks=None, metadata=False):
+        with PingScan(path) as scan:
+            if metadata:
+                scan.scan_metadata()
+            else:
+                scan.scan_datagram()
+            self.catalogue.record(path, scan, checks, vessel)
+
+    def test_record(self):
+        self._record(self.paths[0], 'Investigator')
+        columns, rows = self.catalogue.query(
+            "SELECT file_name, format, size, vessel, scan_mode FROM files")
+        self.assertEqual(
+            columns, ['file_name', 'format', 'size', 'vessel', 'scan_mode'])
+        self.assertEqual(rows, [(
+            "0001_20200107_line.all", 'all', os.path.getsize(self.paths[0]),
+            'Investigator', SCAN_MODE_FULL)])
+        _, rows = self.catalogue.query(
+            "SELECT dg_type, record_count FROM datagram_types "
+            "ORDER BY dg_type")
+        self.assertEqual(rows, [('C', 50), ('h', 50)])
+
+        # recording the file again replaces its entry
+        self._record(self.paths[0], 'Bluefin', metadata=True)
+        _, rows = self.catalogue.query("SELECT vessel, scan_mode FROM files")
+        self.assertEqual(rows, [('Bluefin', SCAN_MODE_METADATA)])
+        _, rows = self.catalogue.query("SELECT * FROM datagram_types")
+        self.assertEqual(rows, [])
+
+    def test_missed_pings(self):
+        self._record(self.paths[0], 'Investigator')
+        self._record(self.paths[1], 'Investigator')
+        self.catalogue.query(
+            "UPDATE datagram_types SET missed_pings = 0 WHERE path = ?",
+            (self.paths[1],))
+        # the counters of the synthetic 'h' datagrams step by two
+        _, rows = self.catalogue.missed_pings(1.0)
+        self.assertEqual([r[0] for r in rows], [self.paths[0]])
+        self.assertEqual(rows[0][1:3], (50, 49))
+        _, rows = self.catalogue.missed_pings(60.0)
+        self.assertEqual(rows, [])
+
+    def test_several_ping_types(self):
+        ''' Pings recorded by several datagram types are only counted once
+        '''
+        path = os.path.join(self.temp_dir, "0003_20200107_line.all")
+        with open(path, 'wb') as f:
+            # ping 10 is missing
+            for counter in [c for c in range(20) if c != 10]:
+                for dg_type in ['X', 'N', 'Y']:
+                    f.write(all_datagram(
+                        dg_type, record_time=counter * 1000,
+                        counter=counter))
+        self._record(path, 'Investigator')
+        _, rows = self.catalogue.query("SELECT ping_type FROM files")
+        self.assertEqual(rows, [('X',)])
+        _, rows = self.catalogue.missed_pings()
+        self.assertEqual(rows, [(path, 19, 1, 5.0)])
+        _, rows = self.catalogue.ping_totals('vessel')
+        self.assertEqual(rows, [('Investigator', 1, 19, 1)])
+
+    def test_missing_datagram_type(self):
+        self._record(self.paths[0], 'Investigator')
+        self._record(self.paths[1], 'Investigator', metadata=True)
+        _, rows = self.catalogue.missing_datagram_type('S')
+        # the counts of a metadata scan aren't known
+        self.assertEqual([r[0] for r in rows], [self.paths[0]])
+        _, rows = self.catalogue.missing_datagram_type('h')
+        self.assertEqual(rows, [])
+
+    def test_ping_totals(self):
+        self._record(self.paths[0], 'Investigator')
+        self._record(self.paths[1], 'Bluefin')
+        columns, rows = self.catalogue.ping_totals('vessel')
+        self.assertEqual(columns[:3], ['vessel', 'files', 'pings'])
+        self.assertEqual(
+            [r[:3] for r in rows],
+            [('Bluefin', 1, 50), ('Investigator', 1, 50)])
+        with self.assertRaises(ValueError):
+            self.catalogue.ping_totals('path; DROP TABLE files')
+
+    def test_cached_outputs_recorded(self):
+        ''' A file is scanned to add it to the catalogue even when the
+            outputs of all its checks are cached
+        '''
+        path = self.paths[0]
+        check = QajsonCheck.from_dict({
+            'info': {
+                'id': FilenameChangedCheck.id,
+                'name': FilenameChangedCheck.name,
+                'description': '',
+                'version': FilenameChangedCheck.version,
+                'group': {'id': '1', 'name': '1'}
+            },
+            'inputs': {
+                'files': [
+                    {'path': path, 'description': 'raw input',
+                     'file_type': 'Raw Files'}
+                ]
+            }
+        })
+        cache = CheckCache(os.path.join(self.temp_dir, "cache.sqlite"))
+        cache.put(
+            file_fingerprint(path), check.info.id, check.info.version,
+            check.inputs.params, QajsonOutputs(check_state='pass'))
+
+        for scan_count in [1, 0]:
+            runner = CheckRunner(
+                [check], cache=cache, catalogue=self.catalogue)
+            runner.initialize()
+            with mock.patch(
+                    'hyo2.mate.lib.check_runner.get_scan',
+                    side_effect=lambda p, *args: PingScan(p)) as get_scan:
+                runner.run_checks()
+            # only scanned until the file is in the catalogue
+            self.assertEqual(get_scan.call_count, scan_count)
+            self.assertTrue(
+                self.catalogue.is_recorded(path, file_fingerprint(path)))
+            # scanned as the check would be, it only needs the metadata
+            _, rows = self.catalogue.query(
+                "SELECT scan_mode FROM files WHERE path = ?", (path,))
+            self.assertEqual(rows, [(SCAN_MODE_METADATA,)])
+            _, rows = self.catalogue.query(
+                "SELECT state FROM check_states WHERE path = ?", (path,))
+            self.assertEqual(rows, [('pass',)])
+        cache.close()
+
+    def test_survey_check_states(self):
+        ''' The states of survey level checks are recorded once the files
+            have been compared, not when each file is scanned
+        '''
+        for path in self.paths:
+            self._record(path, 'Investigator')
+        check = QajsonCheck.from_dict({
+            'info': {
+                'id': SurveyTracksCheck.id,
+                'name': SurveyTracksCheck.name,
+                'description': '',
+                'version': SurveyTracksCheck.version,
+                'group': {'id': '1', 'name': '1'}
+            },
+            'inputs': {
+                'files': [
+                    {'path': p, 'description': 'raw input',
+                     'file_type': 'Raw Files'}
+                    for p in self.paths
+                ],
+                'params': [{'name': 'max_line_spacing', 'value': 50}]
+            }
+        })
+        runner = CheckRunner([check], catalogue=self.catalogue)
+        runner.initialize()
+        tracks = [_line(0, 0, 1000, 0), _line(0, 100, 1000, 100)]
+        for path, track in zip(self.paths, tracks):
+            runner._add_check_output(
+                check, path,
+                QajsonOutputs(data={'summary': simplify_track(track)}))
+        runner._run_survey_checks()
+        _, rows = self.catalogue.query(
+            "SELECT path, check_id, state, status FROM check_states "
+            "ORDER BY path")
+        self.assertEqual(rows, [
+            (path, SurveyTracksCheck.id, check.outputs.check_state,
+             'completed')
+            for path in self.paths
+        ])
+
+        # files that aren't in the catalogue are ignored
+        self.catalogue.record_check_states(
+            os.path.join(self.temp_dir, "unrecorded.all"), [check])
+        _, rows = self.catalogue.query("SELECT path FROM check_states")
+        self.assertEqual(len(rows), 2)
+
+    def test_failed_checks(self):
+        checks = [
+            _check('Filename checked', 'pass'),
+            _check('Date checked', 'fail'),
+            _check('Bathymetry available', None, 'failed'),
+        ]
+        self._record(self.paths[0], 'Investigator', checks)
+        _, rows = self.catalogue.failed_checks()
+        self.assertEqual(
+            [r[1] for r in rows], ['Bathymetry available', 'Date checked'])
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateSurveyCatalogue))
+    return s
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from ausseabed.qajson.model import QajsonCheck, QajsonOutputs, QajsonParam
+
+from hyo2.mate.lib.check_cache import CheckCache, file_fingerprint, \
+    canonical_params
+from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.scan_check import FilenameChangedCheck
+
+
+class TestMateCheckCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.raw_file = os.path.join(self.temp_dir, "line.all")
+        with open(self.raw_file, 'wb') as f:
+            f.write(b'\x00' * 64)
+        self.cache = CheckCache(os.path.join(self.temp_dir, "cache.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_canonical_params_order(self):
+        a = [QajsonParam(name='a', value=1), QajsonParam(name='b', value=2)]
+        b = [QajsonParam(name='b', value=2), QajsonParam(name='a', value=1)]
+        self.assertEqual(canonical_params(a), canonical_params(b))
+        self.assertEqual(canonical_params(None), canonical_params([]))
+
+    def test_put_get(self):
+        fingerprint = file_fingerprint(self.raw_file)
+        params = [QajsonParam(name='threshold', value=20)]
+        outputs = QajsonOutputs(messages=["cached"], check_state="pass")
+
+        self.assertIsNone(self.cache.get(fingerprint, 'id', '1', params))
+        self.cache.put(fingerprint, 'id', '1', params, outputs)
+
+        cached = self.cache.get(fingerprint, 'id', '1', params)
+        self.assertIsNotNone(cached)
+        self.assertEqual(cached.messages, ["cached"])
+
+        # changing a param, or the check version, must miss the cache
+        changed_params = [QajsonParam(name='threshold', value=30)]
+        self.assertIsNone(
+            self.cache.get(fingerprint, 'id', '1', changed_params))
+        self.assertIsNone(self.cache.get(fingerprint, 'id', '2', params))
+
+    def test_fingerprint_changes_with_file(self):
+        before = file_fingerprint(self.raw_file)
+        # ensure the modification time moves on
+        time.sleep(0.01)
+        with open(self.raw_file, 'ab') as f:
+            f.write(b'\x00')
+        after = file_fingerprint(self.raw_file)
+        self.assertNotEqual(before, after)
+        self.assertIsNone(file_fingerprint(self.raw_file + ".missing"))
+
+    def test_fingerprint_archive_member(self):
+        ''' Members of an archive have distinct fingerprints, based on the
+            archive file
+        '''
+        first = file_fingerprint(self.raw_file + "!/0001.all")
+        second = file_fingerprint(self.raw_file + "!/0002.all")
+        self.assertNotEqual(first, second)
+        # size and modification time are those of the archive
+        self.assertEqual(
+            first.split(':')[-2:],
+            file_fingerprint(self.raw_file).split(':')[-2:])
+        self.assertIsNone(file_fingerprint("missing.zip!/0001.all"))
+
+
+class TestMateCheckRunnerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.raw_file = os.path.join(self.temp_dir, "0001_20200107_line.all")
+        with open(self.raw_file, 'wb') as f:
+            f.write(b'\x00' * 64)
+        self.cache = CheckCache(os.path.join(self.temp_dir, "cache.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _check(self):
+        return QajsonCheck.from_dict({
+            'info': {
+                'id': FilenameChangedCheck.id,
+                'name': FilenameChangedCheck.name,
+                'description': '',
+                'version': FilenameChangedCheck.version,
+                'group': {'id': '1', 'name': '1'}
+            },
+            'inputs': {
+                'files': [
+                    {'path': self.raw_file, 'description': 'raw input',
+                     'file_type': 'Raw Files'}
+                ]
+            }
+        })
+
+    def test_cache_hit_skips_scan(self):
+        check = self._check()
+        self.cache.put(
+            file_fingerprint(self.raw_file),
+            check.info.id,
+            check.info.version,
+            check.inputs.params,
+            QajsonOutputs(messages=["cached"], check_state="pass"))
+
+        runner = CheckRunner([check], cache=self.cache)
+        runner.initialize()
+        with mock.patch('hyo2.mate.lib.check_runner.get_scan') as get_scan:
+            runner.run_checks()
+        get_scan.assert_not_called()
+        self.assertEqual(check.outputs.messages, ["cached"])
+
+        # without the cache the file must be scanned
+        runner = CheckRunner([self._check()])
+        runner.initialize()
+        with mock.patch('hyo2.mate.lib.check_runner.get_scan') as get_scan:
+            runner.run_checks()
+        get_scan.assert_called_once()
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateCheckCache))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateCheckRunnerCache))
+    return s
@@ -0,0 +1,210 @@
+from datetime import datetime, timezone
+import os
+import shutil
+import tempfile
+import unittest
+
+from ausseabed.qajson.model import QajsonCheck, QajsonOutputs
+
+from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.continuity import check_continuity
+from hyo2.mate.lib.scan import Scan, ScanState
+from hyo2.mate.lib.scan_check import LineContinuityCheck
+
+from tests.synthetic_data import write_all_file
+
+START = datetime(2020, 1, 7, tzinfo=timezone.utc).timestamp()
+
+
+def _bounds(first_counter, last_counter, start, stop, ping_type='X'):
+    return {
+        'pingType': ping_type,
+        'firstCounter': first_counter,
+        'lastCounter': last_counter,
+        'startTime': None if start is None else START + start,
+        'stopTime': None if stop is None else START + stop,
+    }
+
+
+class TestMateLineContinuity(unittest.TestCase):
+
+    def test_continuous(self):
+        results = check_continuity({
+            'b.all': _bounds(101, 200, 101, 200),
+            'a.all': _bounds(1, 100, 0, 100),
+            'c.all': _bounds(201, 300, 201, 300),
+        })
+        self.assertEqual(
+            [r.state for r in results.values()], [ScanState.PASS] * 3)
+        self.assertIsNone(results['a.all'].data['previousFile'])
+        self.assertEqual(results['c.all'].data['previousFile'], 'b.all')
+        self.assertEqual(results['c.all'].data['pingGap'], 0)
+        self.assertEqual(results['c.all'].data['timeGap'], 1.0)
+
+    def test_gaps(self):
+        results = check_continuity({
+            'a.all': _bounds(1, 100, 0, 100),
+            'b.all': _bounds(166, 200, 101, 200),
+            'c.all': _bounds(201, 300, 400, 500),
+        }, max_time_gap=60, max_ping_gap=10)
+        self.assertEqual(results['b.all'].state, ScanState.WARNING)
+        self.assertEqual(results['b.all'].messages, [
+            "65 pings missing after a.all"])
+        self.assertEqual(results['c.all'].state, ScanState.WARNING)
+        self.assertEqual(results['c.all'].messages, [
+            "200.0 second gap after b.all"])
+
+    def test_overlap_and_duplicate(self):
+        results = check_continuity({
+            'a.all': _bounds(1, 100, 0, 100),
+            'copy of a.all': _bounds(1, 100, 0, 100),
+            'b.all': _bounds(90, 200, 90, 200),
+        })
+        self.assertEqual(results['copy of a.all'].state, ScanState.FAIL)
+        self.assertEqual(
+            results['copy of a.all'].messages, ["Duplicate of a.all"])
+        self.assertEqual(results['b.all'].state, ScanState.FAIL)
+        self.assertEqual(
+            results['b.all'].messages,
+            ["Overlaps copy of a.all by 10.0 seconds"])
+
+    def test_counters(self):
+        results = check_continuity({
+            # the uint16 ping counter wraps between the files
+            'a.all': _bounds(65000, 65535, 0, 100),
+            'b.all': _bounds(0, 100, 101, 200),
+            # repeated ping, without the times overlapping
+            'c.all': _bounds(100, 200, 201, 300),
+            # counter reset by a restart of the sonar
+            'd.all': _bounds(1, 100, 3600, 3700),
+            # the counters of different datagram types aren't compared
+            'e.kmall': _bounds(5000, 5100, 3701, 3800, 'MRZ'),
+        })
+        self.assertEqual(results['b.all'].state, ScanState.PASS)
+        self.assertEqual(results['c.all'].state, ScanState.FAIL)
+        self.assertEqual(results['d.all'].state, ScanState.WARNING)
+        self.assertIn(
+            "Ping counter was reset after c.all", results['d.all'].messages)
+        self.assertEqual(results['e.kmall'].state, ScanState.PASS)
+        self.assertIsNone(results['e.kmall'].data['pingGap'])
+
+    def test_unknown_times(self):
+        results = check_continuity({
+            'a.all': _bounds(1, 100, 0, 100),
+            'b.all': _bounds(None, None, None, None, None),
+            'c.all': None,
+        })
+        self.assertEqual(results['a.all'].state, ScanState.PASS)
+        self.assertEqual(results['b.all'].state, ScanState.WARNING)
+        self.assertEqual(results['c.all'].state, ScanState.WARNING)
+
+
+class PingScan(Scan):
+
+    ping_datagram_types = ['X', 'D']
+
+
+class TestMatePingBounds(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(
+            os.path.join(self.temp_dir, "0001_20200107_line.all"), 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_ping_bounds(self):
+        scan = PingScan(self.path)
+        scan.scan_result = {
+            'P': {'pingCount': 0, 'startTime': datetime(2020, 1, 7),
+                  'stopTime': datetime(2020, 1, 7, 0, 10)},
+            'D': {'pingCount': 0, 'startTime': None, 'stopTime': None},
+            'X': {'pingCount': 5, '_firstSeqNo': 10, '_seqNo': 14,
+                  'startTime': datetime(2020, 1, 7, 0, 1),
+                  'stopTime': datetime(2020, 1, 7, 0, 9)},
+        }
+        bounds = scan.ping_bounds()
+        self.assertEqual(bounds['pingType'], 'X')
+        self.assertEqual(bounds['firstCounter'], 10)
+        self.assertEqual(bounds['lastCounter'], 14)
+        self.assertEqual(bounds['startTime'], START + 60)
+        self.assertEqual(bounds['stopTime'], START + 540)
+
+        # without pings the times of the file are used
+        del scan.scan_result['X']
+        bounds = scan.ping_bounds()
+        self.assertIsNone(bounds['pingType'])
+        self.assertIsNone(bounds['firstCounter'])
+        self.assertEqual(bounds['stopTime'], START + 600)
+
+
+class TestMateCheckRunnerSurveyChecks(unittest.TestCase):
+
+    def _check(self, paths):
+        return QajsonCheck.from_dict({
+            'info': {
+                'id': LineContinuityCheck.id,
+                'name': LineContinuityCheck.name,
+                'description': '',
+                'version': LineContinuityCheck.version,
+                'group': {'id': '1', 'name': '1'}
+            },
+            'inputs': {
+                'files': [
+                    {'path': p, 'description': 'raw input',
+                     'file_type': 'Raw Files'}
+                    for p in paths
+                ]
+            }
+        })
+
+    def test_run_survey_checks(self):
+        paths = ['a.all', 'b.all', 'c.all']
+        check = self._check(paths)
+        runner = CheckRunner([check])
+        runner.initialize()
+        summaries = [
+            _bounds(1, 100, 0, 100),
+            _bounds(151, 200, 101, 200),
+            _bounds(201, 300, 201, 300),
+        ]
+        # as gathered from each file by `LineContinuityCheck.run_check`
+        for path, summary in zip(paths, summaries):
+            runner._add_check_output(
+                check, path, QajsonOutputs(data={'summary': summary}))
+        runner._run_survey_checks()
+
+        # the outputs of the files are merged into the check's output
+        self.assertEqual(check.outputs.check_state, ScanState.WARNING)
+        self.assertEqual(check.outputs.execution.status, 'completed')
+        self.assertEqual(
+            check.outputs.messages, ["b.all: 50 pings missing after a.all"])
+        self.assertEqual(
+            check.outputs.data['files']['c.all']['previousFile'], 'b.all')
+
+    def test_files_of_separate_checks(self):
+        ''' Files given to separate checks in the QA JSON are compared '''
+        checks = [self._check([p]) for p in ['a.all', 'b.all']]
+        runner = CheckRunner(checks)
+        runner.initialize()
+        runner._add_check_output(
+            checks[0], 'a.all',
+            QajsonOutputs(data={'summary': _bounds(1, 100, 0, 100)}))
+        runner._add_check_output(
+            checks[1], 'b.all',
+            QajsonOutputs(data={'summary': _bounds(50, 200, 50, 200)}))
+        runner._run_survey_checks()
+        self.assertEqual(checks[0].outputs.check_state, ScanState.PASS)
+        self.assertEqual(checks[1].outputs.check_state, ScanState.FAIL)
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateLineContinuity))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMatePingBounds))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateCheckRunnerSurveyChecks))
+    return s
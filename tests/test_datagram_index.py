@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from hyo2.mate.lib.datagram_index import AllDatagramIndex, \
+    follow_all_datagrams
+
+from tests.synthetic_data import write_all_file, all_height_datagram
+
+
+def as_buffer(data):
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+class TestMateAllDatagramIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(os.path.join(self.temp_dir, "a.all"), 100)
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_clean(self):
+        index = AllDatagramIndex.from_file(self.path)
+        self.assertEqual(len(index.starts), 100)
+        self.assertEqual(index.corrupt_ranges, [])
+        self.assertEqual(int(index.ends[-1]), len(self.data))
+
+    def test_overwritten(self):
+        ''' Garbage in the middle of the file is skipped, and the datagrams
+            following it are found
+        '''
+        damaged = self.data[:300] + b'\x02' * 45 + self.data[345:]
+        index = AllDatagramIndex.from_buffer(as_buffer(damaged))
+        self.assertEqual(index.corrupt_ranges, [(300, 360)])
+        self.assertEqual(len(index.starts), 98)
+        self.assertTrue(index.is_start(360))
+        self.assertFalse(index.is_start(300))
+        self.assertEqual(index.next_start(300), 360)
+        self.assertEqual(index.corrupt_byte_count(), 60)
+
+    def test_truncated(self):
+        # 'h' datagrams are 28 bytes
+        index = AllDatagramIndex.from_buffer(as_buffer(self.data[:-10]))
+        self.assertEqual(index.corrupt_ranges, [(2968, 2990)])
+        self.assertIsNone(index.next_start(2968))
+
+    def test_leading_garbage(self):
+        ''' A datagram embedded in garbage isn't trusted unless it is
+            followed by another datagram
+        '''
+        damaged = b'\x00' * 7 + all_height_datagram() + b'\x00' * 5 + \
+            self.data
+        index = AllDatagramIndex.from_buffer(as_buffer(damaged))
+        self.assertEqual(index.corrupt_ranges, [(0, 40)])
+        self.assertEqual(len(index.starts), 100)
+
+    def test_empty(self):
+        empty = os.path.join(self.temp_dir, "empty.all")
+        open(empty, 'wb').close()
+        index = AllDatagramIndex.from_file(empty)
+        self.assertEqual(index.corrupt_ranges, [])
+        self.assertEqual(len(index.starts), 0)
+
+    def test_random_data(self):
+        data = np.random.default_rng(0).integers(
+            0, 256, 1000000, dtype=np.uint8)
+        index = AllDatagramIndex.from_buffer(data)
+        self.assertEqual(index.corrupt_byte_count(), len(data))
+
+    def test_from_lengths(self):
+        ''' Following the length fields gives the same index as searching
+            the whole file, the search only being made past a corrupt
+            datagram
+        '''
+        starts, ends = follow_all_datagrams(as_buffer(self.data))
+        self.assertEqual(len(starts), 100)
+        self.assertEqual(int(ends[-1]), len(self.data))
+        starts, ends = follow_all_datagrams(
+            as_buffer(self.data[:300] + b'\x02' * 45 + self.data[345:]))
+        self.assertEqual(int(ends[-1]), 300)
+
+        for data in [
+                self.data,
+                self.data[:300] + b'\x02' * 45 + self.data[345:],
+                self.data[:-10],
+                b'\x00' * 7 + all_height_datagram() + b'\x00' * 5 +
+                self.data,
+                b'']:
+            expected = AllDatagramIndex.from_buffer(as_buffer(data))
+            index = AllDatagramIndex.from_lengths(as_buffer(data))
+            np.testing.assert_array_equal(index.starts, expected.starts)
+            np.testing.assert_array_equal(index.ends, expected.ends)
+            self.assertEqual(index.corrupt_ranges, expected.corrupt_ranges)
+            self.assertEqual(index.size, expected.size)
+
+    def test_benchmark(self):
+        ''' Indexing is vectorised, a file of a million (small) datagrams
+            is indexed in well under a few seconds
+        '''
+        data = as_buffer(self.data * 10000)
+        start = time.perf_counter()
+        index = AllDatagramIndex.from_buffer(data, chunk_size=4 * 1024 * 1024)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(index.starts), 1000000)
+        self.assertLess(elapsed, 5.0)
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateAllDatagramIndex))
+    return s
@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ausseabed.qajson.model import QajsonCheck
+
+from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.duplicates import content_fingerprint, find_duplicates, \
+    BLOCK_RECORDS, EXACT_DUPLICATE, PREFIX_DUPLICATE
+from hyo2.mate.lib.raw_file import open_raw_file
+from hyo2.mate.lib.scan import ScanState
+from hyo2.mate.lib.scan_ALL import _parse_all_header
+from hyo2.mate.lib.scan_check import FilenameChangedCheck
+from hyo2.mate.lib.time_index import walk_headers
+
+from tests.synthetic_data import write_all_file
+from tests.test_scan import HeaderScan
+
+DATAGRAM_COUNT = 1000
+
+
+class IndexedScan(HeaderScan):
+    '''Indexes the synthetic .all file from its headers'''
+
+    def _build_time_index(self):
+        with open_raw_file(self.file_path) as raw_file:
+            return walk_headers(raw_file.stream, _parse_all_header)
+
+
+class TestMateDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original = self._path("0001_20200107_line.all")
+        write_all_file(self.original, DATAGRAM_COUNT)
+        with open(self.original, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _path(self, name):
+        return os.path.join(self.temp_dir, name)
+
+    def _write(self, name, data):
+        path = self._path(name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _fingerprint(self, path):
+        with IndexedScan(path) as scan:
+            return content_fingerprint(scan)
+
+    def test_fingerprint(self):
+        fingerprint = self._fingerprint(self.original)
+        self.assertEqual(fingerprint.count, DATAGRAM_COUNT)
+        self.assertEqual(
+            len(fingerprint.blocks), DATAGRAM_COUNT // BLOCK_RECORDS)
+        # first, last and each power of two
+        self.assertEqual(
+            sorted(fingerprint.samples),
+            [0, 1, 3, 7, 15, 31, 63, 127, 255, 511, 999])
+
+        # the datagram cut off at the end of a truncated file isn't included
+        truncated = self._write("truncated.all", self.data[:-5])
+        self.assertEqual(
+            self._fingerprint(truncated).count, DATAGRAM_COUNT - 1)
+
+    def test_find_duplicates(self):
+        copy = self._write("copy of line.all", self.data)
+        # cut off part way through a datagram, as a copy made while the
+        # line was being logged would be
+        prefix = self._write("partial.all", self.data[:len(self.data) // 2])
+        # same headers, but a sampled payload is different
+        with IndexedScan(self.original) as scan:
+            offset = int(scan.get_time_index().offsets[511])
+        changed = bytearray(self.data)
+        changed[offset + 20] ^= 0xFF
+        changed = self._write("changed.all", bytes(changed))
+        # too short to be compared as a truncated copy
+        short = self._write("short.all", self.data[:100])
+        # the original continues on into a longer file
+        longer = write_all_file(self._path("longer.all"), DATAGRAM_COUNT + 1)
+
+        paths = [prefix, self.original, copy, changed, short, longer]
+        groups = find_duplicates([self._fingerprint(p) for p in paths])
+        self.assertEqual(len(groups), 1)
+        # the longest, then first given, file is the original
+        self.assertEqual(groups[0]['original'], longer)
+        self.assertEqual(groups[0]['duplicates'], [
+            {'path': self.original, 'type': PREFIX_DUPLICATE},
+            {'path': copy, 'type': PREFIX_DUPLICATE},
+            {'path': prefix, 'type': PREFIX_DUPLICATE},
+        ])
+
+        paths = [self.original, copy, changed, short]
+        groups = find_duplicates([self._fingerprint(p) for p in paths])
+        self.assertEqual(groups, [{
+            'original': self.original,
+            'duplicates': [{'path': copy, 'type': EXACT_DUPLICATE}],
+        }])
+
+    def test_skip_duplicates(self):
+        copy = self._write("copy of line.all", self.data)
+        check = QajsonCheck.from_dict({
+            'info': {
+                'id': FilenameChangedCheck.id,
+                'name': FilenameChangedCheck.name,
+                'description': '',
+                'version': FilenameChangedCheck.version,
+                'group': {'id': '1', 'name': '1'}
+            },
+            'inputs': {
+                'files': [
+                    {'path': copy, 'description': 'raw input',
+                     'file_type': 'Raw Files'}
+                ]
+            }
+        })
+        runner = CheckRunner([check])
+        runner.initialize()
+        runner._record_duplicates(find_duplicates([
+            self._fingerprint(p) for p in [self.original, copy]]))
+        self.assertEqual(
+            runner.duplicate_groups[0]['original'], self.original)
+
+        # the duplicate is given an output without being scanned
+        completed = runner._check_file(
+            copy, 'Raw Files', [check], lambda p: None, None)
+        self.assertTrue(completed)
+        self.assertEqual(check.outputs.check_state, ScanState.WARNING)
+        self.assertEqual(check.outputs.execution.status, 'completed')
+        self.assertEqual(
+            check.outputs.messages,
+            ["Not checked, exact duplicate of {}".format(self.original)])
+        self.assertEqual(check.outputs.data['duplicateOf'], self.original)
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateDuplicates))
+    return s
@@ -0,0 +1,159 @@
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pytest
+
+from hyo2.mate.lib.export import ParquetExporter, read_table, _days, \
+    DATAGRAMS_TABLE, POSITIONS_TABLE, ATTITUDE_TABLE
+from hyo2.mate.lib.scan_ALL import _parse_all_header
+from hyo2.mate.lib.time_index import walk_headers, to_timestamp
+from hyo2.mate.lib.raw_file import open_raw_file
+
+from tests.synthetic_data import all_clock_datagram, write_all_file
+from tests.test_scan import HeaderScan
+
+pyarrow = pytest.importorskip("pyarrow")
+
+
+class IndexedScan(HeaderScan):
+    '''
+    Indexes the synthetic .all file from its headers, with a position for
+    each clock datagram
+    '''
+
+    def _build_time_index(self):
+        with open_raw_file(self.file_path) as raw_file:
+            return walk_headers(raw_file.stream, _parse_all_header)
+
+    def position_table(self):
+        index = self.get_time_index()
+        times = index.times[index.types == 'C']
+        return {
+            'time': times,
+            'latitude': np.linspace(-42.0, -41.0, len(times)),
+            'longitude': np.linspace(147.0, 148.0, len(times)),
+        }
+
+
+class TestMateParquetExport(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.temp_dir, "export")
+        self.path = write_all_file(
+            os.path.join(self.temp_dir, "0001_20200107_line.all"), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_days(self):
+        start = to_timestamp(datetime(2020, 1, 7))
+        times = np.array([np.nan, start, np.nan, start + 86400, np.nan])
+        self.assertEqual(
+            list(_days(times)),
+            ['2020-01-07', '2020-01-07', '2020-01-07', '2020-01-08',
+             '2020-01-08'])
+        self.assertEqual(list(_days(np.array([np.nan]))), ['unknown'])
+
+    def test_export(self):
+        exporter = ParquetExporter(self.root, 'S1')
+        self.assertFalse(exporter.is_exported(self.path, 'Investigator'))
+        with IndexedScan(self.path) as scan:
+            paths = exporter.export(scan, 'Investigator')
+        self.assertTrue(exporter.is_exported(self.path, 'Investigator'))
+        self.assertFalse(exporter.is_exported(self.path, 'Bluefin'))
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(
+            os.path.dirname(paths[0]),
+            os.path.join(
+                self.root, DATAGRAMS_TABLE, 'survey=S1',
+                'vessel=Investigator', 'day=2020-01-07'))
+        self.assertTrue(os.path.basename(paths[0]).startswith(
+            '0001_20200107_line.all-'))
+        # the attitude table isn't supported by the scan
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, ATTITUDE_TABLE)))
+
+        columns = read_table(self.root, DATAGRAMS_TABLE, survey='S1')
+        self.assertEqual(len(columns['offset']), 100)
+        self.assertEqual(list(columns['type'][:2]), ['h', 'C'])
+        self.assertEqual(list(columns['size'][:2]), [28, 32])
+        self.assertEqual(
+            int(columns['offset'][-1] + columns['size'][-1]),
+            os.path.getsize(self.path))
+        self.assertTrue(np.all(columns['counter'] == -1))
+        self.assertEqual(columns['file'][0], self.path)
+        self.assertEqual(columns['vessel'][0], 'Investigator')
+        self.assertEqual(columns['day'][0], '2020-01-07')
+
+        positions = read_table(self.root, POSITIONS_TABLE, vessel='Bluefin')
+        self.assertEqual(len(positions['time']), 0)
+        positions = read_table(
+            self.root, POSITIONS_TABLE, vessel='Investigator')
+        self.assertEqual(len(positions['latitude']), 50)
+
+        # exporting again replaces the file's data
+        with IndexedScan(self.path) as scan:
+            exporter.export(scan, 'Investigator')
+        columns = read_table(self.root, DATAGRAMS_TABLE)
+        self.assertEqual(len(columns['offset']), 100)
+
+    def test_export_again(self):
+        ''' Days that are no longer in a file exported again don't keep its
+            old rows, and files of the same name in other directories don't
+            replace each other
+        '''
+        exporter = ParquetExporter(self.root, 'S1')
+        with open(self.path, 'wb') as f:
+            for i in range(10):
+                f.write(all_clock_datagram(
+                    record_date=20200108, record_time=i * 1000, counter=i))
+        with IndexedScan(self.path) as scan:
+            exporter.export(scan, 'Investigator')
+        write_all_file(self.path, 100)
+        with IndexedScan(self.path) as scan:
+            exporter.export(scan, 'Investigator')
+        columns = read_table(self.root, DATAGRAMS_TABLE)
+        self.assertEqual(len(columns['offset']), 100)
+        self.assertEqual(set(columns['day']), {'2020-01-07'})
+
+        other_dir = os.path.join(self.temp_dir, "other")
+        os.mkdir(other_dir)
+        other = write_all_file(
+            os.path.join(other_dir, os.path.basename(self.path)), 50)
+        with IndexedScan(other) as scan:
+            exporter.export(scan, 'Investigator')
+        self.assertTrue(exporter.is_exported(self.path, 'Investigator'))
+        self.assertTrue(exporter.is_exported(other, 'Investigator'))
+        columns = read_table(self.root, DATAGRAMS_TABLE)
+        self.assertEqual(len(columns['offset']), 150)
+        self.assertEqual(set(columns['file']), {self.path, other})
+
+    def test_zero_copy(self):
+        exporter = ParquetExporter(self.root, 'S1')
+        with IndexedScan(self.path) as scan:
+            exporter.export(scan)
+        columns = read_table(self.root, DATAGRAMS_TABLE, vessel=None)
+        # numpy doesn't own the data read from Parquet
+        self.assertFalse(columns['time'].flags.owndata)
+        self.assertEqual(columns['vessel'][0], 'unknown')
+
+        # a chunk for each file, joined into one array
+        second = write_all_file(
+            os.path.join(self.temp_dir, "0002_20200107_line.all"), 50)
+        with IndexedScan(second) as scan:
+            exporter.export(scan)
+        columns = read_table(self.root, DATAGRAMS_TABLE)
+        self.assertEqual(len(columns['time']), 150)
+        self.assertEqual(set(columns['file']), {self.path, second})
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateParquetExport))
+    return s
@@ -0,0 +1,105 @@
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from hyo2.mate.lib.format_detect import detect_format, \
+    detect_format_from_bytes, clear_format_cache
+from hyo2.mate.lib.raw_file import close_archives
+from hyo2.mate.lib.utils import get_scan
+
+from tests.synthetic_data import write_all_file, write_kmall_file, \
+    gsf_header_record
+
+
+class TestMateFormatDetect(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        clear_format_cache()
+
+    def tearDown(self):
+        close_archives()
+        clear_format_cache()
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_from_bytes(self):
+        all_path = write_all_file(os.path.join(self.temp_dir, "a.all"), 10)
+        kmall_path = write_kmall_file(
+            os.path.join(self.temp_dir, "a.kmall"), 10)
+        with open(all_path, 'rb') as f:
+            self.assertEqual(detect_format_from_bytes(f.read()), 'all')
+        with open(kmall_path, 'rb') as f:
+            self.assertEqual(detect_format_from_bytes(f.read()), 'kmall')
+        self.assertEqual(
+            detect_format_from_bytes(gsf_header_record() + bytes(100)), 'gsf')
+        self.assertIsNone(detect_format_from_bytes(b''))
+        self.assertIsNone(detect_format_from_bytes(b'depth,lat,lon\n' * 10))
+        # a .all header whose ETX isn't where the length says
+        self.assertIsNone(detect_format_from_bytes(
+            struct.pack('<I', 30) + b'\x02h' + bytes(40)))
+
+    def test_misnamed(self):
+        ''' Files are read with the reader for their contents, whatever
+            their extension
+        '''
+        kmall_path = write_kmall_file(
+            os.path.join(self.temp_dir, "renamed.all"), 10)
+        all_path = write_all_file(
+            os.path.join(self.temp_dir, "export.dat"), 10)
+        gsf_path = self._write(
+            "line.ALL", gsf_header_record() + bytes(100))
+        with get_scan(kmall_path, 'all', 'Raw Files') as scan:
+            self.assertEqual(type(scan).__name__, 'ScanKMALL')
+        with get_scan(all_path, 'dat', 'Raw Files') as scan:
+            self.assertEqual(type(scan).__name__, 'ScanALL')
+        with get_scan(gsf_path, 'ALL', 'Raw Files') as scan:
+            self.assertEqual(type(scan).__name__, 'ScanGsf')
+
+    def test_unrecognised_uses_extension(self):
+        path = self._write("empty.all", b'')
+        self.assertIsNone(detect_format(path))
+        with get_scan(path, 'all', 'Raw Files') as scan:
+            self.assertEqual(type(scan).__name__, 'ScanALL')
+        self.assertIsNone(detect_format(
+            os.path.join(self.temp_dir, "missing.all")))
+
+    def test_compressed_and_archived(self):
+        all_path = write_all_file(os.path.join(self.temp_dir, "a.dat"), 10)
+        with open(all_path, 'rb') as f:
+            data = f.read()
+        gz_path = self._write("a.dat.gz", gzip.compress(data))
+        self.assertEqual(detect_format(gz_path), 'all')
+        zip_path = os.path.join(self.temp_dir, "survey.zip")
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr("lines/a.dat", data)
+        self.assertEqual(detect_format(zip_path + "!/lines/a.dat"), 'all')
+
+    def test_cached(self):
+        path = write_all_file(os.path.join(self.temp_dir, "a.dat"), 10)
+        self.assertEqual(detect_format(path), 'all')
+        stat = os.stat(path)
+        # same size and modification time, so the cached format is used
+        with open(path, 'r+b') as f:
+            f.write(bytes(8))
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(detect_format(path), 'all')
+        # a change to the file is detected again
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(detect_format(path))
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateFormatDetect))
+    return s
@@ -0,0 +1,129 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from hyo2.mate.lib.integrity import verify_all, verify_kmall
+
+from tests.synthetic_data import write_all_file, write_kmall_file
+
+
+class TestMateAllIntegrity(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(os.path.join(self.temp_dir, "a.all"), 100)
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data):
+        path = os.path.join(self.temp_dir, "damaged.all")
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_clean(self):
+        report = verify_all(self.path)
+        self.assertTrue(report.is_valid)
+        self.assertEqual(report.datagram_count, 100)
+        self.assertEqual(report.size, len(self.data))
+
+    def test_bad_datagrams(self):
+        ''' Datagrams with a bad checksum or ETX are reported by offset,
+            and the datagrams after them are still verified
+        '''
+        damaged = bytearray(self.data)
+        # body of the third datagram (a 28 byte 'h' datagram at 60), the
+        # checksum no longer matches
+        damaged[70] ^= 0xFF
+        # ETX of the fourth datagram (a 32 byte 'C' datagram at 88)
+        damaged[88 + 32 - 3] = 0
+        damaged = bytes(damaged[:300]) + b'\x02' * 45 + \
+            bytes(damaged[345:-10])
+        report = verify_all(self._write(damaged))
+        self.assertFalse(report.is_valid)
+        self.assertEqual(
+            report.bad_datagrams, [(60, 'checksum'), (88, 'etx')])
+        self.assertEqual(report.corrupt_ranges, [(300, 360), (2968, 2990)])
+        self.assertEqual(report.datagram_count, 97)
+
+    def test_stream(self):
+        ''' Streams (eg; compressed files) give the same result as the
+            memory mapped file, whatever the chunk size
+        '''
+        damaged = self.data[:300] + b'\x02' * 45 + self.data[345:-10]
+        path = self._write(damaged)
+        expected = verify_all(path)
+        with gzip.open(path + '.gz', 'wb') as f:
+            f.write(damaged)
+        for chunk_size in [128, 1000, 1024 * 1024]:
+            with gzip.open(path + '.gz', 'rb') as f:
+                report = verify_all(stream=f, chunk_size=chunk_size)
+            self.assertEqual(report.corrupt_ranges, expected.corrupt_ranges)
+            self.assertEqual(report.datagram_count, expected.datagram_count)
+            self.assertEqual(
+                verify_all(path, chunk_size=chunk_size).corrupt_ranges,
+                expected.corrupt_ranges)
+
+    def test_empty(self):
+        report = verify_all(self._write(b''))
+        self.assertTrue(report.is_valid)
+        self.assertEqual(report.datagram_count, 0)
+
+    def test_benchmark(self):
+        ''' Verification is vectorised, a file of a million (small)
+            datagrams is verified in a few seconds
+        '''
+        path = self._write(self.data * 10000)
+        start = time.perf_counter()
+        report = verify_all(path, chunk_size=4 * 1024 * 1024)
+        elapsed = time.perf_counter() - start
+        self.assertTrue(report.is_valid)
+        self.assertEqual(report.datagram_count, 1000000)
+        self.assertLess(elapsed, 10.0)
+
+
+class TestMateKmallIntegrity(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_kmall_file(
+            os.path.join(self.temp_dir, "a.kmall"), 50)
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_clean(self):
+        report = verify_kmall(self.path)
+        self.assertTrue(report.is_valid)
+        self.assertEqual(report.datagram_count, 50)
+
+    def test_length_mismatch(self):
+        damaged = bytearray(self.data)
+        # the repeated length of the first datagram
+        first_length = int.from_bytes(damaged[0:4], 'little')
+        damaged[first_length - 4] ^= 0x01
+        path = os.path.join(self.temp_dir, "damaged.kmall")
+        with open(path, 'wb') as f:
+            f.write(bytes(damaged[:-5]))
+        report = verify_kmall(path)
+        self.assertEqual(report.bad_datagrams, [(0, 'length')])
+        self.assertEqual(len(report.corrupt_ranges), 1)
+        self.assertEqual(report.corrupt_ranges[0][1], len(self.data) - 5)
+        self.assertEqual(report.datagram_count, 49)
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateAllIntegrity))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateKmallIntegrity))
+    return s
@@ -0,0 +1,246 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from hyo2.mate.lib.raw_file import split_compression_suffix, \
+    split_archive_path, raw_file_extension, raw_file_name, open_raw_file, \
+    get_archive, close_archives, stored_file_size
+from hyo2.mate.lib.scan_ALL import ScanALL
+from hyo2.mate.lib.utils import get_scan
+
+from tests.synthetic_data import write_all_file
+
+
+class TestMateRawFile(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = bytes(random.getrandbits(8) for _ in range(300000))
+        self.path = os.path.join(self.temp_dir, "line.all")
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_suffixes(self):
+        self.assertEqual(
+            split_compression_suffix("a/line.all.gz"), ("a/line.all", "gzip"))
+        self.assertEqual(
+            split_compression_suffix("line.kmall.ZST"),
+            ("line.kmall", "zstd"))
+        self.assertEqual(
+            split_compression_suffix("line.gsf"), ("line.gsf", None))
+        self.assertEqual(raw_file_extension("line.gsf.bz2"), "gsf")
+        self.assertEqual(raw_file_extension("line.all"), "all")
+        self.assertEqual(
+            raw_file_name("/data/0001_line.all.xz"), "0001_line.all")
+
+    def _check_reads(self, path):
+        with open_raw_file(path) as raw_file:
+            stream = raw_file.stream
+            # format readers read a header, seek back and read the datagram
+            position = 0
+            while not raw_file.at_end():
+                header = stream.read(8)
+                stream.seek(-len(header), 1)
+                chunk = stream.read(1000)
+                self.assertEqual(chunk, self.data[position:position + 1000])
+                position += len(chunk)
+            self.assertEqual(position, len(self.data))
+            self.assertEqual(raw_file.size, len(self.data))
+            self.assertEqual(raw_file.position(), os.path.getsize(path))
+            # jumping back a long way restarts reading
+            stream.seek(10)
+            self.assertEqual(stream.read(10), self.data[10:20])
+
+    def test_uncompressed(self):
+        self._check_reads(self.path)
+
+    def test_compressed(self):
+        for suffix, compress in [
+                ('.gz', gzip.compress),
+                ('.bz2', bz2.compress),
+                ('.xz', lzma.compress)]:
+            path = self.path + suffix
+            with open(path, 'wb') as f:
+                f.write(compress(self.data))
+            with open_raw_file(path) as raw_file:
+                self.assertTrue(raw_file.is_compressed)
+                # the decompressed size isn't known up front
+                self.assertIsNone(raw_file.size)
+            self._check_reads(path)
+
+
+class TestMateArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = bytes(random.getrandbits(8) for _ in range(300000))
+        self.compressed = gzip.compress(self.data)
+
+    def tearDown(self):
+        close_archives()
+        shutil.rmtree(self.temp_dir)
+
+    def _check_member(self, path):
+        self.assertEqual(stored_file_size(path), len(self.data))
+        with open_raw_file(path) as raw_file:
+            self.assertEqual(raw_file.size, len(self.data))
+            stream = raw_file.stream
+            stream.seek(200000)
+            self.assertEqual(stream.read(100), self.data[200000:200100])
+            # small backward seek, as made by the format readers
+            stream.seek(-50, 1)
+            self.assertEqual(stream.read(50), self.data[200050:200100])
+            stream.seek(0)
+            self.assertEqual(stream.read(), self.data)
+            self.assertTrue(raw_file.at_end())
+
+    def test_split_archive_path(self):
+        self.assertEqual(
+            split_archive_path("a/survey.zip!/lines/0001.all"),
+            ("a/survey.zip", "lines/0001.all"))
+        self.assertEqual(
+            split_archive_path("a/0001.all"), ("a/0001.all", None))
+        self.assertEqual(
+            raw_file_extension("survey.zip!/lines/0001.all"), "all")
+        self.assertEqual(
+            raw_file_name("survey.zip!/lines/0001.all.gz"), "0001.all")
+
+    def test_zip(self):
+        path = os.path.join(self.temp_dir, "survey.zip")
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr(
+                "deflated.all", self.data, compress_type=zipfile.ZIP_DEFLATED)
+            zf.writestr(
+                "lines/stored.all", self.data,
+                compress_type=zipfile.ZIP_STORED)
+            zf.writestr("compressed.all.gz", self.compressed)
+        self._check_member(path + "!/deflated.all")
+        self._check_member(path + "!/lines/stored.all")
+        with open_raw_file(path + "!/compressed.all.gz") as raw_file:
+            self.assertEqual(raw_file.stream.read(), self.data)
+        with self.assertRaises(FileNotFoundError):
+            open_raw_file(path + "!/missing.all")
+        # the member list is only read once
+        self.assertIs(get_archive(path), get_archive(path))
+        self.assertEqual(
+            sorted(get_archive(path).member_names()),
+            ["compressed.all.gz", "deflated.all", "lines/stored.all"])
+
+    def test_archive_lifetime(self):
+        path = os.path.join(self.temp_dir, "survey.zip")
+        with zipfile.ZipFile(path, 'w') as zf:
+            zf.writestr("0001.all", self.data)
+        member = path + "!/0001.all"
+        raw_file = open_raw_file(member)
+        archive = get_archive(path)
+        self.assertEqual(archive.users, 1)
+
+        # an archive replaced, or closed, while a member is being read isn't
+        # closed until the member is
+        os.utime(path, ns=(0, 0))
+        self.assertIsNot(get_archive(path), archive)
+        close_archives()
+        self.assertIsNotNone(archive._zip.fp)
+        self.assertEqual(raw_file.stream.read(), self.data)
+        raw_file.close()
+        self.assertEqual(archive.users, 0)
+        self.assertIsNone(archive._zip.fp)
+
+        # idle archives are closed
+        with open_raw_file(member):
+            pass
+        archive = get_archive(path)
+        close_archives()
+        self.assertIsNone(archive._zip.fp)
+
+    def test_tar(self):
+        for mode, suffix in [('w', '.tar'), ('w:gz', '.tar.gz')]:
+            path = os.path.join(self.temp_dir, "survey" + suffix)
+            with tarfile.open(path, mode) as tf:
+                for name in ["0001.all", "0002.all"]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(self.data)
+                    tf.addfile(info, io.BytesIO(self.data))
+            self._check_member(path + "!/0002.all")
+            with open_raw_file(path + "!/0002.all", read_ahead=True) as f:
+                self.assertEqual(f.stream.read(), self.data)
+
+    def test_not_archive(self):
+        path = os.path.join(self.temp_dir, "line.all")
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        with self.assertRaises(ValueError):
+            open_raw_file(path + "!/line.all")
+        self.assertEqual(stored_file_size(path + "!/line.all"), 0)
+
+
+class TestMateScanCompressed(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(
+            os.path.join(self.temp_dir, "0001_20200107_line.all"), 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_scan_gzip(self):
+        ''' Compressed .all files give the same scan results as the
+            uncompressed file
+        '''
+        gz_path = self.path + '.gz'
+        with open(self.path, 'rb') as f_in, gzip.open(gz_path, 'wb') as f_out:
+            f_out.write(f_in.read())
+
+        with ScanALL(self.path) as scan:
+            scan.scan_datagram()
+            expected = scan.scan_result
+            expected_size_matched = scan.is_size_matched()
+
+        progress = []
+        with get_scan(gz_path, 'gz', 'Raw Files') as scan:
+            self.assertIsInstance(scan, ScanALL)
+            scan.scan_datagram(progress.append)
+            self.assertEqual(scan.scan_result, expected)
+            self.assertEqual(scan.is_size_matched(), expected_size_matched)
+            self.assertEqual(scan.data_size, os.path.getsize(self.path))
+        self.assertEqual(progress[-1], 1.0)
+
+    def test_scan_archive_member(self):
+        ''' Members of an archive give the same scan results as the
+            extracted file
+        '''
+        zip_path = os.path.join(self.temp_dir, "survey.zip")
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.write(self.path, os.path.basename(self.path))
+
+        with ScanALL(self.path) as scan:
+            scan.scan_datagram()
+            expected = scan.scan_result
+
+        member_path = zip_path + "!/" + os.path.basename(self.path)
+        with get_scan(member_path, 'all', 'Raw Files') as scan:
+            self.assertEqual(scan.file_size, os.path.getsize(self.path))
+            scan.scan_datagram()
+            self.assertEqual(scan.scan_result, expected)
+        close_archives()
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateRawFile))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateArchive))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateScanCompressed))
+    return s
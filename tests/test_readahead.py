@@ -0,0 +1,109 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from hyo2.mate.lib.readahead import ReadAheadFile, open_read_ahead, \
+    FilePrefetcher
+
+
+class CountingFile(io.BytesIO):
+    ''' In memory file that counts the reads made of it. On a network share
+    each read pays a fixed latency.
+    '''
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return super().read(size)
+
+
+def read_like_format_reader(f, datagram_size=500):
+    ''' Reads a file with the access pattern of the format readers; a small
+    header read, a seek back, then the datagram itself.
+    '''
+    total = 0
+    while True:
+        header = f.read(8)
+        if len(header) == 0:
+            return total
+        f.seek(-len(header), 1)
+        total += len(f.read(datagram_size))
+
+
+class TestMateReadAhead(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = random.Random(0).randbytes(2 * 1024 * 1024 + 123)
+        self.path = os.path.join(self.temp_dir, "data.bin")
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_random_access(self):
+        ''' Reads and seeks give the same data as the underlying file '''
+        rnd = random.Random(1)
+        position = 0
+        with open_read_ahead(self.path, block_size=64 * 1024, depth=3) as f:
+            for _ in range(5000):
+                op = rnd.random()
+                if op < 0.6:
+                    size = rnd.randint(0, 5000)
+                    data = f.read(size)
+                    self.assertEqual(
+                        data, self.data[position:position + size])
+                    position += len(data)
+                elif op < 0.8:
+                    position = max(0, position - rnd.randint(0, 100000))
+                    f.seek(position)
+                elif op < 0.95:
+                    position += rnd.randint(0, 300000)
+                    f.seek(position)
+                else:
+                    position = rnd.randint(0, len(self.data) + 10)
+                    f.seek(position)
+                self.assertEqual(f.tell(), position)
+            f.seek(-10, 2)
+            self.assertEqual(f.read(), self.data[-10:])
+
+    def test_read_count(self):
+        ''' Reading ahead reads the underlying file once per block, rather
+        than twice per datagram.
+        '''
+        data = self.data[:256 * 1024]
+        block_size = 64 * 1024
+
+        direct_file = CountingFile(data)
+        direct = read_like_format_reader(direct_file)
+
+        read_ahead_file = CountingFile(data)
+        with ReadAheadFile(read_ahead_file, block_size=block_size) as f:
+            read_ahead = read_like_format_reader(f)
+
+        self.assertEqual(direct, len(data))
+        self.assertEqual(read_ahead, len(data))
+        # a header and a datagram read for each 500 byte datagram
+        self.assertGreater(direct_file.reads, 2 * len(data) // 500)
+        # each block, and the read that finds the end of the file
+        self.assertLessEqual(
+            read_ahead_file.reads, len(data) // block_size + 1)
+
+    def test_prefetcher(self):
+        prefetcher = FilePrefetcher(self.path)
+        prefetcher.cancel()
+        # missing files are ignored
+        FilePrefetcher(self.path + ".missing").cancel()
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateReadAhead))
+    return s
@@ -1,9 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from datetime import datetime
+import gzip
 import unittest
 import os
 import pytest
+import shutil
+import struct
+import tempfile
 import time
+from hyo2.mate.lib.datagram_index import find_all_candidates
+from hyo2.mate.lib.scan_ALL import ScanALL, _all_header_info, \
+    _all_parameters_bytes
+from hyo2.mate.lib.scan_KMALL import _kmall_header_info
 from hyo2.mate.lib.utils import get_scan
-from hyo2.mate.lib.scan import ScanResult, ScanState
+from tests.synthetic_data import write_all_file, all_datagram, \
+    all_height_datagram, all_clock_datagram, kmall_datagram
+from hyo2.mate.lib.scan import Scan, ScanResult, ScanState, ScanProgress
 
 TEST_FILE1 = "0200_MBES_EM122_20150203_010431_Supporter_GA4430.all"
 TEST_FILE = "0243_P007_MBES_EM122_20150207_044356_Supporter_GA4430.all"
@@ -49,9 +62,504 @@ class TestMateScanResult(unittest.TestCase):
         # note the ScanResult messages should still be a list
         self.assertSequenceEqual(sr.messages, ["The only message"])
 
+    def test_message_default_not_shared(self):
+        ''' Each scan result gets its own list of messages '''
+        a = ScanResult(ScanState.PASS)
+        a.messages.append("only in a")
+        b = ScanResult(ScanState.PASS)
+        self.assertSequenceEqual(b.messages, [])
+
+
+class TestMateScanConcurrent(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.files = [
+            write_all_file(
+                os.path.join(self.temp_dir, "{:03d}.all".format(i)),
+                200 + i * 10)
+            for i in range(64)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def _scan(path):
+        with ScanALL(path) as scan:
+            scan.scan_datagram()
+            return scan.scan_result
+
+    def test_threaded_matches_serial(self):
+        ''' Scanning many files concurrently gives the same results as
+            scanning them one after the other
+        '''
+        serial = [self._scan(path) for path in self.files]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            threaded = list(executor.map(self._scan, self.files))
+        self.assertEqual(serial, threaded)
+        # each file has a different number of datagrams, so results that
+        # leak between scans would not match
+        self.assertNotEqual(serial[0], serial[1])
+
+
+class TestMateScanProgress(unittest.TestCase):
+
+    def test_throttled_by_bytes(self):
+        ''' Progress is only reported once every `poll_bytes` '''
+        reported = []
+        sp = ScanProgress(
+            1000, reported.append, poll_bytes=100, min_interval=0)
+        for position in range(0, 1000, 10):
+            sp.update(position)
+        sp.finish()
+        self.assertEqual(len(reported), 11)
+        self.assertEqual(reported[-1], 1.0)
+
+    def test_throttled_by_time(self):
+        ''' Progress is reported at most once per `min_interval` seconds '''
+        reported = []
+        sp = ScanProgress(
+            1000, reported.append, poll_bytes=1, min_interval=3600)
+        for position in range(1000):
+            sp.update(position)
+        self.assertEqual(len(reported), 1)
+
+    def test_stopped(self):
+        stop_requests = []
+        sp = ScanProgress(
+            1000, None, lambda: len(stop_requests) > 0, poll_bytes=100)
+        self.assertFalse(sp.update(0))
+        stop_requests.append(True)
+        # stop isn't polled until another `poll_bytes` have been read
+        self.assertFalse(sp.update(50))
+        self.assertTrue(sp.update(100))
+        self.assertTrue(sp.stopped)
+
+
+class HeaderScan(Scan):
+    '''
+    Counts the datagrams in a .all file from their headers alone, to test
+    sampled, incremental and metadata scans independently of the format
+    readers. The counter of each clock datagram is kept as its metadata.
+    '''
+
+    metadata_datagram_types = ['C']
+
+    def __init__(self, file_path):
+        Scan.__init__(self, file_path)
+        self._open_raw_file()
+        self.scanned_count = 0
+
+    def scan_datagram(
+            self, progress_callback=None, is_stopped=None, incremental=False):
+        self._scan_datagrams(progress_callback, is_stopped, incremental)
+
+    def _datagram_end(self, position, length):
+        return position + length + 4
+
+    def _scan_next(self):
+        stream = self.raw_file.stream
+        num_bytes, stx, dg_type, _, _, _, counter, _ = struct.unpack(
+            '<LBBHLLHH', stream.read(20))
+        stream.seek(num_bytes - 16, 1)
+        self.scanned_count += 1
+        dg_type = chr(dg_type)
+        if dg_type not in self.scan_result:
+            self.scan_result[dg_type] = copy(self.default_info)
+            self.scan_result[dg_type]['_seqNo'] = None
+        info = self.scan_result[dg_type]
+        info['recordCount'] += 1
+        info['byteCount'] += num_bytes + 4
+        if dg_type == 'C':
+            self._push_datagram(dg_type, counter)
+        if dg_type == 'h':
+            if info['_seqNo'] is not None and counter > info['_seqNo']:
+                info['missedPings'] += counter - info['_seqNo'] - 1
+            info['pingCount'] += 1
+            info['_seqNo'] = counter
+
+    def _find_candidates(self, buffer):
+        return find_all_candidates(buffer)
+
+    def _header_info(self, header):
+        return _all_header_info(header)
+
+
+class RuntimeDatagram:
+    '''
+    Stands in for a decoded R datagram. Like pyall, the parameters string
+    doesn't give every difference in the bytes of the datagram, here the
+    case of the body.
+    '''
+
+    def __init__(self, counter, body):
+        self.counter = counter
+        self.body = body
+
+    def parameters(self):
+        return self.body.upper().decode()
+
+
+class ParametersScan(HeaderScan):
+    '''
+    Keeps the runtime parameters (R) datagrams where the parameters changed
+    '''
+
+    def _scan_next(self):
+        start = self.raw_file.stream.tell()
+        HeaderScan._scan_next(self)
+        data = self._read_datagram_bytes(start)
+        if chr(data[5]) == 'R' and self._parameters_changed(
+                'R', _all_parameters_bytes(data)):
+            counter = struct.unpack_from('<H', data, 16)[0]
+            self._push_changed_parameters(
+                'R', RuntimeDatagram(counter, _all_parameters_bytes(data)))
+
+    def changed_counters(self):
+        return [d.counter for d in self.datagrams.get('R', [])]
+
+
+def _compare_parameters(datagrams):
+    '''
+    Counters of the datagrams where the parameters changed, found by
+    comparing the parameters of every datagram with those of the last one
+    kept, as runtime_parameters did before the scan kept only the changes
+    '''
+    counters = []
+    string = ""
+    for datagram in datagrams:
+        if datagram.parameters() != string:
+            counters.append(datagram.counter)
+            string = datagram.parameters()
+    return counters
+
+
+class TestMateScanParameters(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "0001_20200107_line.all")
+        self.bodies = [b'ABCD', b'ABCD', b'ABCE', b'ABCE', b'ABCD']
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, bodies, mode='wb', first_counter=0):
+        with open(self.path, mode) as f:
+            for i, body in enumerate(bodies):
+                counter = first_counter + i
+                # the time and counter change in every datagram
+                f.write(all_datagram(
+                    'R', body, record_time=counter * 1000, counter=counter))
+                f.write(all_height_datagram(counter=counter))
+
+    def test_changed_parameters(self):
+        self._write(self.bodies)
+        with ParametersScan(self.path) as scan:
+            scan.scan_datagram()
+            self.assertEqual(scan.changed_counters(), [0, 2, 4])
+            self.assertEqual(scan.scan_result['R']['recordCount'], 5)
+
+    def test_same_as_comparing_parameters(self):
+        ''' The change points are those found by comparing the parameters
+            of every datagram, even where the bytes change without the
+            parameters changing
+        '''
+        bodies = [b'ABCD', b'ABCd', b'ABCE', b'ABCe', b'ABCE', b'abcd']
+        self._write(bodies)
+        with ParametersScan(self.path) as scan:
+            scan.scan_datagram()
+            expected = _compare_parameters(
+                [RuntimeDatagram(i, body) for i, body in enumerate(bodies)])
+            self.assertEqual(expected, [0, 2, 5])
+            self.assertEqual(scan.changed_counters(), expected)
+
+    def test_incremental(self):
+        self._write(self.bodies[:3])
+        with ParametersScan(self.path) as scan:
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.changed_counters(), [0, 2])
+            # the parameters are compared with the last datagram read by
+            # the previous scan
+            self._write(self.bodies[3:], mode='ab', first_counter=3)
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.changed_counters(), [0, 2, 4])
+
+
+class TestMateScanSampled(unittest.TestCase):
+
+    sample_args = {
+        'head_size': 4096,
+        'tail_size': 4096,
+        'window_count': 10,
+        'window_size': 2048,
+    }
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(
+            os.path.join(self.temp_dir, "0001_20200107_line.all"), 20000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_extrapolated(self):
+        with HeaderScan(self.path) as scan:
+            scan.scan_sampled(**self.sample_args)
+            self.assertTrue(scan.sampled)
+            info = scan.scan_result['h']
+            self.assertTrue(info['sampled'])
+            # every other datagram is a 'h', so the estimate is within 1%
+            self.assertAlmostEqual(info['recordCount'], 10000, delta=100)
+            self.assertGreater(info['errorBounds']['recordCount'], 0)
+            self.assertAlmostEqual(
+                scan.total_datagram_bytes(), os.path.getsize(self.path),
+                delta=6000)
+            # the counter of each 'h' datagram is two more than the last,
+            # jumps in the counter between windows aren't missed pings
+            self.assertAlmostEqual(info['missedPings'], 9999, delta=500)
+
+    def test_small_file(self):
+        ''' Files that are too small to sample are scanned in full '''
+        path = write_all_file(os.path.join(self.temp_dir, "small.all"), 50)
+        with HeaderScan(path) as scan:
+            scan.scan_sampled(**self.sample_args)
+            self.assertFalse(scan.sampled)
+            self.assertEqual(scan.scan_result['h']['recordCount'], 25)
+
+    def test_scan_all(self):
+        with ScanALL(self.path) as scan:
+            scan.scan_datagram()
+            expected = scan.scan_result
+        with ScanALL(self.path) as scan:
+            scan.scan_sampled(**self.sample_args)
+            self.assertTrue(scan.sampled)
+            for dg_type in ['h', 'C']:
+                self.assertAlmostEqual(
+                    scan.scan_result[dg_type]['recordCount'],
+                    expected[dg_type]['recordCount'], delta=100)
+                self.assertEqual(
+                    scan.scan_result[dg_type]['startTime'],
+                    expected[dg_type]['startTime'])
+                self.assertEqual(
+                    scan.scan_result[dg_type]['stopTime'],
+                    expected[dg_type]['stopTime'])
+
+
+class TestMateScanIncremental(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        source = write_all_file(os.path.join(self.temp_dir, "source.all"), 100)
+        with open(source, 'rb') as f:
+            self.data = f.read()
+        self.path = os.path.join(self.temp_dir, "0001_20200107_line.all")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, end):
+        ''' writes the synthetic file up to `end`, as if still logging '''
+        with open(self.path, 'wb') as f:
+            f.write(self.data[:end])
+
+    def _append(self, start, end):
+        with open(self.path, 'ab') as f:
+            f.write(self.data[start:end])
+
+    def test_follow(self):
+        ''' Appended datagrams are added to the results of the last scan,
+            a partly written datagram is left for the next scan
+        '''
+        # part way through the 'h' datagram at 60
+        self._write(70)
+        with HeaderScan(self.path) as scan:
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.scanned_offset, 60)
+            self.assertEqual(scan.scan_result['h']['recordCount'], 1)
+            self.assertEqual(scan.scan_result['C']['recordCount'], 1)
+
+            # only the header of the next datagram
+            self._append(70, 90)
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.scanned_offset, 88)
+            self.assertEqual(scan.scanned_count, 3)
+
+            self._append(90, len(self.data))
+            scan.scan_datagram(incremental=True)
+            # only the new datagrams were read
+            self.assertEqual(scan.scanned_count, 100)
+            self.assertEqual(scan.scanned_offset, len(self.data))
+            followed = scan.scan_result
+
+            # nothing new
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.scanned_count, 100)
+
+        self.assertTrue(scan.is_size_matched())
+        with HeaderScan(self.path) as scan:
+            scan.scan_datagram()
+            self.assertEqual(scan.scan_result, followed)
+
+    def test_replaced(self):
+        ''' A file that is smaller than when it was last scanned has been
+            replaced, so it is scanned again from the start
+        '''
+        self._write(len(self.data))
+        with HeaderScan(self.path) as scan:
+            scan.scan_datagram(incremental=True)
+            self._write(60)
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.scanned_offset, 60)
+            self.assertEqual(scan.scan_result['h']['recordCount'], 1)
+
+    def test_compressed(self):
+        self._write(len(self.data))
+        with open(self.path, 'rb') as f_in:
+            with gzip.open(self.path + '.gz', 'wb') as f_out:
+                f_out.write(f_in.read())
+        with HeaderScan(self.path + '.gz') as scan:
+            with self.assertRaises(ValueError):
+                scan.scan_datagram(incremental=True)
+
+    def test_scan_all(self):
+        self._write(70)
+        with ScanALL(self.path) as scan:
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.scanned_offset, 60)
+            self._append(70, len(self.data))
+            scan.scan_datagram(incremental=True)
+            self.assertEqual(scan.scan_result['h']['recordCount'], 50)
+            self.assertEqual(scan.corrupt_ranges, [])
+            self.assertTrue(scan.is_size_matched())
+
+
+class TestMateScanMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data):
+        path = os.path.join(self.temp_dir, "0001_20200107_line.all")
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_stops_early(self):
+        path = write_all_file(
+            os.path.join(self.temp_dir, "0001_20200107_line.all"), 1000)
+        with HeaderScan(path) as scan:
+            scan.scan_metadata()
+            self.assertTrue(scan.metadata_only)
+            self.assertEqual(scan.scanned_count, 2)
+            self.assertEqual(scan.datagrams['C'], [1])
+            # a full scan clears the flag
+            scan.raw_file.stream.seek(0)
+            scan.scan_datagram()
+            self.assertFalse(scan.metadata_only)
+            self.assertEqual(scan.scan_result['C']['recordCount'], 500)
+
+    def test_tail(self):
+        ''' Metadata that isn't near the start of the file is found at the
+            end, without reading the rest of the file
+        '''
+        data = b''.join(
+            all_height_datagram(counter=i) for i in range(1000)) + \
+            all_clock_datagram(counter=1000) + \
+            all_height_datagram(counter=1001)
+        with HeaderScan(self._write(data)) as scan:
+            scan.scan_metadata(head_size=1024, tail_size=1024)
+            self.assertEqual(scan.datagrams['C'], [1000])
+            self.assertLess(scan.scanned_count, 100)
+
+    def test_missing(self):
+        data = b''.join(all_height_datagram(counter=i) for i in range(100))
+        with HeaderScan(self._write(data)) as scan:
+            scan.scan_metadata(head_size=1024, tail_size=1024)
+            self.assertTrue(scan.metadata_only)
+            self.assertNotIn('C', scan.datagrams)
+
+
+class TestMateScanQuickInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        source = write_all_file(
+            os.path.join(self.temp_dir, "source.all"), 10000)
+        with open(source, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, data, name="0001_20200107_line.all"):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_quick_info(self):
+        with HeaderScan(self._write(self.data)) as scan:
+            info = scan.quick_info(probe_size=4096)
+        self.assertEqual(info['startTime'], datetime(2020, 1, 7))
+        # a datagram every second
+        self.assertEqual(
+            info['stopTime'], datetime(2020, 1, 7, 2, 46, 39))
+        self.assertEqual(info['firstDatagramOffset'], 0)
+        self.assertEqual(info['lastDatagramEnd'], len(self.data))
+        self.assertEqual(info['models'], [710])
+        self.assertEqual(info['serialNumbers'], [100])
+
+    def test_damaged_ends(self):
+        ''' Junk before the first datagram, and a datagram cut off at the
+            end of the file, are skipped
+        '''
+        data = b'\x02h' * 7 + self.data[:-10]
+        with HeaderScan(self._write(data)) as scan:
+            info = scan.quick_info(probe_size=4096)
+        self.assertEqual(info['firstDatagramOffset'], 14)
+        self.assertEqual(
+            info['stopTime'], datetime(2020, 1, 7, 2, 46, 38))
+        self.assertEqual(info['lastDatagramEnd'], len(data) - 22)
+
+    def test_compressed(self):
+        path = self._write(
+            gzip.compress(self.data), name="0001_20200107_line.all.gz")
+        with HeaderScan(path) as scan:
+            info = scan.quick_info(probe_size=4096)
+        self.assertEqual(
+            info['stopTime'], datetime(2020, 1, 7, 2, 46, 39))
+        self.assertEqual(info['lastDatagramEnd'], len(self.data))
+
+    def test_kmall_header_info(self):
+        header = kmall_datagram('#MRZ', bytes(100), echo_sounder_id=2040)
+        dg_type, _time, model, serial = _kmall_header_info(header[:64])
+        self.assertEqual(dg_type, 'MRZ')
+        self.assertEqual(model, 2040)
+        self.assertIsNone(serial)
+        self.assertIsNone(_kmall_header_info(b'\x00' * 64))
+
 
 def suite():
     s = unittest.TestSuite()
     s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateScan))
     s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateScanResult))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanProgress))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanConcurrent))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanParameters))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanSampled))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanIncremental))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanMetadata))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateScanQuickInfo))
     return s
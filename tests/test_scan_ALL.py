@@ -1,10 +1,14 @@
 import unittest
 import os
+import shutil
+import tempfile
 import time
 from collections import namedtuple
 from hyo2.mate.lib.scan_ALL import ScanALL
 from hyo2.mate.lib import scan
 
+from tests.synthetic_data import write_all_file
+
 TEST_FILE1 = "0200_MBES_EM122_20150203_010431_Supporter_GA4430.all"
 TEST_FILE = "0243_P007_MBES_EM122_20150207_044356_Supporter_GA4430.all"
 
@@ -154,7 +158,47 @@ class TestMateScanALL(unittest.TestCase):
         )
 
 
+class TestMateScanALLCorrupt(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(os.path.join(self.temp_dir, "a.all"), 100)
+        with open(self.path, 'rb') as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _scan(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        with ScanALL(self.path) as scan:
+            scan.scan_datagram()
+            return scan.scan_result, scan.unaccounted_bytes(), \
+                scan.total_datagram_bytes()
+
+    def test_resync(self):
+        ''' Scanning continues after garbage written over the file, and a
+            truncated datagram at the end of it
+        '''
+        # each pair of h (28 bytes) and C (32 bytes) datagrams is 60 bytes,
+        # so this overwrites the 11th and 12th datagrams
+        damaged = self.data[:300] + b'\xff' * 45 + self.data[345:-10]
+        result, unaccounted, total = self._scan(damaged)
+        self.assertEqual(unaccounted, [(300, 360), (2968, 2990)])
+        self.assertEqual(result['h']['recordCount'], 49)
+        self.assertEqual(result['C']['recordCount'], 48)
+        self.assertEqual(total + 60 + 22, len(damaged))
+
+    def test_clean(self):
+        result, unaccounted, total = self._scan(self.data)
+        self.assertEqual(unaccounted, [])
+        self.assertEqual(total, len(self.data))
+
+
 def suite():
     s = unittest.TestSuite()
     s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateScanALL))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateScanALLCorrupt))
     return s
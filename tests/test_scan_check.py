@@ -1,8 +1,13 @@
 import unittest
 import os
 import time
+from unittest import mock
 import pytest
-from hyo2.mate.lib.utils import get_scan, get_check
+from hyo2.mate.lib.scan_check import ScanCheck, \
+    BackscatterAvailableCheck, EllipsoidHeightAvailableCheck
+from hyo2.mate.lib import utils
+from hyo2.mate.lib.utils import get_scan, get_check, all_checks, \
+    check_registry, is_check_supported, register_check
 
 
 TEST_FILE1 = "0200_MBES_EM122_20150203_010431_Supporter_GA4430.all"
@@ -38,7 +43,65 @@ class TestMateScanCheck(unittest.TestCase):
             check = get_check(check_id, check_version, scan, check_params)
 
 
+class TestMateCheckRegistry(unittest.TestCase):
+
+    def test_all_checks_registered(self):
+        for check in all_checks:
+            self.assertIs(check_registry[(check.id, check.version)], check)
+            self.assertTrue(is_check_supported(check.id, check.version))
+        self.assertFalse(is_check_supported('not-a-check', '1'))
+
+    def test_distinct_ids(self):
+        self.assertNotEqual(
+            BackscatterAvailableCheck.id, EllipsoidHeightAvailableCheck.id)
+        check = get_check(
+            EllipsoidHeightAvailableCheck.id,
+            EllipsoidHeightAvailableCheck.version,
+            None,
+            [])
+        self.assertIsInstance(check, EllipsoidHeightAvailableCheck)
+
+    def test_register_collision(self):
+        class DuplicateCheck(ScanCheck):
+            id = BackscatterAvailableCheck.id
+            name = "Duplicate"
+            version = BackscatterAvailableCheck.version
+
+        with pytest.raises(ValueError):
+            register_check(DuplicateCheck)
+        # re-registering the same class is harmless
+        register_check(BackscatterAvailableCheck)
+
+    def test_clashing_plugin_ignored(self):
+        class PluginCheck(ScanCheck):
+            id = 'b8a2f1c4-0d6e-4b39-9f5a-2c7e1d3a6b90'
+            name = "Plugin"
+            version = '1'
+
+        class ClashingCheck(ScanCheck):
+            id = BackscatterAvailableCheck.id
+            name = "Clashing"
+            version = BackscatterAvailableCheck.version
+
+        entry_point = mock.Mock()
+        entry_point.name = 'clashing'
+        entry_point.load.return_value = [PluginCheck, ClashingCheck]
+        with mock.patch.object(
+                utils, 'entry_points', return_value=[entry_point]):
+            utils._load_check_plugins()
+        # none of the plugin's checks are registered, including those
+        # before the clashing check
+        self.assertFalse(is_check_supported(PluginCheck.id, '1'))
+        self.assertNotIn(PluginCheck, all_checks)
+        self.assertIs(
+            check_registry[(BackscatterAvailableCheck.id,
+                            BackscatterAvailableCheck.version)],
+            BackscatterAvailableCheck)
+
+
 def suite():
     s = unittest.TestSuite()
     s.addTests(unittest.TestLoader().loadTestsFromTestCase(TestMateScanCheck))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateCheckRegistry))
     return s
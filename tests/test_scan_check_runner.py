@@ -2,11 +2,18 @@ import json
 import os
 from ausseabed.qajson.model import QajsonCheck
 import pytest
-import time
+import shutil
+import sys
+import tempfile
 import unittest
 
+from ausseabed.qajson.model import QajsonOutputs
 from hyo2.mate.lib.check_runner import CheckRunner
-from hyo2.mate.lib.utils import get_scan
+from hyo2.mate.lib.scan_check import EllipsoidHeightAvailableCheck, \
+    BathymetryAvailableCheck, FilenameChangedCheck, \
+    InstallationParametersCheck
+from hyo2.mate.lib.utils import get_scan, is_metadata_check
+from tests.synthetic_data import write_all_file
 
 qajson = """
 [
@@ -104,9 +111,255 @@ class TestMateCheckRunner(unittest.TestCase):
             'test/three.all', 'Raw Files')]
         self.assertEqual(len(file_three_checks), 1)
 
+    def test_add_output(self):
+        """ Checks outputs are attached to the check that includes the
+        file the output was generated for.
+        """
+        qajson_checks = [QajsonCheck.from_dict(d) for d in self.checks_json]
+        checkrunner = CheckRunner(qajson_checks)
+        checkrunner.initialize()
+
+        output = QajsonOutputs(messages=["three"])
+        checkrunner._add_output(
+            "4a3f3371-3a21-44f2-93cf-d9ed19d0c002", "test/three.all", output)
+        self.assertIs(qajson_checks[1].outputs, output)
+        self.assertIsNone(qajson_checks[0].outputs)
+
+        with pytest.raises(RuntimeError):
+            checkrunner._add_output(
+                "7761e08b-1380-46fa-a7eb-f1f41db38541", "test/three.all",
+                output)
+
+
+class TestMateMetadataChecks(unittest.TestCase):
+
+    def test_metadata_checks(self):
+        self.assertTrue(is_metadata_check(
+            FilenameChangedCheck.id, FilenameChangedCheck.version))
+        self.assertTrue(is_metadata_check(
+            InstallationParametersCheck.id,
+            InstallationParametersCheck.version))
+        self.assertFalse(is_metadata_check(
+            BathymetryAvailableCheck.id, BathymetryAvailableCheck.version))
+        self.assertFalse(is_metadata_check("unknown", "1"))
+
+
+class CountingDict(dict):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.lookups = 0
+
+    def get(self, *args):
+        self.lookups += 1
+        return super().get(*args)
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return super().__getitem__(key)
+
+
+class CountingList(list):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.iterations = 0
+
+    def __iter__(self):
+        self.iterations += 1
+        return super().__iter__()
+
+
+class TestMateCheckRunnerBenchmark(unittest.TestCase):
+
+    def test_add_output_many_checks(self):
+        """ Attaches outputs for a QA JSON with one check definition per
+        file, as generated by the QAX plugin, for tens of thousands of checks.
+        """
+        check_ids = [
+            "7761e08b-1380-46fa-a7eb-f1f41db38541",
+            "4a3f3371-3a21-44f2-93cf-d9ed19d0c002",
+        ]
+        file_count = 15000
+        checks_json = []
+        for i in range(file_count):
+            for check_id in check_ids:
+                checks_json.append({
+                    "info": {
+                        "id": check_id,
+                        "name": check_id,
+                        "description": "",
+                        "version": "1",
+                        "group": {"id": "123", "name": "123"}
+                    },
+                    "inputs": {
+                        "files": [{
+                            "path": "test/{:05d}.all".format(i),
+                            "description": "raw input",
+                            "file_type": "Raw Files"
+                        }]
+                    }
+                })
+        qajson_checks = [QajsonCheck.from_dict(d) for d in checks_json]
+
+        checkrunner = CheckRunner(qajson_checks)
+        checkrunner.initialize()
+        # count the lookups made, and any search through the list of checks
+        checkrunner._check_index = CountingDict(checkrunner._check_index)
+        checkrunner._output = CountingList(checkrunner._output)
+        for (filename, _), checklist in checkrunner._file_checks.items():
+            for check in checklist:
+                checkrunner._add_output(
+                    check.info.id, filename, QajsonOutputs())
+
+        self.assertTrue(all(c.outputs is not None for c in qajson_checks))
+        # one lookup per output, a linear search per output takes minutes
+        # for this many checks
+        self.assertEqual(checkrunner._check_index.lookups, len(qajson_checks))
+        self.assertEqual(checkrunner._output.iterations, 0)
+
+
+def _open_fd_count():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith('linux'), reason="requires /proc")
+class TestMateCheckRunnerResources(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_many_files_resource_budget(self):
+        """ Runs a check over many small files making sure file handles
+        and memory used for each file are released once it has been
+        checked. A leaked handle for each file would exceed the budget.
+        """
+        file_count = 50
+        template = write_all_file(
+            os.path.join(self.temp_dir, "template.all"), 100)
+        checks = []
+        for i in range(file_count):
+            path = os.path.join(
+                self.temp_dir, "{:04d}_20200107_000000.all".format(i))
+            shutil.copyfile(template, path)
+            checks.append(QajsonCheck.from_dict({
+                "info": {
+                    "id": EllipsoidHeightAvailableCheck.id,
+                    "name": EllipsoidHeightAvailableCheck.name,
+                    "description": "",
+                    "version": EllipsoidHeightAvailableCheck.version,
+                    "group": {"id": "123", "name": "123"}
+                },
+                "inputs": {
+                    "files": [{
+                        "path": path,
+                        "description": "raw input",
+                        "file_type": "Raw Files"
+                    }]
+                }
+            }))
+
+        checkrunner = CheckRunner(checks)
+        checkrunner.initialize()
+
+        fd_before = _open_fd_count()
+        rss_before = _rss_bytes()
+        checkrunner.run_checks()
+        fd_after = _open_fd_count()
+        rss_after = _rss_bytes()
+
+        for check in checks:
+            self.assertEqual(check.outputs.execution.status, "completed")
+            self.assertEqual(check.outputs.check_state, "pass")
+        self.assertLessEqual(fd_after - fd_before, 4)
+        self.assertLess(rss_after - rss_before, 64 * 1024 * 1024)
+
+
+class TestMateCheckRunnerThreaded(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _checks(self, file_count):
+        checks = []
+        for i in range(file_count):
+            path = os.path.join(
+                self.temp_dir, "{:04d}_20200107_000000.all".format(i))
+            if not os.path.exists(path):
+                write_all_file(path, 100 + i)
+            for check_class in [
+                    EllipsoidHeightAvailableCheck, BathymetryAvailableCheck]:
+                checks.append(QajsonCheck.from_dict({
+                    "info": {
+                        "id": check_class.id,
+                        "name": check_class.name,
+                        "description": "",
+                        "version": check_class.version,
+                        "group": {"id": "123", "name": "123"}
+                    },
+                    "inputs": {
+                        "files": [{
+                            "path": path,
+                            "description": "raw input",
+                            "file_type": "Raw Files"
+                        }]
+                    }
+                }))
+        return checks
+
+    def test_threaded_matches_serial(self):
+        serial_checks = self._checks(100)
+        serial_runner = CheckRunner(serial_checks)
+        serial_runner.initialize()
+        serial_runner.run_checks()
+
+        progress = []
+        updates = []
+        threaded_checks = self._checks(100)
+        threaded_runner = CheckRunner(threaded_checks)
+        threaded_runner.initialize()
+        threaded_runner.run_checks(
+            progress_callback=progress.append,
+            qajson_update_callback=lambda: updates.append(True),
+            max_workers=8)
+
+        for serial, threaded in zip(serial_checks, threaded_checks):
+            self.assertEqual(
+                serial.outputs.check_state, threaded.outputs.check_state)
+            self.assertEqual(serial.outputs.messages, threaded.outputs.messages)
+            self.assertEqual(serial.outputs.data, threaded.outputs.data)
+            self.assertEqual(
+                threaded.outputs.execution.status, "completed")
+        self.assertEqual(len(updates), 100)
+        self.assertAlmostEqual(progress[-1], 1.0)
+        self.assertEqual(progress, sorted(progress))
+
 
 def suite():
     s = unittest.TestSuite()
     s.addTests(
         unittest.TestLoader().loadTestsFromTestCase(TestMateCheckRunner))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMateMetadataChecks))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestMateCheckRunnerBenchmark))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestMateCheckRunnerResources))
+    s.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestMateCheckRunnerThreaded))
     return s
@@ -0,0 +1,105 @@
+import json
+import unittest
+
+import numpy as np
+
+from hyo2.mate.lib.serialise import datagram_attributes, datagram_to_dict, \
+    datagrams_to_dicts
+
+
+class RuntimeDatagram:
+    '''Stands in for a decoded pyall runtime parameters datagram'''
+
+    def __init__(self, time, mode, depths):
+        self.offset = 100
+        self.fileptr = None
+        self.typeOfDatagram = 'R'
+        self.Time = np.float64(time)
+        self.Mode = np.uint8(mode)
+        self.Depths = np.array(depths)
+        self.SerialNumber = 100
+
+    def read(self):
+        pass
+
+    def parameters(self):
+        return "Mode: {}".format(self.Mode)
+
+
+class PositionDatagram:
+
+    def __init__(self, latitude):
+        self.Latitude = np.float32(latitude)
+
+
+class SwathDatagram:
+    '''Only has the arrays of the subrecords in its ping, as pygsf swaths'''
+
+    def __init__(self, depths=None, amplitudes=None):
+        if depths is not None:
+            self.DEPTH_ARRAY = np.array(depths)
+        if amplitudes is not None:
+            self.AMPLITUDE_ARRAY = np.array(amplitudes)
+
+
+class TestMateSerialise(unittest.TestCase):
+
+    def test_attributes(self):
+        datagram = RuntimeDatagram(1.5, 2, [1.0])
+        attributes = datagram_attributes(datagram)
+        self.assertEqual(
+            attributes, ('Depths', 'Mode', 'SerialNumber', 'Time'))
+        # looked up once for datagrams of a class with the same attributes
+        self.assertIs(
+            datagram_attributes(RuntimeDatagram(2.5, 3, [])), attributes)
+
+        self.assertEqual(
+            datagram_attributes(SwathDatagram(depths=[1.0])),
+            ('DEPTH_ARRAY',))
+        self.assertEqual(
+            datagram_attributes(SwathDatagram(amplitudes=[2.0])),
+            ('AMPLITUDE_ARRAY',))
+
+    def test_to_dict(self):
+        dg_dict = datagram_to_dict(RuntimeDatagram(1.5, 2, [1.0, 2.0]))
+        self.assertEqual(dg_dict, {
+            'Depths': [1.0, 2.0],
+            'Mode': 2,
+            'SerialNumber': 100,
+            'Time': 1.5,
+        })
+        self.assertIsInstance(dg_dict['Mode'], int)
+        json.dumps(dg_dict)
+
+    def test_to_dicts(self):
+        datagrams = [
+            RuntimeDatagram(1.5, 2, [1.0]),
+            PositionDatagram(-42.5),
+            RuntimeDatagram(2.5, 3, []),
+        ]
+        dicts = datagrams_to_dicts(datagrams)
+        self.assertEqual(
+            [d.get('Mode') for d in dicts], [2, None, 3])
+        self.assertEqual(dicts[1], {'Latitude': -42.5})
+        self.assertEqual(dicts[2]['Depths'], [])
+        self.assertIsInstance(dicts[0]['Time'], float)
+        json.dumps(dicts)
+        self.assertEqual(datagrams_to_dicts([]), [])
+
+        dicts = datagrams_to_dicts([
+            SwathDatagram(depths=[1.0]),
+            SwathDatagram(amplitudes=[2.0]),
+            SwathDatagram(depths=[3.0], amplitudes=[4.0]),
+        ])
+        self.assertEqual(dicts, [
+            {'DEPTH_ARRAY': [1.0]},
+            {'AMPLITUDE_ARRAY': [2.0]},
+            {'AMPLITUDE_ARRAY': [4.0], 'DEPTH_ARRAY': [3.0]},
+        ])
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateSerialise))
+    return s
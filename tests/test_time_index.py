@@ -0,0 +1,175 @@
+from datetime import datetime, timezone
+import io
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from hyo2.mate.lib.scan_ALL import ScanALL, _all_timestamps, \
+    _parse_all_header
+from hyo2.mate.lib.scan_KMALL import _parse_kmall_header
+from hyo2.mate.lib.scan_gsf import _parse_gsf_header
+from hyo2.mate.lib.time_index import TimeIndex, walk_headers, to_timestamp
+
+from tests.synthetic_data import write_all_file, write_kmall_file, \
+    gsf_record, gsf_header_record
+
+# time of the first datagram in the synthetic files
+START = datetime(2020, 1, 7, tzinfo=timezone.utc).timestamp()
+
+
+class TestMateTimeIndex(unittest.TestCase):
+
+    def setUp(self):
+        # two datagram types, alternating, one second apart. The last
+        # datagram doesn't record a time.
+        self.index = TimeIndex(
+            np.arange(0, 1000, 10),
+            np.array(['a', 'b'] * 50),
+            np.append(START + np.arange(99.0), np.nan))
+
+    def test_find(self):
+        offsets = self.index.find(start_time=START + 10, end_time=START + 13)
+        self.assertEqual(list(offsets), [100, 110, 120, 130])
+        offsets = self.index.find(
+            ['b'], datetime(2020, 1, 7, 0, 0, 10), START + 13)
+        self.assertEqual(list(offsets), [110, 130])
+        # untimed datagrams are only included without a time window
+        self.assertEqual(len(self.index.find()), 100)
+        self.assertEqual(len(self.index.find(start_time=START)), 99)
+        self.assertEqual(len(self.index.find(end_time=START - 1)), 0)
+
+    def test_out_of_order(self):
+        ''' Datagrams are found in time order, whatever their order in the
+            file
+        '''
+        index = TimeIndex(
+            np.array([0, 10, 20, 30]),
+            np.array(['a', 'a', 'a', 'a']),
+            np.array([START + 2, START, START + 1, START + 1]))
+        self.assertEqual(list(index.find()), [10, 20, 30, 0])
+
+    def test_type_offsets(self):
+        self.assertEqual(list(self.index.type_offsets('a')[:3]), [0, 20, 40])
+        self.assertFalse(self.index.has_type('c'))
+
+    def test_to_timestamp(self):
+        self.assertEqual(to_timestamp(datetime(2020, 1, 7)), START)
+        self.assertEqual(to_timestamp(START), START)
+        self.assertIsNone(to_timestamp(None))
+
+    def test_all_timestamps(self):
+        times = _all_timestamps(
+            np.array([20200107, 20200229, 0]), np.array([1500, 0, 0]))
+        self.assertEqual(times[0], START + 1.5)
+        self.assertEqual(
+            times[1], datetime(2020, 2, 29, tzinfo=timezone.utc).timestamp())
+        self.assertTrue(np.isnan(times[2]))
+
+    def test_parse_all_header(self):
+        header = struct.pack(
+            '<LBBHLL', 100, 0x02, ord('P'), 710, 20200107, 1500)
+        self.assertEqual(_parse_all_header(header), (104, 'P', START + 1.5))
+        # types are ASCII letters or digits only
+        for dg_type in [0xE9, ord('#')]:
+            header = struct.pack(
+                '<LBBHLL', 100, 0x02, dg_type, 710, 20200107, 1500)
+            self.assertIsNone(_parse_all_header(header))
+
+    def test_valid_all_header(self):
+        ''' The headers read by pyall are validated as the index does,
+            rejecting non-ASCII types such as 0xAA ('ª')
+        '''
+        header = (104, 0x02, 'P', 710, 20200107, 1500, 1, 100)
+        self.assertTrue(ScanALL._is_valid_header(None, header))
+        for dg_type in [chr(0xAA), chr(0xE9), '#', 'XXX', 0]:
+            header = (104, 0x02, dg_type, 710, 20200107, 1500, 1, 100)
+            self.assertFalse(ScanALL._is_valid_header(None, header))
+
+    def test_walk_kmall(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = write_kmall_file(os.path.join(temp_dir, "a.kmall"), 20)
+            with open(path, 'rb') as f:
+                index = walk_headers(f, _parse_kmall_header)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(len(index), 20)
+        self.assertEqual(index.types[0], 'SKM')
+        # the synthetic .kmall datagrams start at 04:00
+        kmall_start = START + 4 * 3600
+        self.assertEqual(
+            len(index.find(['SPO'], kmall_start + 5, kmall_start + 9)), 3)
+
+    def test_walk_gsf(self):
+        # every record other than the header starts with its time
+        data = gsf_header_record() + b''.join(
+            gsf_record(2, struct.pack('>ii', int(START) + i, 500000000) +
+                       bytes(i))
+            for i in range(10))
+        index = walk_headers(io.BytesIO(data), _parse_gsf_header)
+        self.assertEqual(len(index), 11)
+        self.assertTrue(np.isnan(index.times[0]))
+        self.assertEqual(index.times[1], START + 0.5)
+        self.assertEqual(
+            list(index.find([2], START + 3, START + 4)),
+            list(index.type_offsets(2)[3:4]))
+
+    def test_benchmark(self):
+        ''' Windowed queries of an index of millions of datagrams take
+            well under a millisecond each
+        '''
+        count = 5000000
+        index = TimeIndex(
+            np.arange(count) * 100,
+            np.array(['X', 'P', 'A', 'h', 'C'] * (count // 5)),
+            START + np.arange(count) * 0.25)
+        start = time.perf_counter()
+        for minute in range(100):
+            offsets = index.find(
+                ['P'], START + minute * 60, START + minute * 60 + 600)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(offsets), 480)
+        self.assertLess(elapsed, 1.0)
+
+
+class TestMateScanALLTimeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = write_all_file(
+            os.path.join(self.temp_dir, "0001_20200107_line.all"), 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_iter_datagrams(self):
+        with ScanALL(self.path) as scan:
+            # 'h' datagrams are written every other second
+            datagrams = list(scan.iter_datagrams(
+                ['h'], START + 10, START + 20))
+            self.assertEqual([dg_type for dg_type, _ in datagrams], ['h'] * 6)
+            self.assertEqual(len(scan.get_time_index()), 100)
+            # the file can still be scanned from the start
+            scan.scan_datagram()
+            self.assertEqual(scan.scan_result['h']['recordCount'], 50)
+
+    def test_get_ping(self):
+        with ScanALL(self.path) as scan:
+            with self.assertRaises(IndexError):
+                scan.get_ping(0)
+            dg_type, _ = scan.get_ping(-1, datagram_type='C')
+            self.assertEqual(dg_type, 'C')
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateTimeIndex))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateScanALLTimeIndex))
+    return s
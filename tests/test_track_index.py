@@ -0,0 +1,172 @@
+import unittest
+
+import numpy as np
+from ausseabed.qajson.model import QajsonCheck, QajsonOutputs
+
+from hyo2.mate.lib.check_runner import CheckRunner
+from hyo2.mate.lib.scan import ScanState
+from hyo2.mate.lib.scan_check import SurveyTracksCheck
+from hyo2.mate.lib.track_index import check_tracks, project, simplify, \
+    simplify_track, unproject, TrackIndex
+
+ORIGIN = (150.0, -33.0)
+
+
+def _track(points):
+    ''' Longitude and latitude of positions given in metres from ORIGIN '''
+    return unproject(np.array(points, dtype=np.float64), ORIGIN)
+
+
+def _line(x0, y0, x1, y1, count=50):
+    return _track(np.column_stack([
+        np.linspace(x0, x1, count), np.linspace(y0, y1, count)]))
+
+
+class TestMateTrackIndex(unittest.TestCase):
+
+    def test_project(self):
+        xy = np.array([[0.0, 0.0], [1000.0, -500.0]])
+        np.testing.assert_allclose(
+            project(unproject(xy, ORIGIN), ORIGIN), xy, atol=1e-6)
+
+    def test_simplify(self):
+        points = np.array([
+            [0.0, 0.0], [10.0, 0.1], [20.0, -0.1], [30.0, 0.0],
+            [30.0, 10.0], [30.0, 20.0]])
+        np.testing.assert_array_equal(simplify(points, 1.0), [0, 3, 5])
+        # [30, 10] is on the line between its neighbours
+        self.assertEqual(len(simplify(points, 0.01)), 5)
+
+        track = simplify_track(_line(0, 0, 1000, 0, 500))
+        self.assertEqual(len(track), 2)
+        self.assertEqual(simplify_track(np.full((3, 2), np.nan)), [])
+
+    def test_grid_cells(self):
+        ''' A segment is only added to the cells it passes through, not
+            every cell of its bounding box
+        '''
+        index = TrackIndex(
+            {'a.all': _line(0, 0, 10000, 10000, 2)}, cell_size=10)
+        first = index._cell(index.starts[0])
+        last = index._cell(index.ends[0])
+        # about 1000 cells each way, a million in the bounding box
+        self.assertLessEqual(len(index._keys), (last - first + 1).sum())
+        self.assertEqual(len(np.unique(index._keys)), len(index._keys))
+        self.assertIn(index._key(*first), index._keys)
+        self.assertIn(index._key(*last), index._keys)
+        self.assertNotIn(index._key(first[0], last[1]), index._keys)
+
+    def test_crossings(self):
+        index = TrackIndex({
+            'a.all': _line(0, 0, 1000, 0),
+            'b.all': _line(500, -500, 500, 500),
+            # continues on from a.all, so doesn't cross it
+            'c.all': _line(1000, 0, 2000, 0),
+        })
+        crossings = index.crossings()
+        self.assertEqual(len(crossings), 1)
+        names = sorted(crossings[0][:2])
+        self.assertEqual(names, ['a.all', 'b.all'])
+        np.testing.assert_allclose(
+            project(np.array([crossings[0][2]]), ORIGIN), [[500, 0]],
+            atol=1e-3)
+
+    def test_nearest_line(self):
+        index = TrackIndex({
+            'a.all': _line(0, 0, 1000, 0),
+            'b.all': _line(0, 100, 1000, 100),
+            'c.all': _line(0, 300, 1000, 300),
+        })
+        name, distance = index.nearest_line('c.all')
+        self.assertEqual(name, 'b.all')
+        self.assertAlmostEqual(distance, 200, places=3)
+
+        index = TrackIndex({'a.all': _line(0, 0, 1000, 0)})
+        self.assertEqual(index.nearest_line('a.all'), (None, float('inf')))
+
+    def test_coverage_gaps(self):
+        index = TrackIndex({
+            'a.all': _line(0, 0, 1000, 0),
+            # runs away from a.all half way along
+            'b.all': _track([[0, 100], [500, 100], [1000, 600]]),
+        })
+        for name in ['a.all', 'b.all']:
+            gaps = project(
+                np.array(index.coverage_gaps(name, 150)), ORIGIN)
+            self.assertGreater(len(gaps), 0)
+            self.assertTrue(np.all(gaps[:, 0] > 500))
+        self.assertEqual(index.coverage_gaps('a.all', 1000), [])
+
+
+class TestMateCheckTracks(unittest.TestCase):
+
+    def test_check_tracks(self):
+        results = check_tracks({
+            'a.all': simplify_track(_line(0, 0, 1000, 0)),
+            'b.all': simplify_track(_line(0, 100, 1000, 100)),
+            'c.all': simplify_track(_line(500, -500, 500, 2000)),
+            'd.all': [],
+        }, max_line_spacing=200)
+        self.assertEqual(results['a.all'].state, ScanState.PASS)
+        self.assertEqual(
+            results['a.all'].messages, ["Crosses 1 other lines"])
+        self.assertEqual(
+            [c['file'] for c in results['b.all'].data['crossings']],
+            ['c.all'])
+        self.assertEqual(results['a.all'].data['nearestLine'], 'b.all')
+        self.assertAlmostEqual(
+            results['a.all'].data['nearestDistance'], 100, places=3)
+        # the far end of c.all is well away from the other lines
+        self.assertEqual(results['c.all'].state, ScanState.WARNING)
+        self.assertEqual(len(results['c.all'].data['crossings']), 2)
+        self.assertGreater(len(results['c.all'].data['coverageGaps']), 0)
+        self.assertEqual(results['d.all'].state, ScanState.WARNING)
+
+    def test_without_line_spacing(self):
+        results = check_tracks({
+            'a.all': simplify_track(_line(0, 0, 1000, 0)),
+            'b.all': simplify_track(_line(0, 5000, 1000, 5000)),
+        })
+        self.assertEqual(results['a.all'].state, ScanState.PASS)
+        self.assertEqual(results['a.all'].data['coverageGaps'], [])
+
+    def test_run_survey_checks(self):
+        paths = ['a.all', 'b.all']
+        check = QajsonCheck.from_dict({
+            'info': {
+                'id': SurveyTracksCheck.id,
+                'name': SurveyTracksCheck.name,
+                'description': '',
+                'version': SurveyTracksCheck.version,
+                'group': {'id': '1', 'name': '1'}
+            },
+            'inputs': {
+                'files': [
+                    {'path': p, 'description': 'raw input',
+                     'file_type': 'Raw Files'}
+                    for p in paths
+                ],
+                'params': [{'name': 'max_line_spacing', 'value': 50}]
+            }
+        })
+        runner = CheckRunner([check])
+        runner.initialize()
+        tracks = [_line(0, 0, 1000, 0), _line(0, 100, 1000, 100)]
+        # as gathered from each file by `SurveyTracksCheck.run_check`
+        for path, track in zip(paths, tracks):
+            runner._add_check_output(
+                check, path,
+                QajsonOutputs(data={'summary': simplify_track(track)}))
+        runner._run_survey_checks()
+        self.assertEqual(check.outputs.check_state, ScanState.WARNING)
+        self.assertEqual(
+            check.outputs.data['files']['b.all']['nearestLine'], 'a.all')
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateTrackIndex))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateCheckTracks))
+    return s
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from hyo2.mate.lib.scan_check import BathymetryAvailableCheck
+from hyo2.mate.lib.watch import DirectoryWatcher, ProcessedFiles, file_checks
+
+from tests.synthetic_data import write_all_file
+
+
+class TestMateDirectoryWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # the watcher is polled with explicit times, relative to when the
+        # test files were written
+        self.now = os.path.getmtime(self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _watcher(self, **kwargs):
+        return DirectoryWatcher(
+            [self.temp_dir], settle_time=10, use_events=False, **kwargs)
+
+    def test_settle(self):
+        ''' Files are only given once they stop changing, and only once '''
+        path = os.path.join(self.temp_dir, "0001_line.all")
+        write_all_file(path, 10)
+        with open(os.path.join(self.temp_dir, "notes.txt"), 'w') as f:
+            f.write("not a raw file")
+        with self._watcher() as watcher:
+            self.assertEqual(watcher.poll(self.now + 1), [])
+            self.assertEqual(watcher.pending_count, 1)
+            # still being written
+            write_all_file(path, 20)
+            self.assertEqual(watcher.poll(self.now + 9), [])
+            self.assertEqual(watcher.poll(self.now + 18), [])
+            self.assertEqual(watcher.poll(self.now + 19), [path])
+            self.assertEqual(watcher.poll(self.now + 60), [])
+            # changed after it was given
+            write_all_file(path, 30)
+            watcher.poll(self.now + 61)
+            self.assertEqual(watcher.poll(self.now + 71), [path])
+
+    def test_backlog(self):
+        ''' Files already present, and not modified recently, are ready
+            straight away. Files that have been processed are skipped.
+        '''
+        paths = [
+            write_all_file(os.path.join(self.temp_dir, name), 10)
+            for name in ["b.all", "a.kmall", "c.gsf.gz"]
+        ]
+        processed = ProcessedFiles()
+        stat = os.stat(paths[0])
+        processed.add(paths[0], stat.st_size, stat.st_mtime_ns)
+        with self._watcher(processed=processed) as watcher:
+            self.assertEqual(
+                watcher.poll(self.now + 60), sorted(paths[1:]))
+
+    def test_recursive(self):
+        sub_dir = os.path.join(self.temp_dir, "day1")
+        os.mkdir(sub_dir)
+        path = write_all_file(os.path.join(sub_dir, "a.all"), 10)
+        with self._watcher() as watcher:
+            self.assertEqual(watcher.poll(self.now + 60), [])
+        with self._watcher(recursive=True) as watcher:
+            self.assertEqual(watcher.poll(self.now + 60), [path])
+            self.assertEqual(
+                watcher.relative_path(path), os.path.join("day1", "a.all"))
+
+
+class TestMateProcessedFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_persisted(self):
+        path = os.path.join(self.temp_dir, "processed")
+        processed = ProcessedFiles(path)
+        processed.add("a.all", 100, 1)
+        processed.add("b.all", 200, 2)
+        processed.add("a.all", 150, 3)
+        # a line partly written when the watcher was stopped
+        with open(path, 'a') as f:
+            f.write('{"path": "c.al')
+
+        processed = ProcessedFiles(path)
+        self.assertEqual(len(processed), 2)
+        self.assertTrue(processed.is_processed("a.all", 150, 3))
+        self.assertFalse(processed.is_processed("a.all", 100, 1))
+        self.assertTrue(processed.is_processed("b.all", 200, 2))
+
+
+class TestMateFileChecks(unittest.TestCase):
+
+    def test_file_checks(self):
+        template = [{
+            "info": {
+                "id": BathymetryAvailableCheck.id,
+                "name": BathymetryAvailableCheck.name,
+                "description": "",
+                "version": BathymetryAvailableCheck.version,
+                "group": {"id": "123", "name": "123"}
+            },
+            "inputs": {
+                "files": [{
+                    "path": "template.all",
+                    "description": "raw input",
+                    "file_type": "Raw Files"
+                }]
+            }
+        }]
+        checks = file_checks(template, "line.all")
+        self.assertEqual(len(checks), 1)
+        self.assertEqual(checks[0].info.id, BathymetryAvailableCheck.id)
+        self.assertEqual(
+            [f.path for f in checks[0].inputs.files], ["line.all"])
+        # the template isn't changed
+        self.assertEqual(
+            template[0]["inputs"]["files"][0]["path"], "template.all")
+
+
+def suite():
+    s = unittest.TestSuite()
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateDirectoryWatcher))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateProcessedFiles))
+    s.addTests(unittest.TestLoader().loadTestsFromTestCase(
+        TestMateFileChecks))
+    return s